@@ -0,0 +1,234 @@
+import os
+import re
+import json
+import math
+from collections import Counter
+
+import numpy as np
+
+from inference.tokenizer import TextTokenizer
+
+_CJK_RE = re.compile(r'^[\u4e00-\u9fff]$')
+_WORD_RE = re.compile(r'^[a-z0-9]+$')
+
+
+class BM25Index:
+    """
+    BM25 倒排索引，作为关键词召回补充向量检索（SKU、品牌、型号这类词要求精确命中）：
+    - 分词沿用 TextTokenizer 的规则（中文按字、英文数字按词），相邻两个汉字再组成一个二元词，标点丢弃
+    - 倒排表存成 CSR 数组：词 t 的倒排在 post_docs / post_tf 的 term_offsets[t]:term_offsets[t+1] 段，
+      文档号升序；新文档先记在未合并的缓冲区，缓冲区超过主体的 1/8 时整体合并重排
+    - 打分只累加查询词倒排上的文档，不扫描全部文档
+    文档号与 VectorIndex 的行号一致，搜索时可传入同样长度的屏蔽位图（墓碑 / 过滤）。
+    """
+
+    def __init__(self, tokenizer=None, k1=1.2, b=0.75):
+        self.tokenizer = tokenizer if tokenizer is not None else TextTokenizer()
+        self.k1 = k1
+        self.b = b
+        self.vocab = {}  # 词 -> 词号
+        self.term_offsets = np.zeros(1, dtype=np.int64)
+        self.post_docs = np.empty(0, dtype=np.int32)
+        self.post_tf = np.empty(0, dtype=np.float32)
+        self._doc_len = np.empty(0, dtype=np.float32)
+        self._num_docs = 0
+        self._total_len = 0.0
+        self._pending = {}  # 词号 -> ([文档号], [词频])，尚未合并进 CSR
+        self._num_pending = 0
+        self._norm = None
+
+    def __len__(self):
+        return self._num_docs
+
+    def analyze(self, text):
+        """文本 -> 检索词列表：单字 / 英文数字词，外加相邻汉字组成的二元词"""
+        tokens = [t for t in self.tokenizer._tokenize(str(text)) if _CJK_RE.match(t) or _WORD_RE.match(t)]
+        bigrams = [a + b for a, b in zip(tokens, tokens[1:]) if _CJK_RE.match(a) and _CJK_RE.match(b)]
+        return tokens + bigrams
+
+    def add(self, texts):
+        """追加文档，文档号从当前文档数开始连续编号"""
+        lengths = []
+        for doc, text in enumerate(texts, start=self._num_docs):
+            terms = self.analyze(text)
+            lengths.append(len(terms))
+            for term, tf in Counter(terms).items():
+                tid = self.vocab.setdefault(term, len(self.vocab))
+                docs, tfs = self._pending.setdefault(tid, ([], []))
+                docs.append(doc)
+                tfs.append(tf)
+            self._num_pending += len(set(terms))
+        if not lengths:
+            return
+        self._grow_doc_len(self._num_docs + len(lengths))
+        self._doc_len[self._num_docs:self._num_docs + len(lengths)] = lengths
+        self._num_docs += len(lengths)
+        self._total_len += sum(lengths)
+        self._norm = None
+        if self._num_pending > max(4096, len(self.post_docs) // 8):
+            self.merge()
+
+    def _grow_doc_len(self, size):
+        if size > len(self._doc_len):
+            grown = np.empty(max(size, 2 * len(self._doc_len), 1024), dtype=np.float32)
+            grown[:self._num_docs] = self._doc_len[:self._num_docs]
+            self._doc_len = grown
+
+    def merge(self):
+        """把缓冲区合并进 CSR 倒排：新文档号都比已有的大，按词号稳定排序后每段仍是文档号升序"""
+        if not self._pending:
+            return
+        num_terms = len(self.vocab)
+        old_terms = np.repeat(np.arange(len(self.term_offsets) - 1), np.diff(self.term_offsets))
+        new_terms = np.concatenate([np.full(len(docs), tid) for tid, (docs, _) in self._pending.items()])
+        new_docs = np.concatenate([docs for docs, _ in self._pending.values()])
+        new_tf = np.concatenate([tfs for _, tfs in self._pending.values()])
+        terms = np.concatenate([old_terms, new_terms])
+        docs = np.concatenate([self.post_docs, new_docs]).astype(np.int32)
+        tfs = np.concatenate([self.post_tf, new_tf]).astype(np.float32)
+        order = np.lexsort((docs, terms))
+        self.post_docs = docs[order]
+        self.post_tf = tfs[order]
+        self.term_offsets = np.concatenate([[0], np.cumsum(np.bincount(terms, minlength=num_terms))]).astype(np.int64)
+        self._pending = {}
+        self._num_pending = 0
+
+    def _doc_norm(self):
+        """每篇文档的长度归一项 k1 * (1 - b + b * 文档长度 / 平均长度)，追加文档后重算"""
+        if self._norm is None:
+            avgdl = self._total_len / max(self._num_docs, 1) or 1.0
+            self._norm = self.k1 * (1 - self.b + self.b * self._doc_len[:self._num_docs] / avgdl)
+        return self._norm
+
+    def _postings(self, tid):
+        docs = self.post_docs[0:0]
+        tfs = self.post_tf[0:0]
+        if tid + 1 < len(self.term_offsets):
+            start, end = self.term_offsets[tid], self.term_offsets[tid + 1]
+            docs, tfs = self.post_docs[start:end], self.post_tf[start:end]
+        if tid in self._pending:
+            pending_docs, pending_tf = self._pending[tid]
+            docs = np.concatenate([docs, np.asarray(pending_docs, dtype=np.int32)])
+            tfs = np.concatenate([tfs, np.asarray(pending_tf, dtype=np.float32)])
+        return docs, tfs
+
+    def score(self, query, exclude=None):
+        """返回 (命中文档号, BM25 分数)；exclude 为屏蔽位图，其中为 True 的文档不返回"""
+        norm = self._doc_norm()
+        n = self._num_docs
+        hit_docs, hit_scores = [], []
+        for term in set(self.analyze(query)):
+            tid = self.vocab.get(term)
+            if tid is None:
+                continue
+            docs, tfs = self._postings(tid)
+            if len(docs) == 0:
+                continue
+            idf = math.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+            hit_docs.append(docs)
+            hit_scores.append(idf * tfs * (self.k1 + 1) / (tfs + norm[docs]))
+        if not hit_docs:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        docs, inverse = np.unique(np.concatenate(hit_docs), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(hit_scores)).astype(np.float32)
+        if exclude is not None:
+            keep = docs < len(exclude)
+            keep[keep] = ~exclude[docs[keep]]
+            docs, scores = docs[keep], scores[keep]
+        return docs.astype(np.int64), scores
+
+    def search(self, query, k=10, exclude=None):
+        """单条查询的前 k，返回 (scores, indices)，不足 k 个时 indices 为 -1"""
+        scores, indices = self.batch_search([query], k, exclude=exclude)
+        return scores[0], indices[0]
+
+    def batch_search(self, queries, k=10, exclude=None):
+        """批量查询，返回两个 (查询数, k) 数组，按分数降序，不足 k 个时 indices 为 -1"""
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        for qi, query in enumerate(queries):
+            docs, doc_scores = self.score(query, exclude)
+            if len(docs) > k:
+                top = np.argpartition(doc_scores, -k)[-k:]
+                docs, doc_scores = docs[top], doc_scores[top]
+            order = np.argsort(-doc_scores, kind='stable')
+            scores[qi, :len(order)] = doc_scores[order]
+            indices[qi, :len(order)] = docs[order]
+        return scores, indices
+
+    def save(self, dirpath):
+        """词表写成 JSON（按词号排列），倒排与文档长度写成 .npy，加载时可 mmap"""
+        self.merge()
+        os.makedirs(dirpath, exist_ok=True)
+        terms = [None] * len(self.vocab)
+        for term, tid in self.vocab.items():
+            terms[tid] = term
+        with open(os.path.join(dirpath, 'bm25.json'), 'w', encoding='utf-8') as f:
+            json.dump({'k1': self.k1, 'b': self.b, 'terms': terms}, f, ensure_ascii=False)
+        np.save(os.path.join(dirpath, 'bm25_offsets.npy'), self.term_offsets)
+        np.save(os.path.join(dirpath, 'bm25_docs.npy'), self.post_docs)
+        np.save(os.path.join(dirpath, 'bm25_tf.npy'), self.post_tf)
+        np.save(os.path.join(dirpath, 'bm25_doc_len.npy'), self._doc_len[:self._num_docs])
+
+    @classmethod
+    def load(cls, dirpath, tokenizer=None, mmap=True):
+        with open(os.path.join(dirpath, 'bm25.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+        index = cls(tokenizer, k1=meta['k1'], b=meta['b'])
+        index.vocab = {term: tid for tid, term in enumerate(meta['terms'])}
+        mode = 'r' if mmap else None
+        index.term_offsets = np.load(os.path.join(dirpath, 'bm25_offsets.npy'))
+        index.post_docs = np.load(os.path.join(dirpath, 'bm25_docs.npy'), mmap_mode=mode if len(index.vocab) else None)
+        index.post_tf = np.load(os.path.join(dirpath, 'bm25_tf.npy'), mmap_mode=mode if len(index.vocab) else None)
+        index._doc_len = np.load(os.path.join(dirpath, 'bm25_doc_len.npy'))
+        index._num_docs = len(index._doc_len)
+        index._total_len = float(index._doc_len.sum())
+        return index
+
+    @property
+    def nbytes(self):
+        pending = sum(len(docs) for docs, _ in self._pending.values()) * 16
+        return (self.term_offsets.nbytes + self.post_docs.nbytes + self.post_tf.nbytes
+                + self._doc_len.nbytes + pending)
+
+
+def reciprocal_rank_fusion(rank_lists, k=60, weights=None):
+    """
+    倒数排名融合（RRF）：每路召回里排第 r 名（从 1 起）的行得分 weight / (k + r)，各路相加。
+    rank_lists 为每路按相关度降序的行号序列（-1 为补位），返回按融合分数降序的 (scores, rows)。
+    只看名次、不看分数，不同召回的分数尺度不一致也没关系。
+    """
+    weights = weights or [1.0] * len(rank_lists)
+    fused = {}
+    for rows, weight in zip(rank_lists, weights):
+        for rank, row in enumerate(int(r) for r in rows if r >= 0):
+            fused[row] = fused.get(row, 0.0) + weight / (k + rank + 1)
+    return _sorted_items(fused)
+
+
+def weighted_score_fusion(score_lists, rank_lists, weights):
+    """
+    加权分数融合：每路分数先按该路召回结果 min-max 归一化到 [0, 1]，再按 weights 加权求和，
+    某一路没有召回的行在该路记 0。返回按融合分数降序的 (scores, rows)。
+    """
+    fused = {}
+    for scores, rows, weight in zip(score_lists, rank_lists, weights):
+        valid = np.asarray(rows) >= 0
+        scores = np.asarray(scores, dtype=np.float64)[valid]
+        if len(scores) == 0:
+            continue
+        lo, hi = scores.min(), scores.max()
+        normalized = (scores - lo) / (hi - lo) if hi > lo else np.ones_like(scores)
+        for row, s in zip(np.asarray(rows)[valid].tolist(), normalized.tolist()):
+            fused[row] = fused.get(row, 0.0) + weight * s
+    return _sorted_items(fused)
+
+
+def _sorted_items(fused):
+    if not fused:
+        return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)
+    rows = np.fromiter(fused.keys(), dtype=np.int64, count=len(fused))
+    scores = np.fromiter(fused.values(), dtype=np.float64, count=len(fused)).astype(np.float32)
+    order = np.argsort(-scores, kind='stable')
+    return scores[order], rows[order]
+
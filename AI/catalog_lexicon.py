@@ -0,0 +1,422 @@
+import os
+import re
+import math
+from collections import Counter
+
+try:
+    import pymysql
+    PYMYSQL_AVAILABLE = True
+except ImportError:
+    PYMYSQL_AVAILABLE = False
+
+# 与 Go 服务端 server/config/db.go 使用同一个库
+DEFAULT_DB_CONFIG = {
+    'host': '127.0.0.1',
+    'port': 3306,
+    'user': 'root',
+    'password': 'root',
+    'database': 'sys',
+    'charset': 'utf8mb4',
+}
+
+# 组成商品短语的词性：名词 / 专名 / 英文 / 名形词 / 名动词
+_PHRASE_POS = {'n', 'nz', 'nt', 'nr', 'ns', 'eng', 'an', 'vn'}
+_VALID_PHRASE_RE = re.compile(r'^[\u4e00-\u9fffa-zA-Z0-9]+$')
+
+
+class TokenTrie:
+    """
+    token id 前缀树，用于约束解码：从根节点出发，每一步只允许走到已有子节点的 token，
+    走到某个短语结尾（terminal）时额外允许 <EOS>，于是生成结果一定是词表中的某个完整短语。
+    节点用整数编号，children[node] 是 {token_id: 子节点}。
+    """
+
+    def __init__(self):
+        self.children = [{}]
+        self.terminal = [False]
+        self.num_phrases = 0
+        self._allowed_cache = {}
+
+    @classmethod
+    def from_phrases(cls, phrases, tokenizer):
+        """用分词器把短语转成 token id 序列后建树；含未登录字（<UNK>）的短语无法生成，直接跳过"""
+        trie = cls()
+        unk = tokenizer.special_tokens['<UNK>']
+        for phrase in phrases:
+            ids = tokenizer.encode(phrase, add_special=False, pad_to_max=False)
+            if ids and unk not in ids:
+                trie.insert(ids)
+        return trie
+
+    def insert(self, ids):
+        node = 0
+        for tid in ids:
+            nxt = self.children[node].get(tid)
+            if nxt is None:
+                nxt = len(self.children)
+                self.children[node][tid] = nxt
+                self.children.append({})
+                self.terminal.append(False)
+            node = nxt
+        if not self.terminal[node]:
+            self.terminal[node] = True
+            self.num_phrases += 1
+        self._allowed_cache.clear()
+
+    def step(self, node, token_id):
+        """沿 token_id 走一步，不在树上返回 None"""
+        return self.children[node].get(token_id)
+
+    def contains(self, ids):
+        """ids 是否恰好是某个完整短语"""
+        node = 0
+        for tid in ids:
+            node = self.children[node].get(tid)
+            if node is None:
+                return False
+        return self.terminal[node]
+
+    def allowed(self, node, eos_id, device):
+        """当前节点允许生成的 token id（LongTensor，按节点缓存）"""
+        key = (node, str(device))
+        ids = self._allowed_cache.get(key)
+        if ids is None:
+            import torch  # 延迟导入：后处理进程只用 AhoCorasick / load_lexicon，不需要加载 torch
+            allowed = list(self.children[node])
+            if self.terminal[node]:
+                allowed.append(eos_id)
+            ids = torch.as_tensor(allowed, dtype=torch.long, device=device)
+            self._allowed_cache[key] = ids
+        return ids
+
+    def __len__(self):
+        return self.num_phrases
+
+
+class AhoCorasick:
+    """
+    按字符构建的 Aho-Corasick 自动机：一次线性扫描找出文本中出现的所有词表短语，
+    用来替代 jieba 词性标注做关键词抽取（词表本身就定义了“什么是商品词”）。
+    匹配不区分大小写（逐字符转小写，位置不变），返回词表里的原始写法（如 iPhone、USB）。
+    """
+
+    def __init__(self, phrases=()):
+        self.goto = [{}]
+        self.fail = [0]
+        self.length = [0]       # 以该节点结尾的词表短语长度，0 表示不是短语结尾
+        self.dict_link = [0]    # 沿 fail 链最近的短语结尾节点（输出链），0 表示没有
+        self.num_phrases = 0
+        self.original = {}      # 转小写后的短语 -> 词表中的原始写法
+        for phrase in phrases:
+            self.add(phrase)
+        self.build()
+
+    @staticmethod
+    def _fold(text):
+        """逐字符转小写；个别字符小写后会变长（如 'İ'），保留原字符以免匹配位置错位"""
+        return ''.join(ch if len(ch.lower()) != 1 else ch.lower() for ch in text)
+
+    def add(self, phrase):
+        folded = self._fold(phrase)
+        self.original.setdefault(folded, phrase)
+        node = 0
+        for ch in folded:
+            nxt = self.goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[node][ch] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.length.append(0)
+                self.dict_link.append(0)
+            node = nxt
+        if phrase and not self.length[node]:
+            self.length[node] = len(phrase)
+            self.num_phrases += 1
+
+    def build(self):
+        """BFS 计算 fail 指针与输出链；add 之后需要重新 build"""
+        queue = list(self.goto[0].values())
+        for node in queue:
+            self.fail[node] = 0
+            self.dict_link[node] = 0
+        i = 0
+        while i < len(queue):
+            node = queue[i]
+            i += 1
+            for ch, child in self.goto[node].items():
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                target = self.goto[f].get(ch, 0)
+                self.fail[child] = target if target != child else 0
+                fc = self.fail[child]
+                self.dict_link[child] = fc if self.length[fc] else self.dict_link[fc]
+                queue.append(child)
+
+    def iter_matches(self, text):
+        """产出所有匹配 (start, end)，text[start:end] 不区分大小写时为词表短语"""
+        goto, fail, length, dict_link = self.goto, self.fail, self.length, self.dict_link
+        node = 0
+        for i, ch in enumerate(self._fold(text)):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            out = node if length[node] else dict_link[node]
+            while out:
+                yield i + 1 - length[out], i + 1
+                out = dict_link[out]
+
+    def find_terms(self, text):
+        """
+        最左最长、互不重叠的匹配，按出现顺序返回短语列表（如“蓝牙耳机”不再拆出“耳机”），
+        短语为词表中的原始写法。
+        """
+        folded = self._fold(text)
+        matches = sorted(self.iter_matches(text), key=lambda m: (m[0], -m[1]))
+        terms = []
+        pos = 0
+        for start, end in matches:
+            if start >= pos:
+                terms.append(self.original[folded[start:end]])
+                pos = end
+        return terms
+
+    def extract_keywords(self, text, top_k=20, stopwords=()):
+        """与 server._extract_keywords_cn 相同的输出约定：频次 + 长度排序后的前 top_k 个词"""
+        words = [w for w in self.find_terms(text) if w not in stopwords]
+        cnt = Counter(words)
+        scored = sorted(cnt.items(), key=lambda x: (x[1], len(x[0]) >= 2, len(x[0])), reverse=True)
+        return [w for w, _ in scored[:top_k]]
+
+    def __len__(self):
+        return self.num_phrases
+
+
+def fetch_catalog_texts(db_config=None):
+    """从商品库读取商品名、分类名与商品描述（需要 pymysql）"""
+    if not PYMYSQL_AVAILABLE:
+        raise ImportError("读取商品库需要先安装 pymysql")
+    conn = pymysql.connect(**dict(DEFAULT_DB_CONFIG, **(db_config or {})))
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT name, category, description FROM products")
+            products = cur.fetchall()
+            cur.execute("SELECT name FROM categories")
+            categories = cur.fetchall()
+    finally:
+        conn.close()
+
+    names = [row[0] for row in products if row[0]]
+    names += [row[1] for row in products if row[1]]
+    names += [row[0] for row in categories if row[0]]
+    descriptions = [row[2] for row in products if row[2]]
+    return names, descriptions
+
+
+def _iter_corpus_titles(corpus_path, max_lines):
+    """item_desc 语料（title\tdesc）中的标题"""
+    with open(corpus_path, 'r', encoding='utf-8') as f:
+        for i, line in enumerate(f):
+            if max_lines and i >= max_lines:
+                break
+            if '\t' in line:
+                title = line.split('\t', 1)[0].strip()
+                if title:
+                    yield title
+
+
+def _segment_phrases(text, min_len, max_len):
+    """jieba 切词后取名词性的词，以及相邻两个名词性词拼成的复合短语（如 蓝牙 + 耳机）"""
+    import jieba.posseg as pseg
+
+    words = [(w.strip(), f) for w, f in pseg.cut(text)]
+    out = []
+    prev = None
+    for w, f in words:
+        if f in _PHRASE_POS and _VALID_PHRASE_RE.match(w):
+            if min_len <= len(w) <= max_len:
+                out.append(w)
+            if prev is not None and min_len <= len(prev) + len(w) <= max_len:
+                out.append(prev + w)
+            prev = w
+        else:
+            prev = None
+    return out
+
+
+def build_lexicon(db_config=None, corpus_path=None, corpus_lines=200000, min_count=2, min_len=2, max_len=8,
+                  use_db=True):
+    """
+    挖掘商品短语词表，返回按频次降序的 [(phrase, count), ...]：
+    - 商品库中的商品名 / 分类名本身就是合法短语，不受 min_count 限制
+    - 商品名、描述与语料标题切词得到的名词及复合名词，出现次数 >= min_count 才保留
+    use_db=False 或未安装 pymysql 时只用语料。
+    """
+    counts = Counter()
+    always = set()
+
+    if use_db:
+        if PYMYSQL_AVAILABLE:
+            names, descriptions = fetch_catalog_texts(db_config)
+            for name in names:
+                name = name.strip()
+                if min_len <= len(name) <= max_len and _VALID_PHRASE_RE.match(name):
+                    always.add(name)
+            for text in names + descriptions:
+                counts.update(_segment_phrases(text, min_len, max_len))
+            print(f"商品库: {len(names)} 个名称 / 分类，{len(descriptions)} 条描述")
+        else:
+            print("警告: 未安装 pymysql，跳过商品库，只使用语料")
+
+    if corpus_path:
+        n = 0
+        for title in _iter_corpus_titles(corpus_path, corpus_lines):
+            counts.update(_segment_phrases(title, min_len, max_len))
+            n += 1
+        print(f"语料: {n} 个标题")
+
+    lexicon = {p: c for p, c in counts.items() if c >= min_count}
+    for p in always:
+        lexicon[p] = max(lexicon.get(p, 0), min_count)
+    return sorted(lexicon.items(), key=lambda x: (-x[1], x[0]))
+
+
+def save_lexicon(lexicon, path):
+    """每行 `phrase\tcount`"""
+    with open(path, 'w', encoding='utf-8') as f:
+        for phrase, count in lexicon:
+            f.write(f"{phrase}\t{count}\n")
+
+
+def load_lexicon(path):
+    """读取 save_lexicon 写出的词表，返回短语列表（保持频次顺序）"""
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"词表文件不存在: {path}")
+    phrases = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            phrase = line.rstrip('\n').split('\t', 1)[0].strip()
+            if phrase:
+                phrases.append(phrase)
+    return phrases
+
+
+def compare_constrained_decoding(model_path='item_desc_model_final.pth', lexicon_path='catalog_lexicon.txt',
+                                 queries=None, n=8, rounds=3, oversample=3, constrained_oversample=1.5, seed=0):
+    """
+    对比自由采样 + 关键词抽取与前缀树约束解码：
+    每次请求的生成次数、延迟、返回的建议条数，以及每次生成平均产出的有效建议数。
+    """
+    import time
+    import torch
+    import server
+    from item_desc_train import load_trained_model
+
+    queries = queries or ["智能手机", "连衣裙", "笔记本电脑", "运动鞋", "化妆品"]
+    mdl, tok, _ = load_trained_model(model_path)
+    trie = TokenTrie.from_phrases(load_lexicon(lexicon_path), tok)
+    print(f"前缀树: {len(trie):,} 个短语, {len(trie.children):,} 个节点")
+
+    modes = {
+        'free': dict(oversample=oversample, trie=None),
+        'constrained': dict(oversample=constrained_oversample, trie=trie),
+    }
+    # 预热：首次调用会加载 jieba 词典
+    server.generate_suggestions(queries[0], n=n, mdl=mdl, tok=tok)
+
+    report = {}
+    print(f"\n{'模式':<12}{'生成次数/请求':>14}{'延迟(ms)':>12}{'返回条数':>10}{'建议/生成':>10}")
+    for name, kwargs in modes.items():
+        torch.manual_seed(seed)
+        returned, elapsed = 0, 0.0
+        calls = len(queries) * rounds
+        for q in queries:
+            for _ in range(rounds):
+                start = time.perf_counter()
+                returned += len(server.generate_suggestions(q, n=n, mdl=mdl, tok=tok, **kwargs))
+                elapsed += time.perf_counter() - start
+        generations = max(1, math.ceil(n * kwargs['oversample']))
+        report[name] = {
+            'generations_per_request': generations,
+            'latency_ms': 1000 * elapsed / calls,
+            'suggestions_per_request': returned / calls,
+            'suggestions_per_generation': returned / calls / generations,
+        }
+        r = report[name]
+        print(f"{name:<12}{generations:>14}{r['latency_ms']:>12.1f}{r['suggestions_per_request']:>10.1f}"
+              f"{r['suggestions_per_generation']:>10.2f}")
+    return report
+
+
+def benchmark_keyword_extractors(corpus_path, lexicon_path='catalog_lexicon.txt', num_texts=2000, top_k=20):
+    """
+    用语料中的描述作为“生成文本”，对比 jieba 词性过滤与 Aho-Corasick 词表匹配：
+    吞吐（条/秒、字/秒）以及两者抽出的关键词集合的平均重合度（Jaccard）。
+    """
+    import time
+    import server
+
+    texts = []
+    with open(corpus_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if '\t' in line:
+                texts.append(line.rstrip('\n').split('\t', 1)[1])
+            if len(texts) >= num_texts:
+                break
+    chars = sum(len(t) for t in texts)
+    automaton = AhoCorasick(load_lexicon(lexicon_path))
+    print(f"自动机: {len(automaton):,} 个短语, {len(automaton.goto):,} 个状态; 测试文本 {len(texts)} 条 / {chars:,} 字")
+
+    server._extract_keywords_cn(texts[0])  # 预热：加载 jieba 词典
+    extractors = {
+        'jieba': lambda t: server._extract_keywords_cn(t, top_k=top_k),
+        'aho-corasick': lambda t: automaton.extract_keywords(t, top_k=top_k, stopwords=server.STOPWORDS),
+    }
+    outputs, report = {}, {}
+    for name, fn in extractors.items():
+        start = time.perf_counter()
+        outputs[name] = [fn(t) for t in texts]
+        elapsed = time.perf_counter() - start
+        report[name] = {'texts_per_sec': len(texts) / elapsed, 'chars_per_sec': chars / elapsed,
+                        'keywords_per_text': sum(map(len, outputs[name])) / len(texts)}
+        r = report[name]
+        print(f"{name:>14}: {r['texts_per_sec']:>10,.0f} 条/s, {r['chars_per_sec']:>12,.0f} 字/s, "
+              f"平均 {r['keywords_per_text']:.1f} 个关键词")
+
+    jaccard = []
+    for a, b in zip(outputs['jieba'], outputs['aho-corasick']):
+        a, b = set(a), set(b)
+        jaccard.append(len(a & b) / len(a | b) if a | b else 1.0)
+    report['jaccard'] = sum(jaccard) / len(jaccard)
+    report['speedup'] = report['aho-corasick']['texts_per_sec'] / report['jieba']['texts_per_sec']
+    print(f"加速比: {report['speedup']:.1f}x, 关键词集合平均 Jaccard: {report['jaccard']:.2f}")
+    for t, a, b in list(zip(texts, outputs['jieba'], outputs['aho-corasick']))[:3]:
+        print(f"  {t[:30]}\n    jieba: {a[:8]}\n    ac   : {b[:8]}")
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="从商品库与语料挖掘商品短语词表（用于约束解码）")
+    parser.add_argument('--corpus', help="item_desc 语料路径（title\\tdesc）")
+    parser.add_argument('--corpus-lines', type=int, default=200000)
+    parser.add_argument('--no-db', action='store_true', help="不读取商品库")
+    parser.add_argument('--min-count', type=int, default=2)
+    parser.add_argument('--out', default='catalog_lexicon.txt')
+    parser.add_argument('--compare', metavar='MODEL_PATH',
+                        help="不挖掘词表，用已有的 --out 词表对比约束解码与自由采样")
+    parser.add_argument('--bench-extractors', action='store_true',
+                        help="不挖掘词表，用已有的 --out 词表对比 jieba 与 Aho-Corasick 关键词抽取（需要 --corpus）")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare_constrained_decoding(args.compare, args.out)
+    elif args.bench_extractors:
+        benchmark_keyword_extractors(args.corpus, args.out)
+    else:
+        lexicon = build_lexicon(corpus_path=args.corpus, corpus_lines=args.corpus_lines,
+                                min_count=args.min_count, use_db=not args.no_db)
+        save_lexicon(lexicon, args.out)
+        print(f"词表已保存: {args.out}（{len(lexicon)} 个短语）")
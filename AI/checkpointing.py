@@ -0,0 +1,140 @@
+import os
+import re
+import random
+import threading
+import numpy as np
+import torch
+
+_CKPT_RE = re.compile(r'ckpt_step_(\d+)\.pth$')
+
+
+def _to_cpu_snapshot(obj, memo=None):
+    """
+    递归复制出一份 CPU 快照，之后训练继续更新参数也不会影响正在写盘的数据。
+    同一个张量（如共享权重的词嵌入 / 输出层）只复制一次，保持共享关系，写盘时也只存一份。
+    """
+    memo = {} if memo is None else memo
+    if isinstance(obj, torch.Tensor):
+        # state_dict() 对每个键都会 detach 出新的张量对象，按底层存储上的视图判断是否同一个张量
+        key = (obj.device, obj.untyped_storage().data_ptr(), obj.storage_offset(),
+               tuple(obj.shape), obj.stride(), obj.dtype)
+        if key not in memo:
+            memo[key] = obj.detach().to('cpu', copy=True)
+        return memo[key]
+    if isinstance(obj, np.ndarray):
+        return obj.copy()
+    if isinstance(obj, dict):
+        return {k: _to_cpu_snapshot(v, memo) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu_snapshot(v, memo) for v in obj)
+    return obj
+
+
+def capture_rng_state():
+    """收集 python / numpy / torch（含 CUDA）的随机数状态"""
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def restore_rng_state(state):
+    """恢复 capture_rng_state 保存的随机数状态"""
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def list_checkpoints(ckpt_dir):
+    """按步数升序返回目录中的 [(step, path), ...]"""
+    if not os.path.isdir(ckpt_dir):
+        return []
+    steps = []
+    for name in os.listdir(ckpt_dir):
+        m = _CKPT_RE.match(name)
+        if m:
+            steps.append((int(m.group(1)), os.path.join(ckpt_dir, name)))
+    return sorted(steps)
+
+
+def find_latest_checkpoint(ckpt_dir):
+    """返回目录中步数最大的检查点路径，没有则返回 None"""
+    ckpts = list_checkpoints(ckpt_dir)
+    return ckpts[-1][1] if ckpts else None
+
+
+def load_checkpoint(path, map_location='cpu'):
+    """加载检查点（包含分词器 / numpy 随机状态等非张量对象，需要关闭 weights_only）"""
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"检查点不存在: {path}")
+    return torch.load(path, map_location=map_location, weights_only=False)
+
+
+class AsyncCheckpointer:
+    """
+    异步检查点：
+    - save() 在调用线程里只做一次 CPU 快照，序列化和写盘交给后台线程
+    - 先写 .tmp 再 os.replace 原子重命名，进程中途被杀也不会留下半个检查点
+    - 同一时间最多一个写盘任务，控制快照占用的内存
+    - 只保留最近 keep_last 个 ckpt_step_*.pth
+    """
+
+    def __init__(self, ckpt_dir, keep_last=3):
+        self.ckpt_dir = ckpt_dir
+        self.keep_last = keep_last
+        self._thread = None
+        self._error = None
+        os.makedirs(ckpt_dir, exist_ok=True)
+
+    def save(self, state, step):
+        """异步保存第 step 步的训练状态，返回最终文件路径"""
+        snapshot = _to_cpu_snapshot(state)
+        # 等上一次写完再开始下一次（快照已经拍好，训练只在写盘积压时才会等待）
+        self.wait()
+        path = os.path.join(self.ckpt_dir, f'ckpt_step_{step}.pth')
+        self._thread = threading.Thread(target=self._write, args=(snapshot, path), daemon=True)
+        self._thread.start()
+        return path
+
+    def save_artifact(self, name, obj):
+        """同步保存只需写一次的对象（如分词器），已存在则跳过"""
+        path = os.path.join(self.ckpt_dir, name)
+        if not os.path.exists(path):
+            tmp = path + '.tmp'
+            torch.save(obj, tmp)
+            os.replace(tmp, path)
+        return path
+
+    def wait(self):
+        """等待后台写盘完成；后台线程出错时在这里抛出"""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError(f"检查点写入失败: {error}")
+
+    def _write(self, snapshot, path):
+        try:
+            tmp = path + '.tmp'
+            torch.save(snapshot, tmp)
+            os.replace(tmp, path)
+            self._prune()
+        except Exception as e:
+            self._error = e
+
+    def _prune(self):
+        """删除超出 keep_last 的旧检查点"""
+        if not self.keep_last or self.keep_last <= 0:
+            return
+        for _, path in list_checkpoints(self.ckpt_dir)[:-self.keep_last]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
@@ -4,6 +4,7 @@ import torch.optim as optim
 from torch.utils.data import Dataset, DataLoader
 from sentence_encoder import ContrastiveSentenceEncoder, create_semantic_search_model
 from nlp_transformer import TextTokenizer
+from train_profiler import StepProfiler
 import numpy as np
 from tqdm import tqdm
 import random
@@ -94,8 +95,12 @@ def text_augmentation(text):
     
     return ' '.join(words)
 
-def train_contrastive_model():
-    """训练对比学习模型"""
+def train_contrastive_model(profile_every=0, profile_trace_steps=None, profile_trace_path='contrastive_trace.json'):
+    """训练对比学习模型
+
+    profile_every: 每 N 个 batch 输出一次分阶段耗时 / 吞吐 / 峰值内存，0 表示关闭
+    profile_trace_steps: (start, end)，抓取这几个 batch 的 torch.profiler 轨迹写到 profile_trace_path
+    """
     print("开始训练对比学习句子编码器")
     print("=" * 50)
     
@@ -146,34 +151,45 @@ def train_contrastive_model():
     print(f"学习率: 1e-4")
     print()
     
+    # 分阶段计时 / 轨迹抓取（关闭时是空操作）
+    profiler = StepProfiler(device, report_every=profile_every, trace_steps=profile_trace_steps,
+                            trace_path=profile_trace_path, log=tqdm.write)
+    pad_id = tokenizer.special_tokens['<PAD>']
+
     # 训练循环
     num_epochs = 10
     model.train()
     
     for epoch in range(num_epochs):
         total_loss = 0
-        progress_bar = tqdm(dataloader, desc=f'Epoch {epoch+1}/{num_epochs}')
+        progress_bar = tqdm(profiler.wrap_loader(dataloader), desc=f'Epoch {epoch+1}/{num_epochs}',
+                            total=len(dataloader))
         
         for batch_idx, (orig_ids, aug_ids, labels) in enumerate(progress_bar):
             orig_ids, aug_ids = orig_ids.to(device), aug_ids.to(device)
             labels = labels.to(device)
             
             # 前向传播
-            orig_embeddings = model(orig_ids)
-            aug_embeddings = model(aug_ids)
-            
-            # 计算对比损失
-            target = torch.ones(orig_embeddings.size(0)).to(device)
-            loss = criterion(orig_embeddings, aug_embeddings, target)
+            with profiler.phase('forward'):
+                orig_embeddings = model(orig_ids)
+                aug_embeddings = model(aug_ids)
+                
+                # 计算对比损失
+                target = torch.ones(orig_embeddings.size(0)).to(device)
+                loss = criterion(orig_embeddings, aug_embeddings, target)
             
             # 反向传播
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
-            scheduler.step()
+            with profiler.phase('backward'):
+                optimizer.zero_grad()
+                loss.backward()
+            with profiler.phase('optimizer'):
+                optimizer.step()
+                scheduler.step()
             
             total_loss += loss.item()
             progress_bar.set_postfix({'loss': f'{loss.item():.4f}'})
+            n_tokens = int((orig_ids != pad_id).sum()) + int((aug_ids != pad_id).sum())
+            profiler.step_end(orig_ids.size(0), n_tokens)
         
         avg_loss = total_loss / len(dataloader)
         print(f'Epoch {epoch+1}/{num_epochs}, Average Loss: {avg_loss:.4f}')
@@ -191,6 +207,8 @@ def train_contrastive_model():
             torch.save(checkpoint, f'sentence_encoder_epoch_{epoch+1}.pth')
             print(f"检查点已保存: sentence_encoder_epoch_{epoch+1}.pth")
     
+    profiler.close()
+
     # 保存最终模型
     final_checkpoint = {
         'model_state_dict': model.state_dict(),
@@ -0,0 +1,238 @@
+import os
+import time
+import json
+import torch
+import torch.nn.functional as F
+import torch.optim as optim
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+from item_desc_train import (LightweightTransformer, ItemDescDataset, DEFAULT_TRAIN_CONFIG,
+                             load_trained_model, evaluate_perplexity, _build_eval_loader, _format_eval,
+                             _merge_config, _lm_forward, _autocast_context, _create_grad_scaler,
+                             _optimizer_step)
+
+
+# 蒸馏配置：学生模型结构 + 训练超参；max_seq_length 与词表沿用教师模型
+DEFAULT_DISTILL_CONFIG = {
+    'teacher_path': 'item_desc_model_final.pth',
+    'output_path': 'item_desc_model_student.pth',   # 与 item_desc_model_final.pth 格式相同，可直接给 server.py 用
+
+    # 数据（与训练时一致，验证集按同样的标题哈希划分）
+    'data_path': DEFAULT_TRAIN_CONFIG['data_path'],
+    'max_samples': 50000,
+    'pack': False,
+    'num_workers': 0,
+    'seed': 42,
+    'eval_fraction': 0.01,
+    'eval_max_samples': 2000,
+    'eval_batch_size': 64,
+
+    # 优化
+    'batch_size': 32,
+    'num_epochs': 3,
+    'lr': 5e-4,                 # 小模型可以用更大的学习率
+    'weight_decay': 0.01,
+    'max_grad_norm': 1.0,
+    'precision': 'fp32',
+
+    # 蒸馏损失：kd_alpha * KL(teacher || student) * T^2 + (1 - kd_alpha) * 真实标签交叉熵
+    'kd_temperature': 2.0,
+    'kd_alpha': 0.9,
+
+    # 学生模型结构
+    'model_config': {
+        'd_model': 128,
+        'nhead': 4,
+        'num_layers': 2,
+        'dim_feedforward': 256,
+        'dropout': 0.1,
+        'block_type': 'sdpa',
+    },
+}
+
+# 对比报告默认使用的查询
+DEFAULT_COMPARE_QUERIES = [
+    "智能手机", "连衣裙", "笔记本电脑", "运动鞋", "化妆品",
+    "蓝牙耳机", "羽绒服", "电饭煲", "口红", "双肩包",
+]
+
+
+def _distill_loss(student_logits, teacher_logits, labels, temperature, alpha):
+    """
+    只在有标签的位置（非 PAD、非样本边界）上计算：
+    软目标 KL 乘以 T^2 保持梯度量级与温度无关，再与真实标签的交叉熵加权。
+    返回 (总损失, kd 损失, ce 损失)
+    """
+    mask = labels != -100
+    s = student_logits[mask]
+    t = teacher_logits[mask]
+    kd = F.kl_div(
+        F.log_softmax(s / temperature, dim=-1),
+        F.log_softmax(t / temperature, dim=-1),
+        log_target=True,
+        reduction='batchmean'
+    ) * temperature ** 2
+    ce = F.cross_entropy(s, labels[mask])
+    return alpha * kd + (1 - alpha) * ce, kd, ce
+
+
+def distill_model(config=None):
+    """
+    从训练好的教师检查点蒸馏出更小的学生模型。
+    学生共享教师的分词器 / 词表 / max_seq_length，保存格式与 train_model 的最终模型一致。
+    """
+    cfg = _merge_config(config, defaults=DEFAULT_DISTILL_CONFIG)
+    torch.manual_seed(cfg['seed'])
+
+    print("开始蒸馏商品描述生成模型")
+    print("=" * 60)
+
+    teacher, tokenizer, device = load_trained_model(cfg['teacher_path'])
+    teacher.requires_grad_(False)
+    vocab_size = teacher.vocab_size
+    student_cfg = dict(cfg['model_config'], max_seq_length=teacher.max_seq_length)
+    print(f"使用设备: {device}")
+
+    dataset = ItemDescDataset(
+        cfg['data_path'],
+        tokenizer,
+        max_seq_length=student_cfg['max_seq_length'],
+        max_samples=cfg['max_samples'],
+        pack=cfg['pack'],
+        split='train',
+        eval_fraction=cfg['eval_fraction']
+    )
+    dataloader = DataLoader(dataset, batch_size=cfg['batch_size'], shuffle=True, num_workers=cfg['num_workers'])
+    eval_loader = None
+    if cfg['eval_fraction'] > 0:
+        eval_loader = _build_eval_loader(dict(cfg, model_config=student_cfg), tokenizer)
+
+    student = LightweightTransformer(vocab_size=vocab_size, **student_cfg).to(device)
+    optimizer = optim.AdamW(student.parameters(), lr=cfg['lr'], weight_decay=cfg['weight_decay'])
+    num_epochs = cfg['num_epochs']
+    scheduler = optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=len(dataloader) * num_epochs)
+    precision = cfg['precision']
+    scaler = _create_grad_scaler(device, precision)
+    temperature, alpha = cfg['kd_temperature'], cfg['kd_alpha']
+
+    teacher_params = sum(p.numel() for p in teacher.parameters())
+    student_params = sum(p.numel() for p in student.parameters())
+    print(f"教师参数量: {teacher_params:,}")
+    print(f"学生参数量: {student_params:,}（{student_params / teacher_params:.1%}）")
+    print(f"蒸馏温度: {temperature}, kd_alpha: {alpha}")
+    if eval_loader is not None:
+        print("[eval] 教师: " + _format_eval(evaluate_perplexity(teacher, eval_loader, device, precision)))
+    print()
+
+    student.train()
+    teacher.eval()
+    optimizer.zero_grad(set_to_none=True)
+    result = None
+    for epoch in range(num_epochs):
+        total_loss = total_kd = total_ce = 0.0
+        progress_bar = tqdm(dataloader, desc=f'Epoch {epoch+1}/{num_epochs}')
+        for batch in progress_bar:
+            with _autocast_context(device, precision):
+                student_logits, labels, _ = _lm_forward(student, batch, device)
+                with torch.no_grad():
+                    teacher_logits, _, _ = _lm_forward(teacher, batch, device)
+
+            # 损失在 fp32 下计算
+            loss, kd, ce = _distill_loss(student_logits.float(), teacher_logits.float(), labels,
+                                         temperature, alpha)
+            scaler.scale(loss).backward()
+            _optimizer_step(student, optimizer, scheduler, scaler, cfg['max_grad_norm'])
+
+            total_loss += loss.item()
+            total_kd += kd.item()
+            total_ce += ce.item()
+            progress_bar.set_postfix({'loss': f'{loss.item():.4f}', 'kd': f'{kd.item():.4f}', 'ce': f'{ce.item():.4f}'})
+
+        n = max(len(dataloader), 1)
+        print(f'Epoch {epoch+1}/{num_epochs}, Loss: {total_loss / n:.4f}, KD: {total_kd / n:.4f}, CE: {total_ce / n:.4f}')
+        if eval_loader is not None:
+            result = evaluate_perplexity(student, eval_loader, device, precision)
+            print("[eval] 学生: " + _format_eval(result))
+
+        # 每个 epoch 覆盖保存一次，格式与 item_desc_model_final.pth 相同
+        checkpoint = {
+            'model_state_dict': student.state_dict(),
+            'vocab_size': vocab_size,
+            'tokenizer': tokenizer,
+            'model_config': dict(student_cfg),
+            'distilled_from': cfg['teacher_path'],
+            'eval': result,
+        }
+        torch.save(checkpoint, cfg['output_path'])
+        print(f"学生模型已保存: {cfg['output_path']}")
+
+    return student, tokenizer
+
+
+def compare_with_teacher(teacher_path='item_desc_model_final.pth', student_path='item_desc_model_student.pth',
+                         queries=None, n=8, rounds=3, seed=0):
+    """
+    对比报告：用 server.generate_suggestions 分别跑教师 / 学生，
+    统计每次联想请求的平均 / p95 延迟，以及学生结果与教师结果的重合度（|S∩T| / |T|）。
+    两个模型在同一查询、同一轮次使用相同的随机种子。
+    """
+    from server import generate_suggestions
+
+    queries = queries or DEFAULT_COMPARE_QUERIES
+    models = {
+        'teacher': load_trained_model(teacher_path),
+        'student': load_trained_model(student_path),
+    }
+    latencies = {name: [] for name in models}
+    overlaps = []
+    # 预热：首次调用会加载 jieba 词典，不计入延迟
+    for mdl, tok, _ in models.values():
+        generate_suggestions(queries[0], n=n, mdl=mdl, tok=tok)
+
+    for q in queries:
+        for r in range(rounds):
+            outputs = {}
+            for name, (mdl, tok, _) in models.items():
+                torch.manual_seed(seed + r)
+                start = time.perf_counter()
+                outputs[name] = generate_suggestions(q, n=n, mdl=mdl, tok=tok)
+                latencies[name].append(time.perf_counter() - start)
+            ref = set(outputs['teacher'])
+            overlaps.append(len(ref & set(outputs['student'])) / max(len(ref), 1))
+
+    def summary(values):
+        values = sorted(values)
+        return 1000 * sum(values) / len(values), 1000 * values[int(0.95 * (len(values) - 1))]
+
+    report = {'queries': len(queries), 'rounds': rounds, 'overlap': sum(overlaps) / len(overlaps)}
+    print("\n蒸馏对比报告")
+    print("-" * 60)
+    print(f"{'模型':<10}{'参数量':>14}{'平均延迟(ms)':>16}{'p95(ms)':>12}")
+    for name, (mdl, _, _) in models.items():
+        mean_ms, p95_ms = summary(latencies[name])
+        params = sum(p.numel() for p in mdl.parameters())
+        report[name] = {'params': params, 'mean_ms': mean_ms, 'p95_ms': p95_ms}
+        print(f"{name:<10}{params:>14,}{mean_ms:>16.1f}{p95_ms:>12.1f}")
+    print(f"加速比: {report['teacher']['mean_ms'] / report['student']['mean_ms']:.2f}x")
+    print(f"联想结果重合度（学生 ∩ 教师 / 教师）: {report['overlap']:.1%}")
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="把商品描述生成模型蒸馏成更小的学生模型")
+    parser.add_argument('--config', help="JSON 蒸馏配置文件，覆盖 DEFAULT_DISTILL_CONFIG")
+    parser.add_argument('--report-only', action='store_true', help="不训练，只对比已有的教师 / 学生模型")
+    args = parser.parse_args()
+
+    config = {}
+    if args.config:
+        with open(args.config, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+    cfg = _merge_config(config, defaults=DEFAULT_DISTILL_CONFIG)
+
+    if not args.report_only:
+        distill_model(config)
+    if os.path.exists(cfg['output_path']):
+        compare_with_teacher(cfg['teacher_path'], cfg['output_path'])
@@ -0,0 +1,33 @@
+"""
+只做推理的精简包：模型、分词器、采样与联想后处理，不依赖训练代码（优化器、DataLoader、tqdm 等）。
+
+    inference.tokenizer    TextTokenizer（不依赖 torch）
+    inference.layers       SDPA 解码层与旧结构权重转换
+    inference.sampling     生成时的采样辅助函数
+    inference.model        LightweightTransformer 与检查点加载
+    inference.postprocess  关键词抽取 / 清洗 / 后处理进程池（jieba 按需加载，不依赖 torch）
+
+子模块按需导入：`from inference import TextTokenizer` 不会拉起 torch，
+后处理子进程只导入 inference.postprocess。
+"""
+import importlib
+
+_EXPORTS = {
+    'TextTokenizer': 'tokenizer',
+    'LightweightTransformer': 'model',
+    'build_model_from_checkpoint': 'model',
+    'load_trained_model': 'model',
+    'convert_block_state_dict': 'layers',
+    'build_transformer_stack': 'layers',
+    'PostprocessPool': 'postprocess',
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    if name in _EXPORTS:
+        value = getattr(importlib.import_module(f'.{_EXPORTS[name]}', __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
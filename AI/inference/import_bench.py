@@ -0,0 +1,93 @@
+import os
+import sys
+import json
+import subprocess
+
+# 每个入口导入后不应出现的模块：出现即说明训练代码 / jieba 又被提前拉进了推理路径
+# （tqdm 会被 torch.hub 间接导入，所以不在列表里）
+FORBIDDEN_MODULES = {
+    'server': ['item_desc_train', 'train_profiler', 'jieba'],
+    'inference.model': ['item_desc_train', 'train_profiler', 'jieba', 'fastapi'],
+    'inference.postprocess': ['torch', 'jieba'],
+    'inference.tokenizer': ['torch'],
+}
+
+# 对比用：训练脚本的导入开销（旧的 server 从这里导入模型）
+DEFAULT_TARGETS = ['item_desc_train', 'server', 'inference.model', 'inference.postprocess', 'inference.tokenizer']
+
+_PROBE = r'''
+import sys, time, json
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+try:
+    import resource
+    rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+except ImportError:
+    rss_mb = 0.0
+print(json.dumps({{'seconds': seconds, 'rss_mb': rss_mb, 'modules': sorted(sys.modules)}}))
+'''
+
+
+def measure_import(module, repeats=3, cwd=None):
+    """
+    在全新的解释器里导入 module，返回 {seconds（中位数）, rss_mb（峰值 RSS）, num_modules, modules}。
+    每次都起新进程，避免已导入模块的缓存影响结果。
+    """
+    cwd = cwd or os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    runs = []
+    for _ in range(repeats):
+        proc = subprocess.run([sys.executable, '-c', _PROBE.format(module=module)], cwd=cwd,
+                              capture_output=True, text=True, check=True)
+        runs.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+    runs.sort(key=lambda r: r['seconds'])
+    median = runs[len(runs) // 2]
+    return {'seconds': median['seconds'], 'rss_mb': median['rss_mb'],
+            'num_modules': len(median['modules']), 'modules': median['modules']}
+
+
+def check_forbidden(module, modules):
+    """返回 module 导入后出现的禁止模块（含其子模块）"""
+    loaded = set(modules)
+    bad = []
+    for name in FORBIDDEN_MODULES.get(module, []):
+        if name in loaded or any(m.startswith(name + '.') for m in loaded):
+            bad.append(name)
+    return bad
+
+
+def benchmark_imports(targets=None, repeats=3, max_server_seconds=None):
+    """
+    打印各入口的导入耗时 / 峰值 RSS / 模块数，并检查禁止模块。
+    max_server_seconds 给定时 server 导入超过该时间也算回归。返回 (report, violations)。
+    """
+    targets = targets or DEFAULT_TARGETS
+    report, violations = {}, []
+    print(f"{'模块':<24}{'导入耗时(s)':>14}{'峰值RSS(MB)':>14}{'模块数':>10}")
+    for module in targets:
+        r = measure_import(module, repeats=repeats)
+        report[module] = r
+        print(f"{module:<24}{r['seconds']:>14.2f}{r['rss_mb']:>14.0f}{r['num_modules']:>10}")
+        for name in check_forbidden(module, r['modules']):
+            violations.append(f"{module} 导入了 {name}")
+    if max_server_seconds is not None and 'server' in report and report['server']['seconds'] > max_server_seconds:
+        violations.append(f"server 导入耗时 {report['server']['seconds']:.2f}s 超过上限 {max_server_seconds}s")
+    for v in violations:
+        print(f"[回归] {v}")
+    if not violations:
+        print("未发现导入回归")
+    return report, violations
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="推理路径导入耗时 / 内存基准，发现回归时以非零状态退出")
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--max-server-seconds', type=float, default=None, help="server 导入耗时上限")
+    parser.add_argument('modules', nargs='*', help="要测的模块，默认 DEFAULT_TARGETS")
+    args = parser.parse_args()
+
+    _, violations = benchmark_imports(args.modules or None, repeats=args.repeats,
+                                      max_server_seconds=args.max_server_seconds)
+    sys.exit(1 if violations else 0)
@@ -0,0 +1,145 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class SDPASelfAttention(nn.Module):
+    """基于 F.scaled_dot_product_attention 的多头自注意力，可走融合 / 因果感知内核，并支持 KV cache"""
+    def __init__(self, d_model, nhead, dropout=0.1):
+        super(SDPASelfAttention, self).__init__()
+        self.nhead = nhead
+        self.head_dim = d_model // nhead
+        self.dropout = dropout
+        # q/k/v 合并成一次矩阵乘，布局与 nn.MultiheadAttention.in_proj_weight 相同
+        self.qkv_proj = nn.Linear(d_model, 3 * d_model)
+        self.out_proj = nn.Linear(d_model, d_model)
+
+    def forward(self, x, attn_mask=None, is_causal=False, past_kv=None):
+        """
+        attn_mask: SDPA 约定的 bool mask（True=允许注意），可广播到 (B, H, L, S)
+        past_kv  : 之前步的 (k, v)，形状 (B, H, S_past, head_dim)
+        返回 (输出, 本层新的 (k, v))
+        """
+        B, L, D = x.shape
+        q, k, v = self.qkv_proj(x).split(D, dim=-1)
+        q = q.view(B, L, self.nhead, self.head_dim).transpose(1, 2)
+        k = k.view(B, L, self.nhead, self.head_dim).transpose(1, 2)
+        v = v.view(B, L, self.nhead, self.head_dim).transpose(1, 2)
+        if past_kv is not None:
+            k = torch.cat([past_kv[0], k], dim=2)
+            v = torch.cat([past_kv[1], v], dim=2)
+
+        out = F.scaled_dot_product_attention(
+            q, k, v,
+            attn_mask=attn_mask,
+            dropout_p=self.dropout if self.training else 0.0,
+            is_causal=is_causal and attn_mask is None
+        )
+        out = out.transpose(1, 2).reshape(B, L, D)
+        return self.out_proj(out), (k, v)
+
+
+class SDPATransformerLayer(nn.Module):
+    """Post-norm + ReLU 的 Transformer 层，结构与 nn.TransformerEncoderLayer 默认配置一致，便于权重转换"""
+    def __init__(self, d_model, nhead, dim_feedforward=2048, dropout=0.1):
+        super(SDPATransformerLayer, self).__init__()
+        self.self_attn = SDPASelfAttention(d_model, nhead, dropout)
+        self.linear1 = nn.Linear(d_model, dim_feedforward)
+        self.linear2 = nn.Linear(dim_feedforward, d_model)
+        self.norm1 = nn.LayerNorm(d_model)
+        self.norm2 = nn.LayerNorm(d_model)
+        self.dropout = nn.Dropout(dropout)
+        self.dropout1 = nn.Dropout(dropout)
+        self.dropout2 = nn.Dropout(dropout)
+
+    def forward(self, x, attn_mask=None, is_causal=False, past_kv=None):
+        attn_out, kv = self.self_attn(x, attn_mask=attn_mask, is_causal=is_causal, past_kv=past_kv)
+        x = self.norm1(x + self.dropout1(attn_out))
+        x = self.norm2(x + self.dropout2(self.linear2(self.dropout(F.relu(self.linear1(x))))))
+        return x, kv
+
+
+class SDPATransformer(nn.Module):
+    """
+    SDPA 层堆叠，用来替代 nn.TransformerEncoder：
+    - 纯因果场景直接传 is_causal=True，不再每个 batch / 每个解码步重建上三角 mask
+    - mask 参数沿用 nn.Transformer 的约定（True=屏蔽），内部转换成 SDPA 的约定
+    - use_cache=True 时返回每层的 (k, v)，增量解码只需计算新 token
+    """
+    def __init__(self, d_model, nhead, num_layers, dim_feedforward=2048, dropout=0.1):
+        super(SDPATransformer, self).__init__()
+        self.nhead = nhead
+        self.layers = nn.ModuleList([
+            SDPATransformerLayer(d_model, nhead, dim_feedforward, dropout) for _ in range(num_layers)
+        ])
+
+    def _build_attn_mask(self, x, mask, src_key_padding_mask, is_causal, past_len):
+        """把 nn.Transformer 风格的 mask 合并成一个 SDPA bool mask；纯因果时返回 None 走 is_causal 快速路径"""
+        B, L, _ = x.shape
+        S = past_len + L
+        allowed = None
+        if mask is not None:
+            # (L, S) 或 (B*H, L, S) / (B, L, S)
+            allowed = ~mask if mask.dim() == 2 else (~mask).view(B, -1, L, S)
+        elif is_causal and (src_key_padding_mask is not None or (past_len > 0 and L > 1)):
+            # 带缓存时第 i 个新 token 能看到全部历史 + 自己及之前的新 token
+            allowed = torch.ones(L, S, device=x.device, dtype=torch.bool).tril(diagonal=past_len)
+        if src_key_padding_mask is not None:
+            keep = (~src_key_padding_mask).view(B, 1, 1, S)
+            allowed = keep if allowed is None else allowed & keep
+        return allowed
+
+    def forward(self, x, mask=None, src_key_padding_mask=None, is_causal=False,
+                past_key_values=None, use_cache=False):
+        past_len = past_key_values[0][0].size(2) if past_key_values else 0
+        attn_mask = self._build_attn_mask(x, mask, src_key_padding_mask, is_causal, past_len)
+        # 单个新 token 带缓存时可以看到全部历史，无需因果 mask
+        causal = is_causal and attn_mask is None and not (past_len > 0 and x.size(1) == 1)
+
+        new_cache = []
+        for i, layer in enumerate(self.layers):
+            past_kv = past_key_values[i] if past_key_values else None
+            x, kv = layer(x, attn_mask=attn_mask, is_causal=causal, past_kv=past_kv)
+            if use_cache:
+                new_cache.append(kv)
+        return (x, new_cache) if use_cache else x
+
+
+def convert_block_state_dict(state_dict, src='encoder', dst='sdpa'):
+    """
+    nn.TransformerEncoder <-> SDPATransformer 的权重转换。
+    两者逐层参数一一对应，只有注意力输入投影的参数名不同：
+      self_attn.in_proj_weight / in_proj_bias  <->  self_attn.qkv_proj.weight / bias
+    """
+    if src == dst:
+        return dict(state_dict)
+    names = {
+        'encoder': ('self_attn.in_proj_weight', 'self_attn.in_proj_bias'),
+        'sdpa': ('self_attn.qkv_proj.weight', 'self_attn.qkv_proj.bias'),
+    }
+    if src not in names or dst not in names:
+        raise ValueError(f"不支持的 block_type 转换: {src} -> {dst}")
+    converted = {}
+    for key, value in state_dict.items():
+        for old, new in zip(names[src], names[dst]):
+            if key.endswith(old):
+                key = key[:-len(old)] + new
+                break
+        converted[key] = value
+    return converted
+
+
+def build_transformer_stack(block_type, d_model, nhead, num_layers, dim_feedforward, dropout):
+    """按 block_type 构建 Transformer 层堆叠：'sdpa' -> SDPATransformer，'encoder' -> nn.TransformerEncoder"""
+    if block_type == 'sdpa':
+        return SDPATransformer(d_model, nhead, num_layers, dim_feedforward, dropout)
+    if block_type == 'encoder':
+        encoder_layer = nn.TransformerEncoderLayer(
+            d_model=d_model,
+            nhead=nhead,
+            dim_feedforward=dim_feedforward,
+            dropout=dropout,
+            batch_first=True
+        )
+        return nn.TransformerEncoder(encoder_layer, num_layers)
+    raise ValueError(f"不支持的 block_type: {block_type}")
@@ -0,0 +1,371 @@
+import os
+import math
+import torch
+import torch.nn as nn
+from checkpointing import load_checkpoint
+from .layers import build_transformer_stack, convert_block_state_dict
+from .sampling import _to_tensor_1d, _block_repeated_bigrams
+
+
+class LightweightTransformer(nn.Module):
+    """轻量级Transformer语言模型，适合4GB显存
+
+    block_type: 'sdpa'（默认，融合注意力 + KV cache）| 'encoder'（旧的 nn.TransformerEncoder，用于兼容与对比）
+
+    紧凑结构（词表矩阵占了大部分参数，CPU 解码时读它的带宽是瓶颈）：
+    - embedding_rank=r：词嵌入分解为 (vocab, r) 查表 + r->d_model 投影，输出头对称地先投影到 r 维
+    - tie_embeddings=True：输出层与词嵌入共享同一个 (vocab, r 或 d_model) 矩阵
+    两者都关闭时与原结构及其检查点完全一致。
+    """
+    
+    def __init__(self, vocab_size, d_model=256, nhead=8, 
+                 num_layers=4, dim_feedforward=512, dropout=0.1, 
+                 max_seq_length=128, block_type='sdpa', tie_embeddings=False, embedding_rank=None):
+        super(LightweightTransformer, self).__init__()
+        
+        self.d_model = d_model
+        self.nhead = nhead
+        self.vocab_size = vocab_size
+        self.max_seq_length = max_seq_length
+        self.block_type = block_type
+        self.tie_embeddings = tie_embeddings
+        self.embedding_rank = embedding_rank
+        embed_dim = embedding_rank or d_model
+        
+        # 词嵌入（低秩分解时再投影到 d_model）
+        self.embedding = nn.Embedding(vocab_size, embed_dim)
+        if embedding_rank:
+            self.embed_proj = nn.Linear(embedding_rank, d_model, bias=False)
+        
+        # 位置编码
+        self.pos_encoder = nn.Embedding(max_seq_length, d_model)
+        
+        # Transformer层
+        self.transformer = build_transformer_stack(block_type, d_model, nhead, num_layers,
+                                                   dim_feedforward, dropout)
+        if block_type == 'encoder':
+            # 旧结构需要显式的因果 mask：只建一次，按长度切片复用（不进 state_dict）
+            causal_mask = torch.triu(torch.ones(max_seq_length, max_seq_length, dtype=torch.bool), diagonal=1)
+            self.register_buffer('causal_mask', causal_mask, persistent=False)
+        
+        # 输出层
+        if embedding_rank:
+            self.output_proj = nn.Linear(d_model, embedding_rank, bias=False)
+        self.output_layer = nn.Linear(embed_dim, vocab_size)
+        self.dropout = nn.Dropout(dropout)
+        
+        # 初始化权重
+        self._init_weights()
+        if tie_embeddings:
+            # 共享参数：state_dict 里两个键指向同一个张量，torch.save 只存一份
+            self.output_layer.weight = self.embedding.weight
+    
+    def _init_weights(self):
+        """初始化权重"""
+        initrange = 0.1
+        self.embedding.weight.data.uniform_(-initrange, initrange)
+        self.output_layer.bias.data.zero_()
+        self.output_layer.weight.data.uniform_(-initrange, initrange)
+    
+    def forward(self, src, src_mask=None, src_key_padding_mask=None, position_ids=None,
+                is_causal=False, past_key_values=None, use_cache=False):
+        """前向传播
+
+        src_mask       : 显式 mask（True=屏蔽），如序列打包的块对角 mask；纯因果时传 is_causal=True 即可
+        position_ids   : 可选 (B, L)，序列打包时每条样本的位置从 0 重新计数；默认接在缓存之后递增
+        past_key_values: 增量解码时上一步返回的缓存（仅 sdpa）
+        use_cache      : 为 True 时返回 (logits, 新缓存)
+        """
+        batch_size, seq_len = src.size()
+        past_len = past_key_values[0][0].size(2) if past_key_values else 0
+        
+        # 词嵌入
+        src_emb = self.embedding(src)
+        if self.embedding_rank:
+            src_emb = self.embed_proj(src_emb)
+        src_emb = src_emb * math.sqrt(self.d_model)
+        
+        # 位置编码
+        if position_ids is None:
+            position_ids = torch.arange(past_len, past_len + seq_len, device=src.device)
+            position_ids = position_ids.unsqueeze(0).expand(batch_size, seq_len)
+        pos_emb = self.pos_encoder(position_ids)
+        src_emb = src_emb + pos_emb
+        
+        # Transformer编码
+        if self.block_type == 'sdpa':
+            output = self.transformer(src_emb, mask=src_mask, src_key_padding_mask=src_key_padding_mask,
+                                      is_causal=is_causal, past_key_values=past_key_values,
+                                      use_cache=use_cache)
+            if use_cache:
+                output, cache = output
+        else:
+            if use_cache or past_key_values:
+                raise ValueError("encoder 结构不支持 KV cache，请使用 block_type='sdpa'")
+            if is_causal and src_mask is None:
+                src_mask = self.causal_mask[:seq_len, :seq_len]
+            output = self.transformer(src_emb, mask=src_mask, src_key_padding_mask=src_key_padding_mask)
+        
+        # 输出预测
+        if self.embedding_rank:
+            output = self.output_proj(output)
+        output = self.output_layer(output)
+        return (output, cache) if use_cache else output
+    
+    def _prompt_ids(self, input_text, tokenizer):
+        """[SOS] query [SEP]：与训练样本 [SOS] title [SEP] desc [EOS] 的前半段对齐"""
+        # 兼容你的 encode：若没有 add_special/pad_to_max 参数则走老签名
+        try:
+            ids = tokenizer.encode(input_text, max_length=self.max_seq_length - 2,
+                                add_special=False, pad_to_max=False)
+        except TypeError:
+            ids = tokenizer.encode(input_text, max_length=self.max_seq_length - 2)
+        if isinstance(ids, list):
+            # 防止 encode 里已经 pad/加特殊符，这里只保留长度限制
+            ids = ids[: self.max_seq_length - 2]
+
+        sos = tokenizer.special_tokens['<SOS>']
+        eos = tokenizer.special_tokens['<EOS>']
+        sep = tokenizer.special_tokens.get('<SEP>', eos)
+        return [sos] + list(ids) + [sep]
+
+    @staticmethod
+    def _ban_tokens(tokenizer, device):
+        """禁止采样的 token（除了 <EOS>）"""
+        eos = tokenizer.special_tokens['<EOS>']
+        ban_tokens = []
+        for k in ['<PAD>', '<SOS>', '<SEP>', '<UNK>']:
+            tid = tokenizer.special_tokens.get(k, None)
+            if tid is not None and tid != eos:
+                ban_tokens.append(tid)
+        return torch.as_tensor(ban_tokens, dtype=torch.long, device=device) if ban_tokens else None
+
+    def _filter_logits(self, logits, prefix_ids, ban_tokens, temperature, top_k, allowed=None):
+        """
+        采样前的 logits 处理：温度 -> 屏蔽特殊 token -> 2-gram 阻断 -> [前缀树约束] -> top-k。
+        只依赖前缀，投机解码中草稿模型与目标模型对同一前缀使用同一套处理。
+        allowed: 约束解码时当前前缀树节点允许的 token id
+        """
+        logits = logits / max(temperature, 1e-5)
+
+        # 屏蔽特殊 token
+        if ban_tokens is not None and ban_tokens.numel() > 0:
+            logits.index_fill_(0, ban_tokens, float('-inf'))
+        unblocked = logits.clone() if allowed is not None else None
+
+        # 2-gram 阻断（传进去的是 tensor 切片；函数内部也能处理 list）
+        logits = _block_repeated_bigrams(prefix_ids[-self.max_seq_length:], logits)
+
+        if allowed is not None:
+            # 只保留前缀树上的后继；若全被 2-gram 阻断（如“红红”类短语），放开阻断保证短语能走完
+            constrained = torch.full_like(logits, float('-inf'))
+            constrained[allowed] = logits[allowed]
+            if torch.isinf(constrained).all():
+                constrained[allowed] = unblocked[allowed]
+            logits = constrained
+
+        # top-k
+        if top_k and top_k > 0:
+            k = min(top_k, logits.size(0))
+            vals, idx = torch.topk(logits, k)
+            filtered = torch.full_like(logits, float('-inf'))
+            filtered[idx] = vals
+            logits = filtered
+        return logits
+
+    def generate(self, input_text, tokenizer, max_length=50, temperature=1.0, top_k=50,
+                 draft_model=None, num_draft_tokens=4, stats=None, trie=None):
+        """
+        自回归生成（联想友好版）：
+        - 滑动窗口避免位置越界
+        - 屏蔽特殊 token（仅允许 <EOS> 用于结束）
+        - 2-gram 重复阻断
+        传入 draft_model（同一分词器训练的小模型）时走投机解码，输出分布与不用草稿模型时相同，
+        stats 字典会累计 drafted / accepted / target_calls / new_tokens。
+        传入 trie（catalog_lexicon.TokenTrie）时做约束解码：只沿前缀树采样，返回值只含生成的短语（不含输入）。
+        """
+        if draft_model is not None and trie is not None:
+            raise ValueError("约束解码暂不支持与投机解码同时使用")
+        if draft_model is not None:
+            return self._speculative_generate(input_text, tokenizer, draft_model, max_length,
+                                              temperature, top_k, num_draft_tokens, stats)
+        self.eval()
+        device = next(self.parameters()).device
+
+        eos = tokenizer.special_tokens['<EOS>']
+        seq = self._prompt_ids(input_text, tokenizer)
+        generated = torch.as_tensor([seq], dtype=torch.long, device=device)  # (1, L)
+        ban_tokens = self._ban_tokens(tokenizer, device)
+
+        new_tokens = 0
+        past = None
+        use_cache = self.block_type == 'sdpa'
+        node = 0  # 约束解码时当前所在的前缀树节点
+        with torch.no_grad():
+            while new_tokens < max_length:
+                # 保持右侧窗口 = max_seq_length；窗口滑动后所有位置都变了，缓存失效
+                if generated.size(1) > self.max_seq_length:
+                    generated = generated[:, -self.max_seq_length:]
+                    past = None
+
+                if use_cache:
+                    # 有缓存时只需喂入最新的 token
+                    step_input = generated if past is None else generated[:, -1:]
+                    out, past = self(step_input, is_causal=True, past_key_values=past, use_cache=True)
+                else:
+                    out = self(generated, is_causal=True)
+                allowed = trie.allowed(node, eos, device) if trie is not None else None
+                logits = self._filter_logits(out[0, -1, :], generated[0], ban_tokens, temperature, top_k, allowed)
+
+                probs = torch.softmax(logits, dim=-1)
+                next_token = torch.multinomial(probs, num_samples=1)  # (1,)
+
+                generated = torch.cat([generated, next_token.view(1, 1)], dim=1)
+                new_tokens += 1
+
+                if int(next_token.item()) == eos:
+                    break
+                if trie is not None:
+                    node = trie.step(node, int(next_token.item()))
+
+        if stats is not None:
+            stats['new_tokens'] = stats.get('new_tokens', 0) + new_tokens
+            stats['target_calls'] = stats.get('target_calls', 0) + new_tokens
+
+        if trie is not None:
+            # 约束解码只返回生成的短语本身（不含输入）
+            return tokenizer.decode(generated[0, -new_tokens:].tolist()) if new_tokens else ''
+        # 你的 decode 已会过滤特殊符并在 <EOS> 截断
+        return tokenizer.decode(generated[0].tolist())
+
+    def _speculative_generate(self, input_text, tokenizer, draft_model, max_length, temperature, top_k,
+                              num_draft_tokens, stats):
+        """
+        投机解码：草稿模型逐个提议 num_draft_tokens 个 token，目标模型（self）一次前向给出这些位置的分布，
+        逐个以 min(1, p/q) 接受；第一个被拒的位置从 max(0, p - q) 归一化后重采样，全部接受时再从 p 多采一个。
+        两个模型都用 KV cache，被拒之后的缓存直接截断回退。要求两个模型都是 sdpa 结构。
+        """
+        if self.block_type != 'sdpa' or draft_model.block_type != 'sdpa':
+            raise ValueError("投机解码需要目标模型与草稿模型都是 block_type='sdpa'（依赖 KV cache）")
+        self.eval()
+        draft_model.eval()
+        device = next(self.parameters()).device
+
+        eos = tokenizer.special_tokens['<EOS>']
+        seq = self._prompt_ids(input_text, tokenizer)
+        ban_tokens = self._ban_tokens(tokenizer, device)
+        window = min(self.max_seq_length, draft_model.max_seq_length)
+
+        def dist(logits, prefix):
+            return torch.softmax(self._filter_logits(logits, prefix, ban_tokens, temperature, top_k), dim=-1)
+
+        def truncate(past, length):
+            return None if past is None else [(k[:, :, :length], v[:, :, :length]) for k, v in past]
+
+        target_past, draft_past = None, None
+        target_len = draft_len = 0   # 各自缓存覆盖的 seq 前缀长度
+        new_tokens = drafted = accepted = target_calls = 0
+        with torch.no_grad():
+            while new_tokens < max_length and seq[-1] != eos:
+                # 草稿 + 目标多采的一个 token 不超过剩余长度
+                k = min(num_draft_tokens, max_length - new_tokens - 1)
+                # 位置不能越界：窗口滑动后位置全变，两边缓存都失效
+                if len(seq) + k > window:
+                    seq = seq[-(window - k):]
+                    target_past, draft_past = None, None
+                    target_len = draft_len = 0
+
+                # 1) 草稿模型逐个提议 k 个 token，记录其采样分布 q
+                drafts, q_dists = [], []
+                for _ in range(k):
+                    ctx = seq + drafts
+                    step_input = torch.as_tensor([ctx[draft_len:]], dtype=torch.long, device=device)
+                    out, draft_past = draft_model(step_input, is_causal=True, past_key_values=draft_past,
+                                                  use_cache=True)
+                    draft_len = len(ctx)
+                    q = dist(out[0, -1, :], ctx)
+                    token = int(torch.multinomial(q, num_samples=1))
+                    drafts.append(token)
+                    q_dists.append(q)
+                    if token == eos:
+                        break
+
+                # 2) 目标模型一次前向，得到每个草稿位置以及其后一个位置的分布 p
+                step_input = torch.as_tensor([(seq + drafts)[target_len:]], dtype=torch.long, device=device)
+                out, target_past = self(step_input, is_causal=True, past_key_values=target_past, use_cache=True)
+                target_calls += 1
+                rows = out[0, -(len(drafts) + 1):, :]
+
+                # 3) 逐个验证
+                n_ok = 0
+                next_token = None
+                for i, token in enumerate(drafts):
+                    p = dist(rows[i], seq + drafts[:i])
+                    q = q_dists[i]
+                    if torch.rand(()) * q[token] <= p[token]:
+                        n_ok += 1
+                        continue
+                    residual = torch.clamp(p - q, min=0)
+                    residual = residual if residual.sum() > 0 else p
+                    next_token = int(torch.multinomial(residual / residual.sum(), num_samples=1))
+                    break
+                if next_token is None and (not drafts or drafts[-1] != eos):
+                    next_token = int(torch.multinomial(dist(rows[len(drafts)], seq + drafts), num_samples=1))
+
+                drafted += len(drafts)
+                accepted += n_ok
+                new_tokens += n_ok + (next_token is not None)
+                seq = seq + drafts[:n_ok]
+                # 缓存只保留由已确认 token 计算出的部分，新采样的 token 下一轮再喂入
+                target_past = truncate(target_past, len(seq))
+                target_len = len(seq)
+                draft_len = min(draft_len, len(seq))
+                draft_past = truncate(draft_past, draft_len)
+                if next_token is not None:
+                    seq.append(next_token)
+
+        if stats is not None:
+            stats['drafted'] = stats.get('drafted', 0) + drafted
+            stats['accepted'] = stats.get('accepted', 0) + accepted
+            stats['target_calls'] = stats.get('target_calls', 0) + target_calls
+            stats['new_tokens'] = stats.get('new_tokens', 0) + new_tokens
+
+        return tokenizer.decode(seq)
+
+
+def build_model_from_checkpoint(checkpoint, block_type='sdpa'):
+    """
+    根据检查点构建 LightweightTransformer 并加载权重。
+    旧检查点的 model_config 没有 block_type（即 nn.TransformerEncoder 结构），
+    加载时经 convert_block_state_dict 转换到目标 block_type（默认 sdpa）。
+    """
+    model_cfg = dict(checkpoint['model_config'])
+    src_type = model_cfg.pop('block_type', 'encoder')
+    state_dict = convert_block_state_dict(checkpoint['model_state_dict'], src=src_type, dst=block_type)
+
+    model = LightweightTransformer(vocab_size=checkpoint['vocab_size'], block_type=block_type, **model_cfg)
+    model.load_state_dict(state_dict, strict=True)
+    return model
+
+
+def load_trained_model(model_path='item_desc_model_final.pth'):
+    """加载训练好的模型"""
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    
+    if not os.path.exists(model_path):
+        raise FileNotFoundError(f"模型文件不存在: {model_path}")
+    
+    checkpoint = load_checkpoint(model_path, map_location=device)
+    
+    # 创建模型（旧结构的检查点自动转换为 sdpa）
+    model = build_model_from_checkpoint(checkpoint)
+    model = model.to(device)
+    model.eval()
+    
+    # 训练中途的检查点不带分词器，分词器单独存在同目录的 tokenizer.pth
+    tokenizer = checkpoint.get('tokenizer')
+    if tokenizer is None:
+        tokenizer = load_checkpoint(os.path.join(os.path.dirname(model_path), 'tokenizer.pth'))
+    
+    print(f"模型已加载: {model_path}")
+    return model, tokenizer, device
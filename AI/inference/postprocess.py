@@ -0,0 +1,284 @@
+import re
+import time
+import queue
+import threading
+from collections import Counter
+from concurrent.futures import Future, ProcessPoolExecutor
+
+# jieba.posseg 按需加载，见 load_jieba()
+pseg = None
+
+# ===== 工具：清理文本，尽量只留“短词/短语”友好的字符 =====
+_CHINESE_RE = re.compile(r'[\u4e00-\u9fff]+')
+_ALNUM_RE   = re.compile(r'[a-z0-9]+', re.I)
+_PUNC_STRIP = " ，。,.、/|;；:：-—()（）[]【】~!@#$%^&*_+<>?:\"'\\"
+
+STOPWORDS = set([
+    # 口水/功能词，尽量别出现在联想里
+    "这款","采用","具有","无论是","可以","就是","整体","如果","以及","能够","支持",
+    "非常","比较","还是","的话","更加","进行","关于","以及","一种","一款","款式",
+])
+
+# 简单词性白名单（名词、形容词、专名、英文等）
+POS_WHITELIST = set(["n","nr","ns","nz","nt","eng","x","a","an","vn","vnf"])
+
+def _is_good_token(w, flag):
+    if not w:
+        return False
+    if w in STOPWORDS:
+        return False
+    # 纯标点/空白过滤
+    if not (_CHINESE_RE.search(w) or _ALNUM_RE.search(w)):
+        return False
+    # 词性过滤
+    if flag not in POS_WHITELIST:
+        # 允许纯数字/字母
+        if _ALNUM_RE.fullmatch(w):
+            return True
+        return False
+    # 单字允许，但更偏向 2-3 字
+    return True
+
+def load_jieba():
+    """
+    jieba.posseg 在 import 时就会加载词性模型（约 0.5s），只在用 jieba 抽词时才加载；
+    服务启动时主动调用一次预热，避免首个请求承担加载时间。
+    """
+    global pseg
+    if pseg is None:
+        import jieba
+        import jieba.posseg
+        jieba.setLogLevel(jieba.logging.WARNING)
+        jieba.initialize()
+        pseg = jieba.posseg
+        list(pseg.cut("预热"))
+    return pseg
+
+def _extract_keywords_cn(text: str, top_k=20):
+    """用 jieba 抽关键词（单词），只保留白名单词性。"""
+    words = []
+    for w, f in load_jieba().cut(text):
+        w = w.strip(_PUNC_STRIP).strip()
+        if _is_good_token(w, f):
+            words.append(w)
+    # 频次 + 长度微弱加成
+    cnt = Counter(words)
+    scored = sorted(cnt.items(), key=lambda x: (x[1], len(x[0])>=2, len(x[0])), reverse=True)
+    return [w for w,_ in scored[:top_k]]
+
+# 可选的 Aho-Corasick 词表抽取器（KEYWORD_EXTRACTOR=aho 时在启动时加载）
+keyword_automaton = None
+
+def _extract_keywords(text: str, top_k=20):
+    """按配置选择关键词抽取方式：词表自动机（一次线性扫描）或 jieba 词性过滤"""
+    if keyword_automaton is not None:
+        return keyword_automaton.extract_keywords(text, top_k=top_k, stopwords=STOPWORDS)
+    return _extract_keywords_cn(text, top_k=top_k)
+
+def _compose_bigrams(words, query):
+    """把相邻的关键词组成二元短语；优先包含 query 的短语。"""
+    bigrams = []
+    for i in range(len(words)-1):
+        a, b = words[i], words[i+1]
+        if a in STOPWORDS or b in STOPWORDS: 
+            continue
+        # 过滤太长的词拼接
+        if len(a) > 8 or len(b) > 8:
+            continue
+        phrase = a + b
+        # 控制总长度（中文 4~10 字）
+        if 2 <= len(phrase) <= 10:
+            bigrams.append(phrase)
+    # 排序：包含 query 的优先，然后按长度适中优先
+    q = (query or "").strip()
+    bigrams = sorted(set(bigrams), key=lambda s: (q and q in s, 4 <= len(s) <= 8, len(s)), reverse=True)
+    return bigrams
+
+# 放在工具函数区域（和 _extract_keywords_cn / _compose_bigrams 放一起）
+_PUNC_STRIP = " ，。,.、/|;；:：-—()（）[]【】~!@#$%^&*_+<>?:\"'\\"
+
+def _remove_query_from_phrase(phrase: str, query: str) -> str:
+    """把候选里的 query 去掉，只保留联想内容；兼顾中文的前缀重叠等情况。"""
+    if not phrase:
+        return ""
+    s = phrase.strip(_PUNC_STRIP).strip()
+    q = (query or "").strip()
+    if not q:
+        return s
+
+    # 1) 直接替换掉完整 query 出现的位置
+    s = s.replace(q, "")
+
+    # 2) 若依然以 query 的前缀开头（例如 tokenizer/抽词导致“智能手…”），去掉最长公共前缀（阈值≥2个字）
+    i = 0
+    m = min(len(s), len(q))
+    while i < m and s[i] == q[i]:
+        i += 1
+    if i >= 2:
+        s = s[i:]
+
+    # 3) 处理一些常见尾部重叠（例如 q 结尾“手机”，候选以“手机”开头）
+    for k in (q[-2:], q[-1:]):
+        if k and s.startswith(k):
+            s = s[len(k):]
+
+    return s.strip(_PUNC_STRIP).strip()
+
+def _postprocess_phrases(raw_texts, query, max_chars=12, want_n=8, association_only=True, trie=None, tok=None):
+    """约束解码的结果本身就是词表短语：不再抽关键词，只丢弃未走完的短语、去掉 query、去重截断"""
+    q = (query or "").strip()
+    out = []
+    seen = set()
+    for t in raw_texts:
+        s = (t or "").strip()
+        # 达到 max_new_tokens 时短语可能还没走完
+        if not s or (trie is not None and not trie.contains(tok.encode(s, add_special=False, pad_to_max=False))):
+            continue
+        if association_only:
+            s = _remove_query_from_phrase(s, q)
+        if not s or s == q:
+            continue
+        s = s[:max_chars]
+        if s in seen:
+            continue
+        seen.add(s)
+        out.append(s)
+        if len(out) >= want_n:
+            break
+    return out
+
+def _postprocess_suggestions(raw_texts, query, max_chars=12, want_n=8, association_only=True):
+    """句子 -> 关键词集合（单词 + 二元短语）-> 清洗/去重/截断
+       association_only=True 时，把候选里的 query 部分去掉，只保留“联想内容”。
+    """
+    from collections import Counter
+
+    # 1) 先抽关键词
+    cand_words = []
+    for t in raw_texts:
+        t = (t or "").strip()
+        t = t.strip(_PUNC_STRIP)
+        if not t:
+            continue
+        cand_words.extend(_extract_keywords(t, top_k=20))
+
+    # 2) bigram + 单词，优先和 query 相关的
+    bigrams = _compose_bigrams(cand_words, query)
+    q = (query or "").strip()
+    singles = list(dict.fromkeys([w for w in cand_words if (not q) or (q in w or w in q)]))
+
+    merged = bigrams + singles  # bigram 优先
+
+    # 3) 去掉 query，做清理与长度裁剪
+    cleaned = []
+    for s in merged:
+        s = s.strip(_PUNC_STRIP).strip()
+        if not s:
+            continue
+        if association_only:
+            s = _remove_query_from_phrase(s, q)
+        if not s or s == q:
+            continue
+        if len(s) > max_chars:
+            s = s[:max_chars]
+        # 避免只剩下标点/空白
+        if not s or all(ch in _PUNC_STRIP for ch in s):
+            continue
+        cleaned.append(s)
+
+    # 4) 去重、保序，取前 N
+    seen = set()
+    out = []
+    for s in cleaned:
+        if s in seen:
+            continue
+        seen.add(s)
+        out.append(s)
+        if len(out) >= want_n:
+            break
+    return out
+
+# ===== 后处理进程池：jieba / 字符串清洗是纯 Python，放到子进程里避开 GIL =====
+def _init_postprocess_worker(extractor="jieba", lexicon_path=None):
+    """子进程初始化：jieba 词典 / 词性模型只加载一次；extractor='aho' 时只建自动机，不加载 jieba"""
+    global keyword_automaton
+    if extractor == "aho":
+        from catalog_lexicon import AhoCorasick, load_lexicon
+        keyword_automaton = AhoCorasick(load_lexicon(lexicon_path))
+    else:
+        load_jieba()
+
+def _postprocess_batch(jobs):
+    """子进程里执行一批 _postprocess_suggestions；jobs 为 [(raw_texts, query, max_chars, want_n), ...]"""
+    return [_postprocess_suggestions(raw_texts, query, max_chars=max_chars, want_n=want_n)
+            for raw_texts, query, max_chars, want_n in jobs]
+
+class PostprocessPool:
+    """
+    把多个请求的后处理攒成一批再提交给进程池，减少每个请求一次的进程间通信开销：
+    调度线程拿到第一个任务后最多再等 batch_wait 秒或攒满 batch_size 个，然后整批提交；
+    多个批次可以同时在不同的子进程里执行，吞吐随核数增长而不受单个解释器的 GIL 限制。
+    """
+
+    def __init__(self, workers, extractor="jieba", lexicon_path=None, batch_size=16, batch_wait=0.002):
+        self.batch_size = max(1, batch_size)
+        self.batch_wait = batch_wait
+        self.executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_postprocess_worker,
+                                            initargs=(extractor, lexicon_path))
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._dispatch, daemon=True)
+        self._thread.start()
+
+    def submit(self, raw_texts, query, max_chars=12, want_n=8):
+        """提交一个请求的后处理，返回 concurrent.futures.Future"""
+        fut = Future()
+        self._queue.put(((list(raw_texts), query, max_chars, want_n), fut))
+        return fut
+
+    def _dispatch(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.perf_counter() + self.batch_wait
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)  # 先提交手上这一批，下一轮再退出
+                    break
+                batch.append(item)
+            futures = [fut for _, fut in batch]
+            try:
+                task = self.executor.submit(_postprocess_batch, [job for job, _ in batch])
+            except Exception as e:
+                for fut in futures:
+                    fut.set_exception(e)
+                continue
+            task.add_done_callback(lambda t, futures=futures: self._resolve(t, futures))
+
+    @staticmethod
+    def _resolve(task, futures):
+        error = task.exception()
+        if error is not None:
+            for fut in futures:
+                fut.set_exception(error)
+            return
+        for fut, result in zip(futures, task.result()):
+            fut.set_result(result)
+
+    def warmup(self):
+        """每个子进程都跑一次，确保初始化（加载 jieba）在接流量之前完成"""
+        workers = self.executor._max_workers
+        list(self.executor.map(_postprocess_batch, [[(["预热"], "", 12, 1)]] * workers))
+
+    def shutdown(self):
+        self._queue.put(None)
+        self._thread.join()
+        self.executor.shutdown(wait=True)
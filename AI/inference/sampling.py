@@ -0,0 +1,29 @@
+import torch
+
+
+def _to_tensor_1d(x, device, dtype=torch.long):
+    """把 list/ndarray/tensor 统一成 1D Tensor（不拷贝就地引用）"""
+    if isinstance(x, torch.Tensor):
+        return x.to(device=device, dtype=dtype).view(-1)
+    try:
+        return torch.as_tensor(x, device=device, dtype=dtype).view(-1)
+    except Exception:
+        # 兜底：返回长度为 0 的 1D tensor，跳过阻断逻辑
+        return torch.empty(0, device=device, dtype=dtype)
+
+
+def _block_repeated_bigrams(prefix_ids, logits):
+    """2-gram 重复阻断：屏蔽历史中 (last, y) 出现过的 y。兼容 list/tensor。"""
+    p = _to_tensor_1d(prefix_ids, device=logits.device)
+    if p.numel() < 2:
+        return logits
+    last = int(p[-1].item())
+    seen_next = set()
+    arr = p.tolist()
+    for i in range(len(arr) - 1):
+        if arr[i] == last:
+            seen_next.add(arr[i + 1])
+    if seen_next:
+        ix = torch.as_tensor(list(seen_next), device=logits.device, dtype=torch.long)
+        logits.index_fill_(0, ix, float('-inf'))
+    return logits
@@ -0,0 +1,73 @@
+class TextTokenizer:
+    """简单的文本分词器"""
+    def __init__(self, vocab_size=10000):
+        self.vocab_size = vocab_size
+        self.vocab = {}
+        self.inverse_vocab = {}
+        self.special_tokens = {
+            '<PAD>': 0, '<SOS>': 1, '<EOS>': 2, '<UNK>': 3, '<SEP>': 4
+        }
+
+    def build_vocab(self, texts):
+        from collections import Counter
+        import re
+        words = []
+        for text in texts:
+            tokens = self._tokenize(text)
+            words.extend(tokens)
+        word_counts = Counter(words)
+        most_common = word_counts.most_common(self.vocab_size - len(self.special_tokens))
+        self.vocab = {**self.special_tokens}
+        self.inverse_vocab = {v: k for k, v in self.special_tokens.items()}
+        for i, (word, _) in enumerate(most_common, start=len(self.special_tokens)):
+            self.vocab[word] = i
+            self.inverse_vocab[i] = word
+
+    def _tokenize(self, text):
+        """更稳的中英混合分词：中文按字切，英文按词切，保留标点"""
+        import re
+        text = text.lower()
+        # 拆成：中文单字 | 英文/数字串 | 其他符号
+        tokens = re.findall(r'[\u4e00-\u9fff]|[a-z0-9]+|[^\w\s]', text)
+        return tokens
+
+    def encode(self, text, max_length=None, add_special=False, pad_to_max=False):
+        """
+        add_special: 是否在两端添加 <SOS>/<EOS>
+        pad_to_max : 是否把长度补到 max_length（只在给模型喂定长输入时用）
+        """
+        tokens = self._tokenize(text)
+        unk = self.special_tokens['<UNK>']
+        pad = self.special_tokens['<PAD>']
+        eos = self.special_tokens['<EOS>']
+        sos = self.special_tokens['<SOS>']
+
+        token_ids = [self.vocab.get(t, unk) for t in tokens]
+
+        if add_special:
+            token_ids = [sos] + token_ids + [eos]
+
+        if max_length is not None and pad_to_max:
+            if len(token_ids) > max_length:
+                # 截断时确保句尾有 EOS
+                token_ids = token_ids[:max_length]
+                if token_ids[-1] != eos and add_special:
+                    token_ids[-1] = eos
+            else:
+                token_ids = token_ids + [pad] * (max_length - len(token_ids))
+
+        return token_ids
+
+    def decode(self, token_ids, drop_special=True, stop_at_eos=True, concat_chinese=True):
+        """把 id 还原为文本，可选择过滤特殊符号"""
+        specials = set(self.special_tokens.values())
+        eos = self.special_tokens['<EOS>']
+        out = []
+        for tid in token_ids:
+            if stop_at_eos and tid == eos:
+                break
+            if drop_special and tid in specials:
+                continue
+            out.append(self.inverse_vocab.get(tid, ''))
+        # 中文建议不加空格
+        return ''.join(out) if concat_chinese else ' '.join(out)
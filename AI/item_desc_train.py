@@ -1,407 +1,1004 @@
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torch.utils.data import Dataset, DataLoader
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import Dataset, IterableDataset, DataLoader, Sampler, get_worker_info
+from checkpointing import (AsyncCheckpointer, capture_rng_state, restore_rng_state, list_checkpoints,
+                           find_latest_checkpoint, load_checkpoint)
 from nlp_transformer import TextTokenizer
+# 模型结构 / 加载在推理包里，这里重新导入保持旧的 from item_desc_train import ... 可用
+from inference.model import LightweightTransformer, build_model_from_checkpoint, load_trained_model
+from train_profiler import StepProfiler
 import numpy as np
 from tqdm import tqdm
 import os
+import io
+import contextlib
+import gzip
 import math
+import time
+import random
+import json
+import zlib
+
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
+
+
+def _open_corpus(file_path, binary=False):
+    """按扩展名打开语料：支持纯文本 / .gz / .zst（需安装 zstandard）"""
+    if file_path.endswith('.gz'):
+        return gzip.open(file_path, 'rb') if binary else gzip.open(file_path, 'rt', encoding='utf-8')
+    if file_path.endswith('.zst'):
+        if not ZSTD_AVAILABLE:
+            raise ImportError("读取 .zst 语料需要先安装 zstandard")
+        reader = zstandard.ZstdDecompressor().stream_reader(open(file_path, 'rb'), closefd=True)
+        return reader if binary else io.TextIOWrapper(reader, encoding='utf-8')
+    return open(file_path, 'rb') if binary else open(file_path, 'r', encoding='utf-8')
+
+
+def _parse_item_line(line):
+    """解析一行 `title\tdesc`，不合法返回 None"""
+    if '\t' not in line:
+        return None
+    title, desc = line.strip().split('\t', 1)
+    if not title or not desc:
+        return None
+    return title, desc
+
+
+def _in_split(pair, split, eval_fraction):
+    """
+    按标题哈希划分训练 / 验证集：crc32(title) 决定归属，与文件顺序、分片方式、进程数无关，
+    同一标题的所有样本总在同一侧，不会泄漏到验证集。split=None 时不划分。
+    """
+    if split is None or eval_fraction <= 0:
+        return split != 'eval'
+    heldout = zlib.crc32(pair[0].encode('utf-8')) % 10000 < eval_fraction * 10000
+    return heldout if split == 'eval' else not heldout
+
+
+def _encode_item_pair(tokenizer, title, desc):
+    """拼成 [SOS] title [SEP] desc [EOS] 的 token id 序列（不截断、不 padding）"""
+    # 先拿“纯 token id”，不加特殊符，不 padding
+    title_ids = tokenizer.encode(title, max_length=None, add_special=False, pad_to_max=False)
+    desc_ids  = tokenizer.encode(desc,  max_length=None, add_special=False, pad_to_max=False)
+
+    sos = tokenizer.special_tokens['<SOS>']
+    eos = tokenizer.special_tokens['<EOS>']
+    sep = tokenizer.special_tokens['<SEP>']
+    return [sos] + title_ids + [sep] + desc_ids + [eos]
+
+
+def _build_lm_sample(ids, max_seq_length, pad):
+    """截断 + padding，返回 (input_ids, labels, key_padding_mask) 三件套"""
+    # 截断到 max_seq_length
+    ids = ids[:max_seq_length]
+    attn = [1] * len(ids)
+
+    # padding 到固定长度
+    if len(ids) < max_seq_length:
+        pad_n = max_seq_length - len(ids)
+        ids  = ids + [pad] * pad_n
+        attn = attn + [0] * pad_n
+
+    # 右移标签：next-token，PAD 的 label 记为 -100（和 loss 的 ignore_index 对齐）
+    ignore_index = -100
+    labels = ids[1:] + [pad]
+    labels = [tok if tok != pad else ignore_index for tok in labels]
+
+    key_padding_mask = [m == 0 for m in attn]  # True=PAD
+
+    return torch.LongTensor(ids), torch.LongTensor(labels), torch.BoolTensor(key_padding_mask)
+
+
+def count_corpus_samples(file_path):
+    """快速统计语料中合法样本行数（按字节扫描，不做分词），用于估算每个 epoch 的步数"""
+    count = 0
+    with _open_corpus(file_path, binary=True) as f:
+        for line in f:
+            if b'\t' in line:
+                count += 1
+    return count
+
+
+def _pack_sequences(id_lists, max_seq_length):
+    """
+    贪心顺序装箱：把多条样本首尾相接装进长度为 max_seq_length 的行，
+    放不下就另起一行；超长样本先截断。产出每行包含的样本列表。
+    """
+    row, used = [], 0
+    for ids in id_lists:
+        ids = ids[:max_seq_length]
+        if used + len(ids) > max_seq_length and row:
+            yield row
+            row, used = [], 0
+        row.append(ids)
+        used += len(ids)
+    if row:
+        yield row
+
+
+def _build_packed_sample(samples, max_seq_length, pad):
+    """
+    把一行中的多条样本拼成训练张量，返回五件套：
+    (input_ids, labels, key_padding_mask, position_ids, segment_ids)
+    - labels 只在样本内部右移，样本最后一个 token 不跨界预测下一条样本
+    - position_ids 每条样本从 0 重新计数
+    - segment_ids 从 1 开始给样本编号，PAD 为 0，用于构建块对角因果 mask
+    """
+    ignore_index = -100
+    ids, labels, positions, segments = [], [], [], []
+    for seg, sample in enumerate(samples, start=1):
+        ids.extend(sample)
+        labels.extend(sample[1:] + [ignore_index])
+        positions.extend(range(len(sample)))
+        segments.extend([seg] * len(sample))
+
+    pad_n = max_seq_length - len(ids)
+    key_padding_mask = [False] * len(ids) + [True] * pad_n  # True=PAD
+    ids += [pad] * pad_n
+    labels += [ignore_index] * pad_n
+    positions += [0] * pad_n
+    segments += [0] * pad_n
+
+    return (torch.LongTensor(ids), torch.LongTensor(labels), torch.BoolTensor(key_padding_mask),
+            torch.LongTensor(positions), torch.LongTensor(segments))
+
+
+def build_packed_attention_mask(segment_ids, nhead):
+    """
+    块对角因果 mask：同一样本内才能互相看见，且只能看左侧。
+    返回 (B*nhead, L, L) 的 bool mask，True=禁止注意（与 nn.Transformer 的约定一致）。
+    PAD 之间同属 0 号段，对角线恒可见，避免整行被屏蔽产生 NaN。
+    """
+    L = segment_ids.size(1)
+    same = segment_ids.unsqueeze(2) == segment_ids.unsqueeze(1)  # (B, L, L)
+    causal = torch.ones(L, L, device=segment_ids.device, dtype=torch.bool).tril()
+    blocked = ~(same & causal)
+    return blocked.repeat_interleave(nhead, dim=0)
 
 class ItemDescDataset(Dataset):
-    """商品描述数据集"""
+    """商品描述数据集
+
+    pack=True 时把多条短样本装进同一行（序列打包），__getitem__ 返回
+    (input_ids, labels, key_padding_mask, position_ids, segment_ids) 五件套。
+    split='train' / 'eval' 时按标题哈希只保留训练集 / 验证集（比例 eval_fraction）。
+    """
     
-    def __init__(self, file_path, tokenizer, max_seq_length=128, max_samples=None):
+    def __init__(self, file_path, tokenizer, max_seq_length=128, max_samples=None, pack=False,
+                 split=None, eval_fraction=0.0):
         self.file_path = file_path
         self.tokenizer = tokenizer
         self.max_seq_length = max_seq_length
+        self.pack = pack
+        self.split = split
+        self.eval_fraction = eval_fraction
         self.samples = []
+        self.rows = None
         
         # 读取数据
         self._load_data(max_samples)
+        if pack:
+            self._pack_samples()
     
     def _load_data(self, max_samples):
         """加载数据"""
         print("加载数据集...")
         count = 0
         
-        with open(self.file_path, 'r', encoding='utf-8') as f:
+        with _open_corpus(self.file_path) as f:
             for line in tqdm(f, desc="读取数据"):
-                if '\t' in line:
-                    title, desc = line.strip().split('\t', 1)
-                    
-                    # 创建训练样本：使用标题作为输入，描述作为目标
-                    if title and desc:
-                        self.samples.append((title, desc))
-                        count += 1
-                        
-                        if max_samples and count >= max_samples:
-                            break
+                pair = _parse_item_line(line)
+
+                # 创建训练样本：使用标题作为输入，描述作为目标
+                if pair and _in_split(pair, self.split, self.eval_fraction):
+                    self.samples.append(pair)
+                    count += 1
+
+                    if max_samples and count >= max_samples:
+                        break
         
         print(f"加载完成，共 {len(self.samples)} 个样本")
+
+    def _pack_samples(self):
+        """预先分词并装箱，行内样本顺序与文件顺序一致，由 DataLoader 打乱行"""
+        id_lists = (_encode_item_pair(self.tokenizer, t, d) for t, d in self.samples)
+        self.rows = list(_pack_sequences(id_lists, self.max_seq_length))
+        print(f"序列打包完成：{len(self.samples)} 个样本 -> {len(self.rows)} 行")
     
     def __len__(self):
-        return len(self.samples)
+        return len(self.rows) if self.pack else len(self.samples)
         
     def __getitem__(self, idx):
+        pad = self.tokenizer.special_tokens['<PAD>']
+        if self.pack:
+            return _build_packed_sample(self.rows[idx], self.max_seq_length, pad)
         title, desc = self.samples[idx]
-        # 先拿“纯 token id”，不加特殊符，不 padding
-        title_ids = self.tokenizer.encode(title, max_length=None, add_special=False, pad_to_max=False)
-        desc_ids  = self.tokenizer.encode(desc,  max_length=None, add_special=False, pad_to_max=False)
+        ids = _encode_item_pair(self.tokenizer, title, desc)
+        return _build_lm_sample(ids, self.max_seq_length, pad)
 
-        sos = self.tokenizer.special_tokens['<SOS>']
-        eos = self.tokenizer.special_tokens['<EOS>']
-        sep = self.tokenizer.special_tokens['<SEP>']
-        pad = self.tokenizer.special_tokens['<PAD>']
 
-        # 统一拼：[SOS] title [SEP] desc [EOS]
-        ids = [sos] + title_ids + [sep] + desc_ids + [eos]
+class ResumableSampler(Sampler):
+    """
+    可续训的采样器（替代 RandomSampler / DistributedSampler）：
+    - 每个 epoch 的打乱顺序只由 (seed, epoch) 决定
+    - 分布式时先补齐到 world_size 的整数倍，再按 rank 交错切分，保证各 rank 步数相同
+    - set_start 从本 rank 的第 start 个样本继续，跳过的样本不会被加载
+    """
 
-        # 截断到 max_seq_length
-        ids = ids[:self.max_seq_length]
-        attn = [1] * len(ids)
+    def __init__(self, dataset, rank=0, world_size=1, shuffle=True, seed=42):
+        self.dataset_len = len(dataset)
+        self.rank = rank
+        self.world_size = world_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+        self.num_samples = math.ceil(self.dataset_len / world_size)
 
-        # padding 到固定长度
-        if len(ids) < self.max_seq_length:
-            pad_n = self.max_seq_length - len(ids)
-            ids  += [pad] * pad_n
-            attn += [0] * pad_n
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.start = 0
 
-        # 右移标签：next-token，PAD 的 label 记为 -100（和 loss 的 ignore_index 对齐）
-        ignore_index = -100
-        labels = ids[1:] + [pad]
-        labels = [tok if tok != pad else ignore_index for tok in labels]
+    def set_start(self, start):
+        self.start = start
 
-        key_padding_mask = [m == 0 for m in attn]  # True=PAD
+    def __iter__(self):
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(self.dataset_len, generator=g).tolist()
+        else:
+            indices = list(range(self.dataset_len))
 
-        return torch.LongTensor(ids), torch.LongTensor(labels), torch.BoolTensor(key_padding_mask)
+        total = self.num_samples * self.world_size
+        while len(indices) < total:
+            indices += indices[:total - len(indices)]
+        indices = indices[self.rank:total:self.world_size]
+        return iter(indices[self.start:])
 
+    def __len__(self):
+        return self.num_samples - self.start
 
 
-class LightweightTransformer(nn.Module):
-    """轻量级Transformer语言模型，适合4GB显存"""
-    
-    def __init__(self, vocab_size, d_model=256, nhead=8, 
-                 num_layers=4, dim_feedforward=512, dropout=0.1, 
-                 max_seq_length=128):
-        super(LightweightTransformer, self).__init__()
-        
-        self.d_model = d_model
-        self.vocab_size = vocab_size
+class StreamingItemDescDataset(IterableDataset):
+    """
+    流式商品描述数据集（语料大于内存时使用）：
+    - 边读边分词，不把样本整体放进内存，支持 .gz / .zst 压缩语料
+    - 按 (rank, worker) 切分分片：纯文本按字节偏移切，压缩文件无法 seek，退化为按行取模
+    - 分片内用 shuffle buffer 做近似打乱，顺序由 (seed, epoch, 分片号) 唯一确定
+    - 通过 state_dict / load_state_dict 从保存的位置确定性续训
+    - pack=True 时在打乱之后做序列打包，产出五件套（见 ItemDescDataset）
+    - split / eval_fraction 与 ItemDescDataset 相同，按标题哈希划分训练 / 验证集
+    """
+
+    def __init__(self, file_path, tokenizer, max_seq_length=128, shuffle_buffer=10000,
+                 seed=42, rank=None, world_size=None, pack=False, split=None, eval_fraction=0.0):
+        self.file_path = file_path
+        self.tokenizer = tokenizer
         self.max_seq_length = max_seq_length
-        
-        # 词嵌入
-        self.embedding = nn.Embedding(vocab_size, d_model)
-        
-        # 位置编码
-        self.pos_encoder = nn.Embedding(max_seq_length, d_model)
-        
-        # Transformer编码器
-        encoder_layer = nn.TransformerEncoderLayer(
-            d_model=d_model,
-            nhead=nhead,
-            dim_feedforward=dim_feedforward,
-            dropout=dropout,
-            batch_first=True
-        )
-        self.transformer = nn.TransformerEncoder(encoder_layer, num_layers)
-        
-        # 输出层
-        self.output_layer = nn.Linear(d_model, vocab_size)
-        self.dropout = nn.Dropout(dropout)
-        
-        # 初始化权重
-        self._init_weights()
-    
-    def _init_weights(self):
-        """初始化权重"""
-        initrange = 0.1
-        self.embedding.weight.data.uniform_(-initrange, initrange)
-        self.output_layer.bias.data.zero_()
-        self.output_layer.weight.data.uniform_(-initrange, initrange)
-    
-    def forward(self, src, src_mask=None, src_key_padding_mask=None):
-        """前向传播"""
-        batch_size, seq_len = src.size()
-        
-        # 词嵌入
-        src_emb = self.embedding(src) * math.sqrt(self.d_model)
-        
-        # 位置编码
-        positions = torch.arange(seq_len, device=src.device).unsqueeze(0).expand(batch_size, seq_len)
-        pos_emb = self.pos_encoder(positions)
-        src_emb = src_emb + pos_emb
-        
-        # Transformer编码
-        output = self.transformer(src_emb, mask=src_mask, src_key_padding_mask=src_key_padding_mask)
-        
-        # 输出预测
-        output = self.output_layer(output)
-        return output
-    
-    def generate(self, input_text, tokenizer, max_length=50, temperature=1.0, top_k=50):
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.pack = pack
+        self.split = split
+        self.eval_fraction = eval_fraction
+
+        # 未显式指定时从分布式环境读取 rank / world_size
+        if rank is None or world_size is None:
+            if torch.distributed.is_available() and torch.distributed.is_initialized():
+                rank, world_size = torch.distributed.get_rank(), torch.distributed.get_world_size()
+            else:
+                rank, world_size = 0, 1
+        self.rank = rank
+        self.world_size = world_size
+
+        # 只有未压缩文件才能按字节偏移切分
+        self.seekable = not file_path.endswith(('.gz', '.zst'))
+        self.epoch = 0
+        self._resume = None
+
+    def set_epoch(self, epoch):
+        """每个 epoch 开始前调用，切换打乱顺序；离开续训所在 epoch 后不再跳过样本"""
+        self.epoch = epoch
+        if self._resume is not None and self._resume['epoch'] != epoch:
+            self._resume = None
+
+    def state_dict(self, batches_seen, batch_size, num_workers=0):
+        """记录当前 rank 的读取位置（已消费的 batch 数），用于续训"""
+        return {
+            'epoch': self.epoch,
+            'batches_seen': batches_seen,
+            'batch_size': batch_size,
+            'num_workers': num_workers,
+            'seed': self.seed,
+        }
+
+    def load_state_dict(self, state):
+        """从 state_dict 恢复：同一 epoch 内跳过已消费的样本"""
+        self.seed = state['seed']
+        self.epoch = state['epoch']
+        self._resume = dict(state)
+
+    def _iter_shard_lines(self, shard_id, num_shards):
+        """读取本分片的原始行"""
+        if self.seekable:
+            size = os.path.getsize(self.file_path)
+            start = size * shard_id // num_shards
+            end = size * (shard_id + 1) // num_shards
+            with open(self.file_path, 'rb') as f:
+                pos = start
+                if start > 0:
+                    # 回退一个字节再丢掉半行：一行归属于其起始字节所在的分片
+                    f.seek(start - 1)
+                    pos = start - 1 + len(f.readline())
+                while pos < end:
+                    line = f.readline()
+                    if not line:
+                        break
+                    pos += len(line)
+                    yield line.decode('utf-8', errors='ignore')
+        else:
+            with _open_corpus(self.file_path) as f:
+                for i, line in enumerate(f):
+                    if i % num_shards == shard_id:
+                        yield line
+
+    def _shuffled(self, items, rng):
+        """shuffle buffer：缓冲区满后随机吐出一个，再用新样本补位"""
+        if self.shuffle_buffer <= 1:
+            yield from items
+            return
+        buf = []
+        for x in items:
+            if len(buf) < self.shuffle_buffer:
+                buf.append(x)
+                continue
+            j = rng.randrange(len(buf))
+            yield buf[j]
+            buf[j] = x
+        rng.shuffle(buf)
+        yield from buf
+
+    def _resume_position(self, worker_id, num_workers):
         """
-        自回归生成（联想友好版）：
-        - 滑动窗口避免位置越界
-        - 屏蔽特殊 token（仅允许 <EOS> 用于结束）
-        - 2-gram 重复阻断
+        续训时本 worker 对应的逻辑分片号与需要跳过的样本数。
+        DataLoader 按 worker 轮询取 batch，第 i 个 batch 来自 worker i % num_workers；
+        续训后轮询总是从 0 号 worker 重新开始，所以把物理 worker 旋转映射到逻辑 worker，
+        保证续训后的 batch 顺序与不中断时完全一致。
+        仅在某个 worker 已读完（epoch 末尾）之后续训时这一对应关系才会失效。
         """
-        self.eval()
-        device = next(self.parameters()).device
+        state = self._resume
+        if state is None or state['epoch'] != self.epoch:
+            return worker_id, 0
+        if max(state['num_workers'], 1) != num_workers:
+            raise ValueError(
+                f"续训时 num_workers 必须与保存时一致: 保存={state['num_workers']}, 当前={num_workers}"
+            )
+        n = state['batches_seen']
+        logical_id = (worker_id + n) % num_workers
+        my_batches = n // num_workers + (1 if logical_id < n % num_workers else 0)
+        return logical_id, my_batches * state['batch_size']
 
-        # 兼容你的 encode：若没有 add_special/pad_to_max 参数则走老签名
-        try:
-            ids = tokenizer.encode(input_text, max_length=self.max_seq_length - 2,
-                                add_special=False, pad_to_max=False)
-        except TypeError:
-            ids = tokenizer.encode(input_text, max_length=self.max_seq_length - 2)
-        if isinstance(ids, list):
-            # 防止 encode 里已经 pad/加特殊符，这里只保留长度限制
-            ids = ids[: self.max_seq_length - 2]
-
-        sos = tokenizer.special_tokens['<SOS>']
-        eos = tokenizer.special_tokens['<EOS>']
-        sep = tokenizer.special_tokens.get('<SEP>', eos)
-
-        seq = [sos] + ids + [sep]
-        generated = torch.as_tensor([seq], dtype=torch.long, device=device)  # (1, L)
-
-        # 构建禁止采样的 token（除了 <EOS>）
-        ban_tokens = []
-        for k in ['<PAD>', '<SOS>', '<SEP>', '<UNK>']:
-            tid = tokenizer.special_tokens.get(k, None)
-            if tid is not None and tid != eos:
-                ban_tokens.append(tid)
-        ban_tokens = torch.as_tensor(ban_tokens, dtype=torch.long, device=device) if ban_tokens else None
-
-        def to_tensor_1d(x, device, dtype=torch.long):
-            """把 list/ndarray/tensor 统一成 1D Tensor（不拷贝就地引用）"""
-            if isinstance(x, torch.Tensor):
-                return x.to(device=device, dtype=dtype).view(-1)
-            try:
-                return torch.as_tensor(x, device=device, dtype=dtype).view(-1)
-            except Exception:
-                # 兜底：返回长度为 0 的 1D tensor，跳过阻断逻辑
-                return torch.empty(0, device=device, dtype=dtype)
-
-        def block_repeated_bigrams(prefix_ids, logits):
-            """2-gram 重复阻断：屏蔽历史中 (last, y) 出现过的 y。兼容 list/tensor。"""
-            p = to_tensor_1d(prefix_ids, device=logits.device)
-            if p.numel() < 2:
-                return logits
-            last = int(p[-1].item())
-            seen_next = set()
-            arr = p.tolist()
-            for i in range(len(arr) - 1):
-                if arr[i] == last:
-                    seen_next.add(arr[i + 1])
-            if seen_next:
-                ix = torch.as_tensor(list(seen_next), device=logits.device, dtype=torch.long)
-                logits.index_fill_(0, ix, float('-inf'))
-            return logits
-
-        new_tokens = 0
-        with torch.no_grad():
-            while new_tokens < max_length:
-                # 保持右侧窗口 = max_seq_length
-                if generated.size(1) > self.max_seq_length:
-                    generated = generated[:, -self.max_seq_length:]
-
-                L = generated.size(1)
-                causal_mask = torch.triu(torch.ones(L, L, device=device, dtype=torch.bool), diagonal=1)
-
-                logits = self(generated, src_mask=causal_mask)[0, -1, :] / max(temperature, 1e-5)
-
-                # 屏蔽特殊 token
-                if ban_tokens is not None and ban_tokens.numel() > 0:
-                    logits.index_fill_(0, ban_tokens, float('-inf'))
-
-                # 2-gram 阻断（传进去的是 tensor 切片；函数内部也能处理 list）
-                logits = block_repeated_bigrams(generated[0, -self.max_seq_length:], logits)
-
-                # top-k
-                if top_k and top_k > 0:
-                    k = min(top_k, logits.size(0))
-                    vals, idx = torch.topk(logits, k)
-                    filtered = torch.full_like(logits, float('-inf'))
-                    filtered[idx] = vals
-                    logits = filtered
-
-                probs = torch.softmax(logits, dim=-1)
-                next_token = torch.multinomial(probs, num_samples=1)  # (1,)
-
-                generated = torch.cat([generated, next_token.view(1, 1)], dim=1)
-                new_tokens += 1
-
-                if int(next_token.item()) == eos:
-                    break
-
-        # 你的 decode 已会过滤特殊符并在 <EOS> 截断
-        return tokenizer.decode(generated[0].tolist())
-
-
-
-
-def train_model():
-    """训练模型"""
-    print("开始训练商品描述生成模型")
-    print("=" * 60)
-    
-    # 设置设备
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    print(f"使用设备: {device}")
-    
-    # 数据集路径
-    data_path = r"D:\Document\MyCodeProject\实习项目-电商平台\AI\数据集\item_desc_dataset\item_desc_dataset.txt"
-    
-    # 创建分词器
-    tokenizer = TextTokenizer(vocab_size=20000)
-    
-    # 先构建词汇表（使用部分数据）
-    print("构建词汇表...")
+    def __iter__(self):
+        worker = get_worker_info()
+        worker_id, num_workers = (worker.id, worker.num_workers) if worker else (0, 1)
+        logical_id, skip = self._resume_position(worker_id, num_workers)
+        shard_id = self.rank * num_workers + logical_id
+        num_shards = self.world_size * num_workers
+
+        rng = random.Random(f"{self.seed}-{self.epoch}-{shard_id}")
+        pad = self.tokenizer.special_tokens['<PAD>']
+
+        pairs = (p for p in map(_parse_item_line, self._iter_shard_lines(shard_id, num_shards))
+                 if p and _in_split(p, self.split, self.eval_fraction))
+        pairs = self._shuffled(pairs, rng)
+
+        if self.pack:
+            # 打包后一行对应多条样本，行边界依赖分词长度，续训只能重新分词后按行跳过
+            id_lists = (_encode_item_pair(self.tokenizer, t, d) for t, d in pairs)
+            for i, row in enumerate(_pack_sequences(id_lists, self.max_seq_length)):
+                if i >= skip:
+                    yield _build_packed_sample(row, self.max_seq_length, pad)
+            return
+
+        for i, (title, desc) in enumerate(pairs):
+            # 跳过发生在分词之前，续训时定位代价只是读文件
+            if i < skip:
+                continue
+            ids = _encode_item_pair(self.tokenizer, title, desc)
+            yield _build_lm_sample(ids, self.max_seq_length, pad)
+
+
+def _unwrap_model(model):
+    """取出被 DistributedDataParallel / torch.compile 包裹的原始模型"""
+    if isinstance(model, DistributedDataParallel):
+        model = model.module
+    return getattr(model, '_orig_mod', model)
+
+
+def _lm_forward(model, batch, device):
+    """
+    一次语言模型前向，兼容普通三件套与序列打包五件套。
+    返回 (logits, labels, 非 PAD token 数)，PAD 比例 = 1 - 非 PAD token 数 / input_ids.numel()
+    """
+    if len(batch) == 5:
+        # 打包样本：块对角因果 mask + 每条样本重新计数的位置；PAD 已被 mask 隔离，无需 key padding mask
+        input_ids, labels, key_padding_mask, position_ids, segment_ids = (t.to(device) for t in batch)
+        # 旧 encoder 结构要求 (B*nhead, L, L)；sdpa 用 (B, L, L) 在头维上广播即可
+        base = _unwrap_model(model)
+        heads = base.nhead if base.block_type == 'encoder' else 1
+        src_mask = build_packed_attention_mask(segment_ids, heads)
+        logits = model(input_ids, src_mask=src_mask, position_ids=position_ids)
+    else:
+        input_ids, labels, key_padding_mask = (t.to(device) for t in batch)
+
+        # PAD 只在右侧，因果 mask 已保证真实 token 看不到它们，PAD 位置的 label 又被忽略，
+        # 所以不再传 key padding mask：sdpa 可直接走 is_causal 的融合内核
+        logits = model(input_ids, is_causal=True)  # (B, L, V)
+    return logits, labels, int((~key_padding_mask).sum())
+
+
+def _estimate_pack_ratio(tokenizer, pairs, max_seq_length):
+    """用少量样本估算打包后的 行数/样本数 比例，流式 + 打包时据此估计每个 epoch 的步数"""
+    id_lists = [_encode_item_pair(tokenizer, t, d) for t, d in pairs]
+    rows = sum(1 for _ in _pack_sequences(id_lists, max_seq_length))
+    return rows / max(len(id_lists), 1)
+
+
+def evaluate_perplexity(model, dataloader, device, precision='fp32'):
+    """
+    在验证集上批量计算困惑度：整批 no_grad 前向，不做逐 token 采样。
+    返回 {'loss', 'ppl', 'tokens', 'seconds', 'tokens_per_sec'}，loss 为按预测 token 平均的交叉熵，
+    tokens_per_sec 按输入的非 PAD token 计，可直接与训练日志里的有效 token/s 对比。
+    """
+    model = _unwrap_model(model)
+    was_training = model.training
+    model.eval()
+    loss_sum, scored, real_tokens = 0.0, 0, 0
+    start = time.perf_counter()
+    with torch.inference_mode():
+        for batch in dataloader:
+            with _autocast_context(device, precision):
+                logits, labels, n_tokens = _lm_forward(model, batch, device)
+            loss_sum += float(nn.functional.cross_entropy(
+                logits.float().reshape(-1, logits.size(-1)), labels.reshape(-1),
+                ignore_index=-100, reduction='sum'
+            ))
+            scored += int((labels != -100).sum())
+            real_tokens += n_tokens
+    seconds = time.perf_counter() - start
+    model.train(was_training)
+
+    loss = loss_sum / max(scored, 1)
+    return {
+        'loss': loss,
+        'ppl': math.exp(min(loss, 50)),
+        'tokens': scored,
+        'seconds': seconds,
+        'tokens_per_sec': real_tokens / max(seconds, 1e-9),
+    }
+
+
+def _build_eval_loader(cfg, tokenizer):
+    """验证集 DataLoader：按标题哈希划出的 held-out 样本，最多 eval_max_samples 条，顺序固定"""
+    dataset = ItemDescDataset(
+        cfg['data_path'],
+        tokenizer,
+        max_seq_length=cfg['model_config']['max_seq_length'],
+        max_samples=cfg['eval_max_samples'],
+        pack=cfg['pack'],
+        split='eval',
+        eval_fraction=cfg['eval_fraction']
+    )
+    if len(dataset) == 0:
+        return None
+    # 独立的生成器：建迭代器时抽取的随机种子不占用全局随机状态，训练中途评估不影响续训的可复现性
+    return DataLoader(dataset, batch_size=cfg['eval_batch_size'], shuffle=False, num_workers=0,
+                      generator=torch.Generator())
+
+
+def _format_eval(result):
+    return (f"loss {result['loss']:.4f}, 困惑度 {result['ppl']:.2f}"
+            f"（{result['tokens']:,} tokens / {result['seconds']:.1f}s，{result['tokens_per_sec']:,.0f} tokens/s）")
+
+
+# 训练配置：所有原先写死在 train_model 里的常量都集中在这里，按需用 config 覆盖
+DEFAULT_TRAIN_CONFIG = {
+    # 数据
+    'data_path': r"D:\Document\MyCodeProject\实习项目-电商平台\AI\数据集\item_desc_dataset\item_desc_dataset.txt",
+    'vocab_size': 20000,
+    'vocab_lines': 10000,       # 用前 N 行构建词汇表
+    'max_samples': 50000,       # 非流式模式下的样本上限（受内存限制）
+    'streaming': False,         # 流式读取全量语料
+    'pack': False,              # 序列打包
+    'shuffle_buffer': 10000,
+    'num_workers': 0,           # 流式模式下至少使用 1 个 worker 做预取
+    'seed': 42,
+
+    # 优化
+    'batch_size': 16,           # 单次前向的 micro-batch，适配 4GB 显存
+    'grad_accum_steps': 1,      # 梯度累积：有效 batch = batch_size * grad_accum_steps
+    'num_epochs': 5,
+    'lr': 1e-4,
+    'weight_decay': 0.01,
+    'max_grad_norm': 1.0,
+
+    # 精度：'fp32' | 'bf16'（CPU / CUDA 均可）| 'fp16'（仅 CUDA，自动启用 GradScaler）
+    'precision': 'fp32',
+
+    # 分布式数据并行（torchrun 或 launch_distributed 启动时生效）
+    'backend': 'gloo',          # CPU-only Linux 也可用
+    'master_port': 29500,       # launch_distributed 使用的本机端口
+    'threads_per_rank': None,   # 每个进程的 intra-op 线程数，None 表示按 CPU 核数均分
+
+    # 检查点（rank 0 后台线程异步写盘）
+    'checkpoint_dir': 'checkpoints',
+    'checkpoint_every': 0,      # 每 N 个优化器步保存一次；0 表示只在 epoch 结束时保存
+    'keep_last': 3,             # 只保留最近 K 个检查点
+    'resume': None,             # None | 'latest' | 检查点路径
+
+    # 模型结构
+    'model_config': {
+        'd_model': 256,         # 较小的模型维度
+        'nhead': 8,
+        'num_layers': 4,        # 较少的层数
+        'dim_feedforward': 512,
+        'dropout': 0.1,
+        'max_seq_length': 64,
+        'block_type': 'sdpa',   # 'sdpa' 融合注意力 | 'encoder' 旧的 nn.TransformerEncoder
+        'tie_embeddings': False,  # 输出层与词嵌入共享权重
+        'embedding_rank': None,   # 词嵌入 / 输出头的低秩分解维度，如 64；None 表示不分解
+    },
+    'compile': False,           # 用 torch.compile 编译模型（首个 step 编译较慢）
+
+    # 训练性能分析（只在 rank 0 上输出）
+    'profile_every': 0,         # 每 N 个 batch 输出一次分阶段耗时 / 吞吐 / 峰值内存；0 表示关闭
+    'profile_trace_steps': None,  # [start, end]：抓取这几个 batch 的 torch.profiler 轨迹
+    'profile_trace_path': 'train_trace.json',
+
+    # 验证集（按标题哈希划分，训练集自动排除这部分样本）
+    'eval_fraction': 0.01,      # 验证集比例；0 表示不划分、不评估
+    'eval_max_samples': 2000,   # 验证集样本上限
+    'eval_batch_size': 64,      # 评估不需要反向，可以比训练 batch 大
+    'eval_every': 0,            # 每 N 个优化器步评估一次；0 表示只在 epoch 结束时评估
+    'eval_in_training': True,   # False 时训练中不评估，交给 --watch 进程监视检查点目录
+    'generation_test': False,   # epoch 结束时是否跑 test_generation 的逐 token 采样示例
+}
+
+_AUTOCAST_DTYPES = {'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def _merge_config(config=None, defaults=DEFAULT_TRAIN_CONFIG):
+    """在默认配置上叠加用户配置（model_config 按键合并）"""
+    merged = dict(defaults)
+    merged['model_config'] = dict(defaults['model_config'])
+    for k, v in (config or {}).items():
+        if k == 'model_config':
+            merged['model_config'].update(v)
+        elif k not in defaults:
+            raise ValueError(f"未知的训练配置项: {k}")
+        else:
+            merged[k] = v
+    return merged
+
+
+def _autocast_context(device, precision):
+    """按精度配置返回 autocast 上下文；fp32 时为空操作"""
+    if precision not in ('fp32', 'bf16', 'fp16'):
+        raise ValueError(f"不支持的精度: {precision}")
+    if precision == 'fp16' and device.type != 'cuda':
+        raise ValueError("fp16 只支持 CUDA，CPU 请使用 bf16")
+    return torch.autocast(device_type=device.type, dtype=_AUTOCAST_DTYPES.get(precision, torch.bfloat16),
+                          enabled=precision != 'fp32')
+
+
+def _create_grad_scaler(device, precision):
+    """fp16 需要 GradScaler 防止梯度下溢；bf16 指数位与 fp32 相同，不需要"""
+    return torch.amp.GradScaler(device.type, enabled=precision == 'fp16')
+
+
+def _optimizer_step(model, optimizer, scheduler, scaler, max_grad_norm):
+    """一次参数更新：反缩放 -> 梯度裁剪 -> step -> 清梯度"""
+    scaler.unscale_(optimizer)
+    torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=max_grad_norm)
+    scaler.step(optimizer)
+    scaler.update()
+    scheduler.step()
+    optimizer.zero_grad(set_to_none=True)
+
+
+def _build_tokenizer(data_path, vocab_size, vocab_lines):
+    """用语料前 vocab_lines 行构建词汇表，同时返回这些行的 (title, desc) 以便估算"""
+    tokenizer = TextTokenizer(vocab_size=vocab_size)
     sample_texts = []
-    with open(data_path, 'r', encoding='utf-8') as f:
+    sample_pairs = []
+    with _open_corpus(data_path) as f:
         for i, line in enumerate(f):
             if '\t' in line:
                 title, desc = line.strip().split('\t', 1)
                 sample_texts.extend([title, desc])
-            if i >= 10000:  # 使用前10000行构建词汇表
+                sample_pairs.append((title, desc))
+            if i >= vocab_lines:
                 break
-    
     tokenizer.build_vocab(sample_texts)
-    vocab_size = len(tokenizer.vocab)
-    print(f"词汇表大小: {vocab_size}")
+    return tokenizer, sample_pairs
+
+
+def _init_distributed(cfg):
+    """
+    按环境变量初始化进程组（torchrun / launch_distributed 会设置 RANK、WORLD_SIZE）。
+    返回 (rank, world_size, local_rank, 是否由本函数初始化)。
+    """
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size(), int(os.environ.get('LOCAL_RANK', 0)), False
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size <= 1:
+        return 0, 1, 0, False
+    dist.init_process_group(backend=cfg['backend'], init_method='env://')
+    return dist.get_rank(), world_size, int(os.environ.get('LOCAL_RANK', 0)), True
+
+
+def _set_rank_threads(cfg, world_size):
+    """多进程训练时均分 CPU 核，避免每个进程都开满线程互相抢占"""
+    threads = cfg['threads_per_rank']
+    if threads is None and world_size > 1:
+        threads = max(1, (os.cpu_count() or 1) // world_size)
+    if threads:
+        torch.set_num_threads(threads)
+
+
+def _synchronized_batches(dataloader, distributed):
+    """
+    流式分片大小不一，各 rank 的 batch 数可能不同；DDP 要求每步所有 rank 都参与 allreduce。
+    每步同步一次“是否还有数据”，任一 rank 读完则全体结束本 epoch。
+    """
+    it = iter(dataloader)
+    while True:
+        batch = next(it, None)
+        if distributed:
+            flag = torch.tensor([0 if batch is None else 1])
+            dist.all_reduce(flag, op=dist.ReduceOp.MIN)
+            if flag.item() == 0:
+                return
+        elif batch is None:
+            return
+        yield batch
+
+
+def train_model(config=None):
+    """训练模型
+
+    config: 覆盖 DEFAULT_TRAIN_CONFIG 的字典，例如
+      {'streaming': True}                     流式读取全量语料，不再受 max_samples 限制
+      {'pack': True}                          序列打包，减少 PAD 上的无效计算
+      {'precision': 'bf16', 'grad_accum_steps': 4}  混合精度 + 梯度累积
+      {'checkpoint_every': 500, 'resume': 'latest'} 每 500 步异步存检查点，并从最近的检查点续训
+
+    用 torchrun 或 launch_distributed 启动时自动进入数据并行模式：
+    每个 rank 读取自己的数据分片，只有 rank 0 打印日志和保存检查点。
+    """
+    cfg = _merge_config(config)
+    model_cfg = cfg['model_config']
+    max_seq_length = model_cfg['max_seq_length']
+
+    rank, world_size, local_rank, owns_group = _init_distributed(cfg)
+    distributed = world_size > 1
+    is_main = rank == 0
+    log = print if is_main else (lambda *args, **kwargs: None)
+    _set_rank_threads(cfg, world_size)
+
+    log("开始训练商品描述生成模型")
+    log("=" * 60)
     
-    # 创建数据集（使用部分数据以适应显存）
-    dataset = ItemDescDataset(
-        data_path, 
-        tokenizer, 
-        max_seq_length=64,
-        max_samples=50000  # 使用5万样本训练
-    )
+    # 设置设备
+    if torch.cuda.is_available():
+        device = torch.device('cuda', local_rank) if distributed else torch.device('cuda')
+    else:
+        device = torch.device('cpu')
+    log(f"使用设备: {device}" + (f"，数据并行 {world_size} 进程（{cfg['backend']}）" if distributed else ""))
+    # 所有 rank 同一个种子，保证模型初始化一致
+    torch.manual_seed(cfg['seed'])
     
-    # 数据加载器
-    dataloader = DataLoader(
-        dataset, 
-        batch_size=16,  # 小批次以适应显存
-        shuffle=True, 
-        num_workers=0
-    )
+    # 数据集路径
+    data_path = cfg['data_path']
+    ckpt_dir = cfg['checkpoint_dir']
+
+    # 续训：'latest' 取检查点目录中步数最大的，否则视为检查点路径
+    resume_state = None
+    if cfg['resume']:
+        resume_path = find_latest_checkpoint(ckpt_dir) if cfg['resume'] == 'latest' else cfg['resume']
+        if resume_path is None:
+            raise FileNotFoundError(f"检查点目录中没有可续训的检查点: {ckpt_dir}")
+        resume_state = load_checkpoint(resume_path)
+        log(f"从检查点续训: {resume_path}（step {resume_state['step']}）")
+    
+    # 先构建词汇表（使用部分数据；各 rank 读取相同的前 N 行，词表一致）
+    log("构建词汇表...")
+    tokenizer, sample_pairs = _build_tokenizer(data_path, cfg['vocab_size'], cfg['vocab_lines'])
+    if resume_state is not None:
+        # 续训必须沿用原词表
+        tokenizer = load_checkpoint(os.path.join(os.path.dirname(resume_path), 'tokenizer.pth'))
+    vocab_size = len(tokenizer.vocab)
+    log(f"词汇表大小: {vocab_size}")
+    
+    batch_size = cfg['batch_size']
+    sampler = None
+    # DataLoader 每次建迭代器都会抽一个随机种子；用独立的生成器，避免扰动续训时恢复的全局随机状态
+    loader_generator = torch.Generator()
+    loader_generator.manual_seed(cfg['seed'])
+    if cfg['streaming']:
+        # 流式读取全量语料：按字节偏移分给各 rank / worker，shuffle buffer 近似打乱
+        dataset = StreamingItemDescDataset(
+            data_path,
+            tokenizer,
+            max_seq_length=max_seq_length,
+            shuffle_buffer=cfg['shuffle_buffer'],
+            seed=cfg['seed'],
+            rank=rank,
+            world_size=world_size,
+            pack=cfg['pack'],
+            split='train',
+            eval_fraction=cfg['eval_fraction']
+        )
+        num_workers = max(cfg['num_workers'], 1)
+        dataloader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers,
+                                generator=loader_generator)
+        num_samples = int(count_corpus_samples(data_path) * (1 - cfg['eval_fraction'])) // world_size
+        num_rows = num_samples
+        if cfg['pack']:
+            # 打包后的行数只能估计（仅影响进度条与学习率调度的 T_max）
+            num_rows = math.ceil(num_samples * _estimate_pack_ratio(tokenizer, sample_pairs[:2000], max_seq_length))
+        steps_per_epoch = math.ceil(num_rows / batch_size)
+    else:
+        # 创建数据集（使用部分数据以适应内存）
+        dataset = ItemDescDataset(
+            data_path,
+            tokenizer,
+            max_seq_length=max_seq_length,
+            max_samples=cfg['max_samples'],
+            pack=cfg['pack'],
+            split='train',
+            eval_fraction=cfg['eval_fraction']
+        )
+        # 分布式时把样本均分给各 rank（不足时补齐），保证各 rank 步数相同；顺序可复现，便于续训
+        sampler = ResumableSampler(dataset, rank=rank, world_size=world_size, shuffle=True, seed=cfg['seed'])
+        dataloader = DataLoader(
+            dataset,
+            batch_size=batch_size,
+            sampler=sampler,
+            num_workers=cfg['num_workers'],
+            generator=loader_generator
+        )
+        num_samples = sampler.num_samples  # 每个 rank 分到的样本数（含补齐）
+        steps_per_epoch = len(dataloader)
     
     # 创建模型
-    model = LightweightTransformer(
-        vocab_size=vocab_size,
-        d_model=256,      # 较小的模型维度
-        nhead=8,
-        num_layers=4,     # 较少的层数
-        dim_feedforward=512,
-        dropout=0.1,
-        max_seq_length=64
-    )
+    model = LightweightTransformer(vocab_size=vocab_size, **model_cfg)
     model = model.to(device)
+    if resume_state is not None:
+        model.load_state_dict(resume_state['model_state_dict'])
+    if cfg['compile']:
+        model = torch.compile(model)
+    if distributed:
+        model = DistributedDataParallel(model, device_ids=[device.index] if device.type == 'cuda' else None)
     
     # ---- 关键点1：损失忽略 -100（我们会把 PAD 的 label 设为 -100）----
     criterion = nn.CrossEntropyLoss(ignore_index=-100)
-    optimizer = optim.AdamW(model.parameters(), lr=1e-4, weight_decay=0.01)
+    optimizer = optim.AdamW(model.parameters(), lr=cfg['lr'], weight_decay=cfg['weight_decay'])
 
-    num_epochs = 5
-    total_steps = len(dataloader) * num_epochs
-    # ---- 关键点2：CosineAnnealingLR 的 T_max 用总 step 数 ----
+    num_epochs = cfg['num_epochs']
+    accum = cfg['grad_accum_steps']
+    # ---- 关键点2：CosineAnnealingLR 的 T_max 用总“优化器”步数（梯度累积后） ----
+    # 各 rank 的 steps_per_epoch 相同，调度器同步前进
+    total_steps = math.ceil(steps_per_epoch / accum) * num_epochs
     scheduler = optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=total_steps)
+
+    precision = cfg['precision']
+    scaler = _create_grad_scaler(device, precision)
+
+    # 恢复优化器 / 调度器 / 随机数 / 数据位置
+    start_epoch, start_batch, global_step = 0, 0, 0
+    if resume_state is not None:
+        optimizer.load_state_dict(resume_state['optimizer_state_dict'])
+        scheduler.load_state_dict(resume_state['scheduler_state_dict'])
+        scaler.load_state_dict(resume_state['scaler_state_dict'])
+        restore_rng_state(resume_state['rng_state'])
+        start_epoch = resume_state['epoch']
+        start_batch = resume_state['batches_seen']
+        global_step = resume_state['step']
+        if cfg['streaming']:
+            dataset.load_state_dict(resume_state['data_state'])
+
+    # 只有 rank 0 写检查点；分词器只写一次，不再随每个检查点重复序列化
+    checkpointer = None
+    if is_main:
+        checkpointer = AsyncCheckpointer(ckpt_dir, keep_last=cfg['keep_last'])
+        checkpointer.save_artifact('tokenizer.pth', tokenizer)
+
+    def train_state(epoch, batches_seen):
+        """当前完整训练状态（只在优化器更新之后调用，此时没有残留梯度）"""
+        state = {
+            'step': global_step,
+            'epoch': epoch,
+            'batches_seen': batches_seen,
+            'model_state_dict': _unwrap_model(model).state_dict(),
+            'optimizer_state_dict': optimizer.state_dict(),
+            'scheduler_state_dict': scheduler.state_dict(),
+            'scaler_state_dict': scaler.state_dict(),
+            'rng_state': capture_rng_state(),
+            'vocab_size': vocab_size,
+            'model_config': dict(model_cfg),
+            'train_config': cfg,
+        }
+        if cfg['streaming']:
+            state['data_state'] = dict(dataset.state_dict(batches_seen, batch_size, num_workers), epoch=epoch)
+        return state
     
-    print(f"模型参数量: {sum(p.numel() for p in model.parameters()):,}")
-    print(f"批次大小: 16")
-    print(f"学习率: 1e-4")
-    print(f"训练样本: {len(dataset)}")
-    print()
+    # 验证集只在 rank 0 上评估（其他 rank 在下一次 allreduce 处等待）
+    eval_loader = None
+    if is_main and cfg['eval_in_training'] and cfg['eval_fraction'] > 0:
+        eval_loader = _build_eval_loader(cfg, tokenizer)
+        if eval_loader is None:
+            log("警告: 验证集为空，训练中不做评估")
+
+    def run_eval():
+        result = evaluate_perplexity(model, eval_loader, device, precision)
+        tqdm.write(f"[eval] step {global_step}: " + _format_eval(result))
+        return result
+
+    log(f"模型参数量: {sum(p.numel() for p in model.parameters()):,}")
+    log(f"批次大小: {batch_size} x 累积 {accum} x {world_size} 进程 = 有效批次 {batch_size * accum * world_size}")
+    log(f"学习率: {cfg['lr']}")
+    log(f"精度: {precision}")
+    log(f"训练样本: {num_samples}" + (" / rank" if distributed else ""))
+    log()
     
+    # 分阶段计时 / 轨迹抓取（关闭时是空操作）
+    profiler = StepProfiler(
+        device,
+        report_every=cfg['profile_every'] if is_main else 0,
+        trace_steps=cfg['profile_trace_steps'] if is_main else None,
+        trace_path=cfg['profile_trace_path'],
+        log=tqdm.write,
+    )
+
     # 训练循环
     model.train()
+    optimizer.zero_grad(set_to_none=True)
 
-    max_len = 64
-    ignore_index = -100
-
-    for epoch in range(num_epochs):
+    for epoch in range(start_epoch, num_epochs):
         total_loss = 0.0
-        progress_bar = tqdm(dataloader, desc=f'Epoch {epoch+1}/{num_epochs}')
+        num_batches = 0
+        real_tokens = 0
+        total_slots = 0
+        epoch_start = time.perf_counter()
+        # 续训的那个 epoch 从 start_batch 继续，之后的 epoch 从头开始
+        skip = start_batch if epoch == start_epoch else 0
+        if cfg['streaming']:
+            dataset.set_epoch(epoch)
+        if sampler is not None:
+            sampler.set_epoch(epoch)
+            sampler.set_start(skip * batch_size)
+        batches = profiler.wrap_loader(_synchronized_batches(dataloader, distributed and cfg['streaming']))
+        progress_bar = tqdm(batches, desc=f'Epoch {epoch+1}/{num_epochs}', total=steps_per_epoch,
+                            initial=skip, disable=not is_main)
 
-        for batch_idx, batch in enumerate(progress_bar):
-            # ✅ 这里直接解包数据集返回的三件套
-            input_ids, labels, key_padding_mask = batch  # (B, L), (B, L), (B, L)
+        for batch_idx, batch in enumerate(progress_bar, start=skip):
+            # 梯度累积的中间 micro-batch 不做 allreduce，只在更新前同步一次
+            step_now = (batch_idx + 1) % accum == 0
+            sync = model.no_sync() if distributed and not step_now else contextlib.nullcontext()
 
-            input_ids = input_ids.to(device)
-            labels = labels.to(device)
-            key_padding_mask = key_padding_mask.to(device)
+            with sync:
+                # 前向 & 损失（三件套 / 打包五件套都在 _lm_forward 里处理）
+                with profiler.phase('forward'):
+                    with _autocast_context(device, precision):
+                        logits, labels, n_tokens = _lm_forward(model, batch, device)
 
-            # 因果 mask（上三角为 True）
-            L = input_ids.size(1)
-            causal_mask = torch.triu(
-                torch.ones(L, L, device=device, dtype=torch.bool),
-                diagonal=1
-            )
-
-            # 前向 & 损失
-            logits = model(
-                input_ids,
-                src_mask=causal_mask,
-                src_key_padding_mask=key_padding_mask
-            )  # (B, L, V)
-
-            loss = criterion(
-                logits.reshape(-1, vocab_size),
-                labels.reshape(-1)
-            )
+                    # 损失在 fp32 下计算，避免低精度 softmax 的数值误差
+                    loss = criterion(
+                        logits.float().reshape(-1, vocab_size),
+                        labels.reshape(-1)
+                    )
 
-            # 反向传播
-            optimizer.zero_grad(set_to_none=True)
-            loss.backward()
-            torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
-            optimizer.step()
-            scheduler.step()
+                # 反向传播：累积 accum 个 micro-batch 后再更新一次参数
+                with profiler.phase('backward'):
+                    scaler.scale(loss / accum).backward()
+            if step_now:
+                with profiler.phase('optimizer'):
+                    _optimizer_step(model, optimizer, scheduler, scaler, cfg['max_grad_norm'])
+                global_step += 1
+                if eval_loader is not None and cfg['eval_every'] and global_step % cfg['eval_every'] == 0:
+                    run_eval()
+                # 按步数间隔异步保存（快照后立即继续训练）
+                if checkpointer is not None and cfg['checkpoint_every'] and global_step % cfg['checkpoint_every'] == 0:
+                    checkpointer.save(train_state(epoch, batch_idx + 1), global_step)
 
             total_loss += float(loss.item())
+            num_batches += 1
+            real_tokens += n_tokens
+            total_slots += labels.numel()
             progress_bar.set_postfix({'loss': f'{loss.item():.4f}'})
+            profiler.step_end(batch[0].size(0), n_tokens)
 
-        avg_loss = total_loss / len(dataloader)
-        print(f'Epoch {epoch+1}/{num_epochs}, Average Loss: {avg_loss:.4f}')
+        # epoch 末尾不足 accum 的残余梯度也要用掉（上一个 micro-batch 未同步，这里补一次 allreduce）；
+        # 每个 micro-batch 的损失按 1/accum 缩放过，这里按实际累积的个数重新取平均
+        n_accumulated = (skip + num_batches) % accum
+        if n_accumulated:
+            rescale = accum / n_accumulated / (world_size if distributed else 1)
+            for p in model.parameters():
+                if p.grad is not None:
+                    if distributed:
+                        dist.all_reduce(p.grad)
+                    p.grad.mul_(rescale)
+            _optimizer_step(model, optimizer, scheduler, scaler, cfg['max_grad_norm'])
+            global_step += 1
 
-        # 每个 epoch 后做一次生成测试
-        test_generation(model, tokenizer, device)
+        elapsed = time.perf_counter() - epoch_start
+        if distributed:
+            # 汇总所有 rank 的损失与 token 数，日志反映全局吞吐
+            stats = torch.tensor([total_loss, num_batches, real_tokens, total_slots], dtype=torch.float64)
+            dist.all_reduce(stats)
+            total_loss, num_batches, real_tokens, total_slots = stats.tolist()
+        avg_loss = total_loss / max(num_batches, 1)
+        log(f'Epoch {epoch+1}/{num_epochs}, Average Loss: {avg_loss:.4f}')
+        log(f'有效 token/s: {real_tokens / max(elapsed, 1e-9):,.0f}, '
+            f'PAD 比例: {1 - real_tokens / max(total_slots, 1):.2%}')
 
-        # 保存检查点（训练已稳定时）
-        checkpoint = {
-            'epoch': epoch,
+        if is_main:
+            if eval_loader is not None:
+                run_eval()
+            # 逐 token 采样很慢，默认关闭，需要肉眼检查生成效果时再打开
+            if cfg['generation_test']:
+                test_generation(_unwrap_model(model), tokenizer, device)
+
+            # epoch 结束的检查点：位置记为下一个 epoch 的开头
+            path = checkpointer.save(train_state(epoch + 1, 0), global_step)
+            print(f"检查点已提交后台保存: {path}")
+
+    profiler.close()
+    model = _unwrap_model(model)
+    if is_main:
+        checkpointer.wait()
+
+        # 保存最终模型
+        final_checkpoint = {
             'model_state_dict': model.state_dict(),
-            'optimizer_state_dict': optimizer.state_dict(),
-            'loss': avg_loss,
             'vocab_size': vocab_size,
             'tokenizer': tokenizer,
-            'model_config': {
-                'd_model': 256,
-                'nhead': 8,
-                'num_layers': 4,
-                'dim_feedforward': 512,
-                'dropout': 0.1,
-                'max_seq_length': 64
-            }
+            'model_config': dict(model_cfg)
         }
-        torch.save(checkpoint, f'item_desc_model_epoch_{epoch+1}.pth')
-        print(f"检查点已保存: item_desc_model_epoch_{epoch+1}.pth")
+        torch.save(final_checkpoint, 'item_desc_model_final.pth')
+        print("最终模型已保存: item_desc_model_final.pth")
 
-    
-    # 保存最终模型
-    final_checkpoint = {
-        'model_state_dict': model.state_dict(),
-        'vocab_size': vocab_size,
-        'tokenizer': tokenizer,
-        'model_config': checkpoint['model_config']
-    }
-    torch.save(final_checkpoint, 'item_desc_model_final.pth')
-    print("最终模型已保存: item_desc_model_final.pth")
+    if owns_group:
+        dist.destroy_process_group()
     
     return model, tokenizer
 
 
+def _distributed_entry(rank, world_size, config):
+    """launch_distributed 的子进程入口：设置 torchrun 风格的环境变量后进入 train_model"""
+    os.environ['RANK'] = str(rank)
+    os.environ['LOCAL_RANK'] = str(rank)
+    os.environ['WORLD_SIZE'] = str(world_size)
+    train_model(config)
+
+
+def launch_distributed(config=None, nproc=2):
+    """单机多进程数据并行训练（等价于 torchrun --nproc_per_node=nproc item_desc_train.py）"""
+    import torch.multiprocessing as mp
+
+    cfg = _merge_config(config)
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', str(cfg['master_port']))
+    mp.spawn(_distributed_entry, args=(nproc, config), nprocs=nproc, join=True)
+
+
 def test_generation(model, tokenizer, device, test_cases=None):
     """测试文本生成"""
     if test_cases is None:
@@ -427,29 +1024,54 @@ def test_generation(model, tokenizer, device, test_cases=None):
             print(f"生成错误: {e}")
     model.train()
 
-def load_trained_model(model_path='item_desc_model_final.pth'):
-    """加载训练好的模型"""
+def watch_checkpoints(config=None, poll_interval=60, once=False):
+    """
+    独立的评估进程：轮询检查点目录，对每个新出现的 ckpt_step_*.pth 计算验证集困惑度，
+    结果追加到 checkpoint_dir/eval_log.jsonl（重启后跳过已评估的步数）。
+    训练时设 eval_in_training=False，评估就完全不占用训练进程的时间。
+    config 需与训练时一致（数据路径、eval_fraction 决定验证集）；once=True 时评估完现有检查点即退出。
+    """
+    cfg = _merge_config(config)
+    ckpt_dir = cfg['checkpoint_dir']
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    
-    if not os.path.exists(model_path):
-        raise FileNotFoundError(f"模型文件不存在: {model_path}")
-    
-    checkpoint = torch.load(model_path, map_location=device)
-    
-    # 创建模型
-    model = LightweightTransformer(
-        vocab_size=checkpoint['vocab_size'],
-        **checkpoint['model_config']
-    )
-    
-    model.load_state_dict(checkpoint['model_state_dict'])
-    model = model.to(device)
-    model.eval()
-    
-    tokenizer = checkpoint['tokenizer']
-    
-    print(f"模型已加载: {model_path}")
-    return model, tokenizer, device
+    log_path = os.path.join(ckpt_dir, 'eval_log.jsonl')
+
+    done = set()
+    if os.path.exists(log_path):
+        with open(log_path, 'r', encoding='utf-8') as f:
+            done = {json.loads(line)['step'] for line in f if line.strip()}
+
+    print(f"监视检查点目录: {ckpt_dir}（每 {poll_interval}s 轮询一次，已评估 {len(done)} 个）")
+    eval_loader = None
+    while True:
+        tokenizer_path = os.path.join(ckpt_dir, 'tokenizer.pth')
+        if eval_loader is None and os.path.exists(tokenizer_path):
+            eval_loader = _build_eval_loader(cfg, load_checkpoint(tokenizer_path))
+            if eval_loader is None:
+                raise ValueError("验证集为空，请检查 data_path / eval_fraction")
+
+        if eval_loader is not None:
+            for step, path in list_checkpoints(ckpt_dir):
+                if step in done:
+                    continue
+                try:
+                    checkpoint = load_checkpoint(path)
+                except FileNotFoundError:
+                    # 已被 keep_last 清理掉
+                    continue
+                block_type = checkpoint['model_config'].get('block_type', 'sdpa')
+                model = build_model_from_checkpoint(checkpoint, block_type=block_type).to(device)
+                result = evaluate_perplexity(model, eval_loader, device, cfg['precision'])
+                print(f"[eval] step {step}: " + _format_eval(result))
+
+                with open(log_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(dict(result, step=step, epoch=checkpoint['epoch'])) + '\n')
+                done.add(step)
+
+        if once:
+            return
+        time.sleep(poll_interval)
+
 
 def interactive_demo():
     """交互式演示"""
@@ -482,9 +1104,386 @@ def interactive_demo():
     except Exception as e:
         print(f"加载模型时出错: {e}")
 
+def benchmark_packing(data_path, num_steps=30, batch_size=16, max_seq_length=64, max_samples=20000):
+    """
+    对比普通 padding 与序列打包的训练吞吐：
+    输出每种模式的 PAD 比例和有效 token/s（只统计非 PAD token）。
+    """
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    tokenizer = TextTokenizer(vocab_size=20000)
+    texts = []
+    with _open_corpus(data_path) as f:
+        for i, line in enumerate(f):
+            pair = _parse_item_line(line)
+            if pair:
+                texts.extend(pair)
+            if i >= 10000:
+                break
+    tokenizer.build_vocab(texts)
+    vocab_size = len(tokenizer.vocab)
+    criterion = nn.CrossEntropyLoss(ignore_index=-100)
+
+    print("序列打包基准测试")
+    print("=" * 60)
+    results = {}
+    for pack in (False, True):
+        torch.manual_seed(0)
+        dataset = ItemDescDataset(data_path, tokenizer, max_seq_length=max_seq_length,
+                                  max_samples=max_samples, pack=pack)
+        dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=0)
+        model = LightweightTransformer(vocab_size=vocab_size, max_seq_length=max_seq_length).to(device)
+        optimizer = optim.AdamW(model.parameters(), lr=1e-4)
+        model.train()
+
+        real_tokens = total_slots = steps = 0
+        elapsed = 0.0
+        for batch in dataloader:
+            start = time.perf_counter()
+            logits, labels, n_tokens = _lm_forward(model, batch, device)
+            loss = criterion(logits.reshape(-1, vocab_size), labels.reshape(-1))
+            optimizer.zero_grad(set_to_none=True)
+            loss.backward()
+            optimizer.step()
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            # 第一步包含初始化开销，不计入
+            if steps > 0:
+                elapsed += time.perf_counter() - start
+                real_tokens += n_tokens
+                total_slots += labels.numel()
+            steps += 1
+            if steps > num_steps:
+                break
+
+        name = '打包' if pack else '普通'
+        results[name] = {
+            'pad_ratio': 1 - real_tokens / max(total_slots, 1),
+            'tokens_per_sec': real_tokens / max(elapsed, 1e-9),
+        }
+        print(f"{name}: PAD 比例 {results[name]['pad_ratio']:.2%}, "
+              f"有效 token/s {results[name]['tokens_per_sec']:,.0f}")
+
+    speedup = results['打包']['tokens_per_sec'] / max(results['普通']['tokens_per_sec'], 1e-9)
+    print(f"有效吞吐提升: {speedup:.2f}x")
+    return results
+
+def _benchmark_step_worker(cfg, vocab_size, num_steps, queue):
+    """在独立进程里跑若干训练步，返回平均步耗时与峰值内存（进程隔离保证峰值互不干扰）"""
+    import resource
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(cfg['seed'])
+    model_cfg = cfg['model_config']
+    seq_len = model_cfg['max_seq_length']
+    model = LightweightTransformer(vocab_size=vocab_size, **model_cfg).to(device)
+    model.train()
+    criterion = nn.CrossEntropyLoss(ignore_index=-100)
+    optimizer = optim.AdamW(model.parameters(), lr=cfg['lr'])
+    scheduler = optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=num_steps)
+    scaler = _create_grad_scaler(device, cfg['precision'])
+    accum = cfg['grad_accum_steps']
+
+    # 随机 token 构造定长 batch，只测模型本身的计算与显存
+    ids = torch.randint(5, vocab_size, (cfg['batch_size'], seq_len))
+    batch = (ids, torch.roll(ids, -1, dims=1), torch.zeros_like(ids, dtype=torch.bool))
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+
+    times = []
+    for step in range(num_steps + 1):
+        start = time.perf_counter()
+        for _ in range(accum):
+            with _autocast_context(device, cfg['precision']):
+                logits, labels, _ = _lm_forward(model, batch, device)
+            loss = criterion(logits.float().reshape(-1, vocab_size), labels.reshape(-1))
+            scaler.scale(loss / accum).backward()
+        _optimizer_step(model, optimizer, scheduler, scaler, cfg['max_grad_norm'])
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        # 第一步包含初始化开销，不计入
+        if step > 0:
+            times.append(time.perf_counter() - start)
+
+    if device.type == 'cuda':
+        peak_mb = torch.cuda.max_memory_allocated() / 2 ** 20
+    else:
+        peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # Linux 下单位为 KB
+    queue.put({'step_ms': 1000 * sum(times) / len(times), 'peak_mb': peak_mb})
+
+
+def benchmark_precision(config=None, precisions=('fp32', 'bf16'), num_steps=20, vocab_size=20000):
+    """
+    对比不同精度下一次优化器更新的耗时与峰值内存（CPU 为进程峰值 RSS，CUDA 为峰值显存）。
+    每种精度在独立的 spawn 子进程里运行。
+    """
+    import multiprocessing as mp
+
+    cfg = _merge_config(config)
+    ctx = mp.get_context('spawn')
+    print("混合精度基准测试")
+    print("=" * 60)
+    print(f"micro-batch {cfg['batch_size']} x 累积 {cfg['grad_accum_steps']}, "
+          f"序列长度 {cfg['model_config']['max_seq_length']}")
+
+    results = {}
+    for precision in precisions:
+        run_cfg = dict(cfg, precision=precision)
+        queue = ctx.Queue()
+        proc = ctx.Process(target=_benchmark_step_worker, args=(run_cfg, vocab_size, num_steps, queue))
+        proc.start()
+        results[precision] = queue.get()
+        proc.join()
+        print(f"{precision}: 每步 {results[precision]['step_ms']:.1f} ms, "
+              f"峰值内存 {results[precision]['peak_mb']:.0f} MB")
+
+    base = results[precisions[0]]
+    for precision in precisions[1:]:
+        r = results[precision]
+        print(f"{precision} 相对 {precisions[0]}: 步耗时 {base['step_ms'] / r['step_ms']:.2f}x 加速, "
+              f"峰值内存 {r['peak_mb'] - base['peak_mb']:+.0f} MB")
+    return results
+
+def _scaling_worker(rank, world_size, cfg, vocab_size, num_steps, queue):
+    """数据并行扩展性测试的子进程：随机 token 跑若干步，rank 0 回报全局 token/s"""
+    if world_size > 1:
+        dist.init_process_group(backend=cfg['backend'], init_method='env://', rank=rank, world_size=world_size)
+    _set_rank_threads(cfg, world_size)
+    torch.manual_seed(cfg['seed'])
+
+    device = torch.device('cpu')
+    seq_len = cfg['model_config']['max_seq_length']
+    model = LightweightTransformer(vocab_size=vocab_size, **cfg['model_config'])
+    if world_size > 1:
+        model = DistributedDataParallel(model)
+    model.train()
+    criterion = nn.CrossEntropyLoss(ignore_index=-100)
+    optimizer = optim.AdamW(model.parameters(), lr=cfg['lr'])
+    scheduler = optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=num_steps)
+    scaler = _create_grad_scaler(device, cfg['precision'])
+
+    ids = torch.randint(5, vocab_size, (cfg['batch_size'], seq_len))
+    batch = (ids, torch.roll(ids, -1, dims=1), torch.zeros_like(ids, dtype=torch.bool))
+
+    for step in range(num_steps + 1):
+        # 第一步包含初始化与 DDP bucket 构建开销，不计入
+        if step == 1:
+            if world_size > 1:
+                dist.barrier()
+            start = time.perf_counter()
+        with _autocast_context(device, cfg['precision']):
+            logits, labels, _ = _lm_forward(model, batch, device)
+        loss = criterion(logits.float().reshape(-1, vocab_size), labels.reshape(-1))
+        scaler.scale(loss).backward()
+        _optimizer_step(model, optimizer, scheduler, scaler, cfg['max_grad_norm'])
+    if world_size > 1:
+        dist.barrier()
+    elapsed = time.perf_counter() - start
+
+    if rank == 0:
+        queue.put(cfg['batch_size'] * seq_len * world_size * num_steps / elapsed)
+    if world_size > 1:
+        dist.destroy_process_group()
+
+
+def benchmark_ddp_scaling(config=None, nprocs=(1, 2, 4), num_steps=10, vocab_size=20000):
+    """
+    数据并行扩展性报告：不同进程数下的全局 token/s 与扩展效率（相对单进程的线性加速比）。
+    每个进程使用固定的 micro-batch（弱扩展），CPU 核在进程间均分。
+    """
+    import torch.multiprocessing as mp
+
+    cfg = _merge_config(config)
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    ctx = mp.get_context('spawn')
+    print("数据并行扩展性测试")
+    print("=" * 60)
+    print(f"CPU 核数: {os.cpu_count()}, 每进程 micro-batch {cfg['batch_size']}, "
+          f"序列长度 {cfg['model_config']['max_seq_length']}, 后端 {cfg['backend']}")
+
+    results = {}
+    for n in nprocs:
+        queue = ctx.Queue()
+        # 每次换一个端口，避免上一轮进程组的端口尚未释放
+        os.environ['MASTER_PORT'] = str(cfg['master_port'] + n)
+        mp.spawn(_scaling_worker, args=(n, cfg, vocab_size, num_steps, queue), nprocs=n, join=True)
+        results[n] = queue.get()
+
+    base = results[nprocs[0]] / nprocs[0]
+    print(f"{'进程数':>6} {'token/s':>12} {'加速比':>8} {'扩展效率':>8}")
+    for n, tps in results.items():
+        print(f"{n:>6} {tps:>12,.0f} {tps / results[nprocs[0]]:>8.2f} {tps / (base * n):>8.0%}")
+    return results
+
+
+def _decode_tokens_per_sec(model, prompt_len, gen_tokens, vocab_size):
+    """逐 token 贪心解码的吞吐；sdpa 走 KV cache，encoder 每步重算整个前缀"""
+    model.eval()
+    ids = torch.randint(5, vocab_size, (1, prompt_len))
+    with torch.no_grad():
+        start = time.perf_counter()
+        past = None
+        for _ in range(gen_tokens):
+            if model.block_type == 'sdpa':
+                step_input = ids if past is None else ids[:, -1:]
+                logits, past = model(step_input, is_causal=True, past_key_values=past, use_cache=True)
+            else:
+                logits = model(ids, is_causal=True)
+            ids = torch.cat([ids, logits[:, -1:].argmax(dim=-1)], dim=1)
+        elapsed = time.perf_counter() - start
+    return gen_tokens / elapsed
+
+
+def benchmark_block_types(config=None, num_steps=10, prompt_len=8, gen_tokens=32,
+                          vocab_size=20000, compile=False):
+    """
+    对比旧 nn.TransformerEncoder 与 SDPA 解码块：
+    - 训练：定长随机 batch 的 token/s（前向 + 反向 + 更新）
+    - 推理：单条逐 token 解码的 token/s
+    compile=True 时额外测试 torch.compile 后的 sdpa。
+    """
+    cfg = _merge_config(config)
+    device = torch.device('cpu')
+    seq_len = cfg['model_config']['max_seq_length']
+    variants = [('encoder', False), ('sdpa', False)] + ([('sdpa', True)] if compile else [])
+
+    print("注意力实现基准测试")
+    print("=" * 60)
+    results = {}
+    for block_type, use_compile in variants:
+        name = block_type + ('+compile' if use_compile else '')
+        torch.manual_seed(cfg['seed'])
+        model_cfg = dict(cfg['model_config'], block_type=block_type)
+        model = LightweightTransformer(vocab_size=vocab_size, **model_cfg).to(device)
+        runner = torch.compile(model) if use_compile else model
+        criterion = nn.CrossEntropyLoss(ignore_index=-100)
+        optimizer = optim.AdamW(model.parameters(), lr=cfg['lr'])
+
+        ids = torch.randint(5, vocab_size, (cfg['batch_size'], seq_len))
+        batch = (ids, torch.roll(ids, -1, dims=1), torch.zeros_like(ids, dtype=torch.bool))
+        runner.train()
+        for step in range(num_steps + 1):
+            # 第一步包含初始化 / 编译开销，不计入
+            if step == 1:
+                start = time.perf_counter()
+            logits, labels, _ = _lm_forward(runner, batch, device)
+            loss = criterion(logits.reshape(-1, vocab_size), labels.reshape(-1))
+            optimizer.zero_grad(set_to_none=True)
+            loss.backward()
+            optimizer.step()
+        train_tps = cfg['batch_size'] * seq_len * num_steps / (time.perf_counter() - start)
+
+        decode_tps = _decode_tokens_per_sec(model, prompt_len, gen_tokens, vocab_size)
+        results[name] = {'train_tokens_per_sec': train_tps, 'decode_tokens_per_sec': decode_tps}
+        print(f"{name:>14}: 训练 {train_tps:>10,.0f} token/s, 解码 {decode_tps:>8,.1f} token/s")
+
+    base = results['encoder']
+    for name, r in results.items():
+        if name != 'encoder':
+            print(f"{name} 相对 encoder: 训练 {r['train_tokens_per_sec'] / base['train_tokens_per_sec']:.2f}x, "
+                  f"解码 {r['decode_tokens_per_sec'] / base['decode_tokens_per_sec']:.2f}x")
+    return results
+
+
+def benchmark_embedding_variants(config=None, embedding_rank=64, prompt_len=8, gen_tokens=32, vocab_size=20000):
+    """
+    对比词表相关的紧凑结构：参数量、序列化后的模型大小、单条逐 token 解码吞吐。
+    variants: 原结构 / 共享输出层 / 低秩分解 / 低秩 + 共享
+    """
+    cfg = _merge_config(config)
+    variants = [
+        ('baseline', {}),
+        ('tied', {'tie_embeddings': True}),
+        (f'rank{embedding_rank}', {'embedding_rank': embedding_rank}),
+        (f'rank{embedding_rank}+tied', {'embedding_rank': embedding_rank, 'tie_embeddings': True}),
+    ]
+
+    print("词嵌入结构基准测试")
+    print("=" * 60)
+    results = {}
+    for name, overrides in variants:
+        torch.manual_seed(cfg['seed'])
+        model_cfg = dict(cfg['model_config'], **overrides)
+        model = LightweightTransformer(vocab_size=vocab_size, **model_cfg)
+        params = sum(p.numel() for p in model.parameters())
+        buf = io.BytesIO()
+        torch.save(model.state_dict(), buf)
+        decode_tps = _decode_tokens_per_sec(model, prompt_len, gen_tokens, vocab_size)
+        results[name] = {'params': params, 'size_mb': buf.tell() / 2 ** 20, 'decode_tokens_per_sec': decode_tps}
+        print(f"{name:>14}: 参数 {params:>11,}, 模型 {results[name]['size_mb']:>6.1f} MB, 解码 {decode_tps:>8,.1f} token/s")
+    return results
+
+
+def benchmark_speculative(target_path='item_desc_model_final.pth', draft_path='item_desc_model_student.pth',
+                          queries=None, num_draft_tokens=(2, 4, 6), max_new_tokens=12, rounds=5,
+                          temperature=0.9, top_k=30, seed=0):
+    """
+    投机解码基准：与普通逐 token 解码对比生成吞吐，
+    并报告接受率（被目标模型接受的草稿 token 比例）与每个新 token 平均需要的目标模型前向次数。
+    """
+    queries = queries or ["智能手机", "连衣裙", "笔记本电脑", "运动鞋", "化妆品"]
+    target, tokenizer, _ = load_trained_model(target_path)
+    draft, draft_tokenizer, _ = load_trained_model(draft_path)
+    if draft_tokenizer.vocab != tokenizer.vocab:
+        raise ValueError("草稿模型与目标模型的词表不一致")
+
+    def run(draft_model=None, k=0):
+        torch.manual_seed(seed)
+        stats = {}
+        start = time.perf_counter()
+        for q in queries:
+            for _ in range(rounds):
+                target.generate(q, tokenizer, max_length=max_new_tokens, temperature=temperature, top_k=top_k,
+                                draft_model=draft_model, num_draft_tokens=k, stats=stats)
+        stats['tokens_per_sec'] = stats['new_tokens'] / (time.perf_counter() - start)
+        return stats
+
+    print("\n投机解码基准测试")
+    print("=" * 60)
+    run()  # 预热
+    base = run()
+    print(f"{'普通解码':>10}: {base['tokens_per_sec']:>8,.1f} token/s")
+    results = {'baseline': base}
+    for k in num_draft_tokens:
+        r = run(draft, k)
+        r['acceptance'] = r['accepted'] / max(r['drafted'], 1)
+        r['speedup'] = r['tokens_per_sec'] / base['tokens_per_sec']
+        results[k] = r
+        print(f"{f'草稿 k={k}':>10}: {r['tokens_per_sec']:>8,.1f} token/s, 接受率 {r['acceptance']:.1%}, "
+              f"目标前向 / token {r['target_calls'] / max(r['new_tokens'], 1):.2f}, 加速 {r['speedup']:.2f}x")
+    return results
+
+
 if __name__ == "__main__":
-    # 训练模型
-    trained_model, tokenizer = train_model()
-    
-    # 交互式演示
-    interactive_demo()
+    import argparse
+
+    parser = argparse.ArgumentParser(description="训练商品描述生成模型")
+    parser.add_argument('--config', help="JSON 训练配置文件，覆盖 DEFAULT_TRAIN_CONFIG")
+    parser.add_argument('--nproc', type=int, default=1, help="单机数据并行进程数（gloo 后端）")
+    parser.add_argument('--scaling-report', action='store_true', help="只跑数据并行扩展性测试")
+    parser.add_argument('--resume', nargs='?', const='latest', default=None,
+                        help="从检查点续训；不带参数时使用检查点目录中最新的一个")
+    parser.add_argument('--watch', action='store_true',
+                        help="不训练，只监视检查点目录并评估验证集困惑度（与训练使用相同的 --config）")
+    parser.add_argument('--poll-interval', type=float, default=60, help="--watch 的轮询间隔（秒）")
+    args = parser.parse_args()
+
+    config = {}
+    if args.config:
+        with open(args.config, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+    if args.resume:
+        config['resume'] = args.resume
+
+    if args.watch:
+        watch_checkpoints(config, poll_interval=args.poll_interval)
+    elif args.scaling_report:
+        benchmark_ddp_scaling(config)
+    elif args.nproc > 1:
+        launch_distributed(config, nproc=args.nproc)
+    else:
+        # 训练模型（torchrun 启动时每个进程都会走到这里，由 train_model 自动进入数据并行）
+        trained_model, tokenizer = train_model(config)
+
+        # 交互式演示（多进程训练时跳过）
+        if int(os.environ.get('WORLD_SIZE', 1)) <= 1:
+            interactive_demo()
@@ -5,79 +5,11 @@ import math
 import numpy as np
 from collections import Counter
 import re
-class TextTokenizer:
-    """简单的文本分词器"""
-    def __init__(self, vocab_size=10000):
-        self.vocab_size = vocab_size
-        self.vocab = {}
-        self.inverse_vocab = {}
-        self.special_tokens = {
-            '<PAD>': 0, '<SOS>': 1, '<EOS>': 2, '<UNK>': 3, '<SEP>': 4
-        }
-
-    def build_vocab(self, texts):
-        from collections import Counter
-        import re
-        words = []
-        for text in texts:
-            tokens = self._tokenize(text)
-            words.extend(tokens)
-        word_counts = Counter(words)
-        most_common = word_counts.most_common(self.vocab_size - len(self.special_tokens))
-        self.vocab = {**self.special_tokens}
-        self.inverse_vocab = {v: k for k, v in self.special_tokens.items()}
-        for i, (word, _) in enumerate(most_common, start=len(self.special_tokens)):
-            self.vocab[word] = i
-            self.inverse_vocab[i] = word
-
-    def _tokenize(self, text):
-        """更稳的中英混合分词：中文按字切，英文按词切，保留标点"""
-        import re
-        text = text.lower()
-        # 拆成：中文单字 | 英文/数字串 | 其他符号
-        tokens = re.findall(r'[\u4e00-\u9fff]|[a-z0-9]+|[^\w\s]', text)
-        return tokens
-
-    def encode(self, text, max_length=None, add_special=False, pad_to_max=False):
-        """
-        add_special: 是否在两端添加 <SOS>/<EOS>
-        pad_to_max : 是否把长度补到 max_length（只在给模型喂定长输入时用）
-        """
-        tokens = self._tokenize(text)
-        unk = self.special_tokens['<UNK>']
-        pad = self.special_tokens['<PAD>']
-        eos = self.special_tokens['<EOS>']
-        sos = self.special_tokens['<SOS>']
-
-        token_ids = [self.vocab.get(t, unk) for t in tokens]
-
-        if add_special:
-            token_ids = [sos] + token_ids + [eos]
-
-        if max_length is not None and pad_to_max:
-            if len(token_ids) > max_length:
-                # 截断时确保句尾有 EOS
-                token_ids = token_ids[:max_length]
-                if token_ids[-1] != eos and add_special:
-                    token_ids[-1] = eos
-            else:
-                token_ids = token_ids + [pad] * (max_length - len(token_ids))
-
-        return token_ids
-
-    def decode(self, token_ids, drop_special=True, stop_at_eos=True, concat_chinese=True):
-        """把 id 还原为文本，可选择过滤特殊符号"""
-        specials = set(self.special_tokens.values())
-        eos = self.special_tokens['<EOS>']
-        out = []
-        for tid in token_ids:
-            if stop_at_eos and tid == eos:
-                break
-            if drop_special and tid in specials:
-                continue
-            out.append(self.inverse_vocab.get(tid, ''))
-        # 中文建议不加空格
-        return ''.join(out) if concat_chinese else ' '.join(out)
+# 分词器与 SDPA 层在推理包里，这里重新导入保持旧的 from nlp_transformer import ... 可用
+# （已保存检查点里的分词器按 nlp_transformer.TextTokenizer 反序列化，也依赖这里的导入）
+from inference.tokenizer import TextTokenizer
+from inference.layers import (SDPASelfAttention, SDPATransformerLayer, SDPATransformer,
+                              convert_block_state_dict, build_transformer_stack)
 
 
 class PositionalEncoding(nn.Module):
@@ -99,29 +31,30 @@ class PositionalEncoding(nn.Module):
         x = x + self.pe[:, :x.size(1)]
         return x
 
+
 class LanguageModelTransformer(nn.Module):
-    """用于自然语言处理的Transformer语言模型"""
+    """用于自然语言处理的Transformer语言模型
+
+    block_type: 'sdpa'（默认，SDPATransformer）| 'encoder'（旧的 nn.TransformerEncoder）
+    """
     def __init__(self, vocab_size, d_model=512, nhead=8, 
-                 num_layers=6, dim_feedforward=2048, dropout=0.1, max_seq_length=512):
+                 num_layers=6, dim_feedforward=2048, dropout=0.1, max_seq_length=512,
+                 block_type='sdpa'):
         super(LanguageModelTransformer, self).__init__()
         
         self.d_model = d_model
+        self.nhead = nhead
         self.vocab_size = vocab_size
         self.max_seq_length = max_seq_length
+        self.block_type = block_type
         
         # 词嵌入和位置编码
         self.embedding = nn.Embedding(vocab_size, d_model)
         self.pos_encoder = PositionalEncoding(d_model, max_seq_length)
         
-        # Transformer编码器
-        encoder_layer = nn.TransformerEncoderLayer(
-            d_model=d_model,
-            nhead=nhead,
-            dim_feedforward=dim_feedforward,
-            dropout=dropout,
-            batch_first=True
-        )
-        self.transformer = nn.TransformerEncoder(encoder_layer, num_layers)
+        # Transformer层
+        self.transformer = build_transformer_stack(block_type, d_model, nhead, num_layers,
+                                                   dim_feedforward, dropout)
         
         # 输出层
         self.output_layer = nn.Linear(d_model, vocab_size)
@@ -137,14 +70,18 @@ class LanguageModelTransformer(nn.Module):
         self.output_layer.bias.data.zero_()
         self.output_layer.weight.data.uniform_(-initrange, initrange)
     
-    def forward(self, src, src_mask=None, src_key_padding_mask=None):
-        """前向传播"""
+    def forward(self, src, src_mask=None, src_key_padding_mask=None, is_causal=False):
+        """前向传播；is_causal=True 时按因果语言模型计算（不需要传上三角 mask）"""
         # 嵌入和位置编码
         src_emb = self.embedding(src) * math.sqrt(self.d_model)
         src_emb = self.pos_encoder(src_emb)
         
         # Transformer编码
-        output = self.transformer(src_emb, mask=src_mask, src_key_padding_mask=src_key_padding_mask)
+        if is_causal and src_mask is None and self.block_type == 'encoder':
+            L = src.size(1)
+            src_mask = torch.triu(torch.ones(L, L, device=src.device, dtype=torch.bool), diagonal=1)
+        output = self.transformer(src_emb, mask=src_mask, src_key_padding_mask=src_key_padding_mask,
+                                  is_causal=is_causal)
         
         # 输出预测
         output = self.output_layer(output)
@@ -162,8 +99,8 @@ class LanguageModelTransformer(nn.Module):
         
         with torch.no_grad():
             for _ in range(max_length):
-                # 前向传播
-                outputs = self(generated)
+                # 前向传播（因果）
+                outputs = self(generated, is_causal=True)
                 
                 # 获取最后一个时间步的预测
                 next_token_logits = outputs[0, -1, :] / temperature
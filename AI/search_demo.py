@@ -179,8 +179,8 @@ class InteractiveSearchDemo:
     
     def save_demo(self):
         """保存演示数据"""
-        self.search_engine.save_index('demo_search_index.pkl')
-        print("演示索引已保存到: demo_search_index.pkl")
+        self.search_engine.save_index('demo_search_index')
+        print("演示索引已保存到: demo_search_index")
 
 def demonstrate_complete_system():
     """演示完整的语义搜索系统"""
@@ -6,167 +6,33 @@ import uvicorn
 from typing import List, Optional
 from fastapi import FastAPI, Query, HTTPException
 from pydantic import BaseModel
-# ===== 在文件顶部 imports 附近补充 =====
-import re
-import jieba
-import jieba.posseg as pseg
-from collections import Counter
-
-# ===== 工具：清理文本，尽量只留“短词/短语”友好的字符 =====
-_CHINESE_RE = re.compile(r'[\u4e00-\u9fff]+')
-_ALNUM_RE   = re.compile(r'[a-z0-9]+', re.I)
-_PUNC_STRIP = " ，。,.、/|;；:：-—()（）[]【】~!@#$%^&*_+<>?:\"'\\"
-
-STOPWORDS = set([
-    # 口水/功能词，尽量别出现在联想里
-    "这款","采用","具有","无论是","可以","就是","整体","如果","以及","能够","支持",
-    "非常","比较","还是","的话","更加","进行","关于","以及","一种","一款","款式",
-])
-
-# 简单词性白名单（名词、形容词、专名、英文等）
-POS_WHITELIST = set(["n","nr","ns","nz","nt","eng","x","a","an","vn","vnf"])
-
-def _is_good_token(w, flag):
-    if not w:
-        return False
-    if w in STOPWORDS:
-        return False
-    # 纯标点/空白过滤
-    if not (_CHINESE_RE.search(w) or _ALNUM_RE.search(w)):
-        return False
-    # 词性过滤
-    if flag not in POS_WHITELIST:
-        # 允许纯数字/字母
-        if _ALNUM_RE.fullmatch(w):
-            return True
-        return False
-    # 单字允许，但更偏向 2-3 字
-    return True
-
-def _extract_keywords_cn(text: str, top_k=20):
-    """用 jieba 抽关键词（单词），只保留白名单词性。"""
-    words = []
-    for w, f in pseg.cut(text):
-        w = w.strip(_PUNC_STRIP).strip()
-        if _is_good_token(w, f):
-            words.append(w)
-    # 频次 + 长度微弱加成
-    cnt = Counter(words)
-    scored = sorted(cnt.items(), key=lambda x: (x[1], len(x[0])>=2, len(x[0])), reverse=True)
-    return [w for w,_ in scored[:top_k]]
-
-def _compose_bigrams(words, query):
-    """把相邻的关键词组成二元短语；优先包含 query 的短语。"""
-    bigrams = []
-    for i in range(len(words)-1):
-        a, b = words[i], words[i+1]
-        if a in STOPWORDS or b in STOPWORDS: 
-            continue
-        # 过滤太长的词拼接
-        if len(a) > 8 or len(b) > 8:
-            continue
-        phrase = a + b
-        # 控制总长度（中文 4~10 字）
-        if 2 <= len(phrase) <= 10:
-            bigrams.append(phrase)
-    # 排序：包含 query 的优先，然后按长度适中优先
-    q = (query or "").strip()
-    bigrams = sorted(set(bigrams), key=lambda s: (q and q in s, 4 <= len(s) <= 8, len(s)), reverse=True)
-    return bigrams
-
-# 放在工具函数区域（和 _extract_keywords_cn / _compose_bigrams 放一起）
-_PUNC_STRIP = " ，。,.、/|;；:：-—()（）[]【】~!@#$%^&*_+<>?:\"'\\"
-
-def _remove_query_from_phrase(phrase: str, query: str) -> str:
-    """把候选里的 query 去掉，只保留联想内容；兼顾中文的前缀重叠等情况。"""
-    if not phrase:
-        return ""
-    s = phrase.strip(_PUNC_STRIP).strip()
-    q = (query or "").strip()
-    if not q:
-        return s
-
-    # 1) 直接替换掉完整 query 出现的位置
-    s = s.replace(q, "")
-
-    # 2) 若依然以 query 的前缀开头（例如 tokenizer/抽词导致“智能手…”），去掉最长公共前缀（阈值≥2个字）
-    i = 0
-    m = min(len(s), len(q))
-    while i < m and s[i] == q[i]:
-        i += 1
-    if i >= 2:
-        s = s[i:]
-
-    # 3) 处理一些常见尾部重叠（例如 q 结尾“手机”，候选以“手机”开头）
-    for k in (q[-2:], q[-1:]):
-        if k and s.startswith(k):
-            s = s[len(k):]
-
-    return s.strip(_PUNC_STRIP).strip()
-
-def _postprocess_suggestions(raw_texts, query, max_chars=12, want_n=8, association_only=True):
-    """句子 -> 关键词集合（单词 + 二元短语）-> 清洗/去重/截断
-       association_only=True 时，把候选里的 query 部分去掉，只保留“联想内容”。
-    """
-    from collections import Counter
-
-    # 1) 先抽关键词
-    cand_words = []
-    for t in raw_texts:
-        t = (t or "").strip()
-        t = t.strip(_PUNC_STRIP)
-        if not t:
-            continue
-        cand_words.extend(_extract_keywords_cn(t, top_k=20))
-
-    # 2) bigram + 单词，优先和 query 相关的
-    bigrams = _compose_bigrams(cand_words, query)
-    q = (query or "").strip()
-    singles = list(dict.fromkeys([w for w in cand_words if (not q) or (q in w or w in q)]))
-
-    merged = bigrams + singles  # bigram 优先
-
-    # 3) 去掉 query，做清理与长度裁剪
-    cleaned = []
-    for s in merged:
-        s = s.strip(_PUNC_STRIP).strip()
-        if not s:
-            continue
-        if association_only:
-            s = _remove_query_from_phrase(s, q)
-        if not s or s == q:
-            continue
-        if len(s) > max_chars:
-            s = s[:max_chars]
-        # 避免只剩下标点/空白
-        if not s or all(ch in _PUNC_STRIP for ch in s):
-            continue
-        cleaned.append(s)
-
-    # 4) 去重、保序，取前 N
-    seen = set()
-    out = []
-    for s in cleaned:
-        if s in seen:
-            continue
-        seen.add(s)
-        out.append(s)
-        if len(out) >= want_n:
-            break
-    return out
-
-
-
+# 关键词抽取 / 清洗 / 后处理进程池在推理包里（jieba 按需加载），这里重新导入保持旧名字可用
+from inference import postprocess
+from inference.postprocess import (STOPWORDS, POS_WHITELIST, PostprocessPool, _extract_keywords_cn,
+                                   _extract_keywords, _compose_bigrams, _remove_query_from_phrase,
+                                   _postprocess_phrases, _postprocess_suggestions)
 
 # ========= 你自己的模型/分词器 =========
 # 如果这些类定义就在本文件，请直接粘贴进来；
 # 若在其他文件，请改成 from your_module import LightweightTransformer, TextTokenizer
-from nlp_transformer import TextTokenizer  # 你已有
-from item_desc_train import LightweightTransformer  # 如果类在当前文件，改为: from __main__ import LightweightTransformer
+from inference.tokenizer import TextTokenizer  # 你已有
+from inference.model import LightweightTransformer, build_model_from_checkpoint  # 只导入推理代码，不拉起训练依赖
+from checkpointing import load_checkpoint
+from catalog_lexicon import TokenTrie, AhoCorasick, load_lexicon
 
 # ========= 配置 =========
 MODEL_PATH = os.environ.get("MODEL_PATH", "item_desc_model_final.pth")
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+BLOCK_TYPE = os.environ.get("BLOCK_TYPE", "sdpa")  # 'sdpa'（融合注意力 + KV cache）| 'encoder'（旧结构）
+DRAFT_MODEL_PATH = os.environ.get("DRAFT_MODEL_PATH", "")  # 投机解码的草稿模型（同一分词器训练的小模型），留空不启用
+NUM_DRAFT_TOKENS = int(os.environ.get("NUM_DRAFT_TOKENS", "4"))  # 草稿模型每轮提议的 token 数
+LEXICON_PATH = os.environ.get("LEXICON_PATH", "")  # 商品短语词表（catalog_lexicon.py 生成），设置后启用约束解码
+CONSTRAINED_OVERSAMPLE = float(os.environ.get("CONSTRAINED_OVERSAMPLE", "1.5"))  # 约束解码时每条建议的生成次数
+KEYWORD_EXTRACTOR = os.environ.get("KEYWORD_EXTRACTOR", "jieba")  # 'jieba' | 'aho'（商品词表 Aho-Corasick 自动机）
+KEYWORD_LEXICON_PATH = os.environ.get("KEYWORD_LEXICON_PATH", LEXICON_PATH or "catalog_lexicon.txt")
+POSTPROCESS_WORKERS = int(os.environ.get("POSTPROCESS_WORKERS", "0"))  # 后处理子进程数，0 表示在请求线程里直接做
+POSTPROCESS_BATCH_SIZE = int(os.environ.get("POSTPROCESS_BATCH_SIZE", "16"))  # 每次提交给进程池的最多请求数
+POSTPROCESS_BATCH_WAIT_MS = float(os.environ.get("POSTPROCESS_BATCH_WAIT_MS", "2"))  # 攒批最多等待的毫秒数
 
 # ========= 全局对象 =========
 app = FastAPI(title="Suggest API", version="1.0.0")
@@ -174,25 +40,44 @@ model = None
 tokenizer = None
 vocab_size = None
 model_cfg = None
+draft_model = None
+lexicon_trie = None
+postprocess_pool = None
 
 # ========= 工具函数 =========
 def load_model(model_path: str):
     global model, tokenizer, vocab_size, model_cfg
     if not os.path.exists(model_path):
         raise FileNotFoundError(f"模型文件不存在: {model_path}")
-    ckpt = torch.load(model_path, map_location=DEVICE)
+    ckpt = load_checkpoint(model_path, map_location=DEVICE)
     vocab_size = ckpt["vocab_size"]
-    model_cfg = ckpt["model_config"]
     tokenizer_obj = ckpt["tokenizer"]
 
-    # 构建模型并加载权重
-    mdl = LightweightTransformer(vocab_size=vocab_size, **model_cfg)
-    mdl.load_state_dict(ckpt["model_state_dict"], strict=True)
+    # 构建模型并加载权重（旧 nn.TransformerEncoder 结构的检查点会自动转换为 sdpa）
+    mdl = build_model_from_checkpoint(ckpt, block_type=BLOCK_TYPE)
+    model_cfg = dict(ckpt["model_config"], block_type=BLOCK_TYPE)
     mdl.to(DEVICE)
     mdl.eval()
 
     return mdl, tokenizer_obj, vocab_size, model_cfg
 
+def load_draft_model(model_path: str, tokenizer_obj):
+    """加载投机解码用的草稿模型；必须与主模型使用同一份词表"""
+    if not os.path.exists(model_path):
+        raise FileNotFoundError(f"草稿模型文件不存在: {model_path}")
+    ckpt = load_checkpoint(model_path, map_location=DEVICE)
+    draft_tokenizer = ckpt.get("tokenizer")
+    if draft_tokenizer is not None and draft_tokenizer.vocab != tokenizer_obj.vocab:
+        raise ValueError("草稿模型与主模型的词表不一致，无法用于投机解码")
+    mdl = build_model_from_checkpoint(ckpt, block_type="sdpa")
+    mdl.to(DEVICE)
+    mdl.eval()
+    return mdl
+
+def load_lexicon_trie(lexicon_path: str, tokenizer_obj):
+    """读取短语词表并按当前分词器建前缀树"""
+    return TokenTrie.from_phrases(load_lexicon(lexicon_path), tokenizer_obj)
+
 def _clean_text(s: str, max_chars: int = 18) -> str:
     """把 decode 后的文本清理/截断成更适合联想的短语。"""
     s = (s or "").strip()
@@ -235,40 +120,98 @@ def generate_suggestions(
     max_new_tokens: int = 12,
     temperature: float = 0.9,
     top_k: int = 30,
+    mdl=None,
+    tok=None,
+    draft=None,
+    trie=None,
 ) -> List[str]:
     """
     关键词联想：
       1) 用模型生成 oversample*n 条句子片段；
       2) 用 jieba 抽关键词 + 组合二元短语；
       3) 清洗/去重/截断，返回 N 条短词/短语。
+    mdl / tok 默认使用全局加载的模型与分词器，传入时可对比其他模型（如蒸馏后的学生模型）。
+    draft 为投机解码的草稿模型；未指定 mdl 时默认使用 DRAFT_MODEL_PATH 加载的全局草稿模型。
+    trie 为商品短语前缀树；未指定 mdl 时默认使用 LEXICON_PATH 建的全局前缀树。
+    约束解码时每次生成都是一个完整的商品短语，跳过关键词抽取，且不与投机解码同时使用。
     """
     if not q or not q.strip():
         return []
-
-    rounds = max(1, n * oversample)
+    if mdl is None:
+        mdl, draft = model, (draft if draft is not None else draft_model)
+        trie = trie if trie is not None else lexicon_trie
+    tok = tok if tok is not None else tokenizer
+    if trie is not None:
+        draft = None
+
+    rounds = max(1, math.ceil(n * oversample))
     raw_texts: List[str] = []
     for _ in range(rounds):
-        text = model.generate(
+        text = mdl.generate(
             input_text=q.strip(),
-            tokenizer=tokenizer,
+            tokenizer=tok,
             max_length=max_new_tokens,
             temperature=temperature,
-            top_k=top_k
+            top_k=top_k,
+            draft_model=draft,
+            num_draft_tokens=NUM_DRAFT_TOKENS,
+            trie=trie
         )
         raw_texts.append(text)
 
+    if trie is not None:
+        return _postprocess_phrases(raw_texts, query=q, max_chars=12, want_n=n, trie=trie, tok=tok)
+    if postprocess_pool is not None:
+        # 等待结果时释放 GIL，其他请求线程可以继续生成
+        return postprocess_pool.submit(raw_texts, q, max_chars=12, want_n=n).result()
     suggestions = _postprocess_suggestions(raw_texts, query=q, max_chars=12, want_n=n)
     return suggestions
 
+def start_postprocess_pool():
+    """按 POSTPROCESS_WORKERS 创建（或重建）后处理进程池；子进程使用与主进程相同的关键词抽取方式"""
+    global postprocess_pool
+    if postprocess_pool is not None:
+        postprocess_pool.shutdown()
+        postprocess_pool = None
+    if POSTPROCESS_WORKERS > 0:
+        postprocess_pool = PostprocessPool(POSTPROCESS_WORKERS, extractor=KEYWORD_EXTRACTOR,
+                                           lexicon_path=KEYWORD_LEXICON_PATH,
+                                           batch_size=POSTPROCESS_BATCH_SIZE,
+                                           batch_wait=POSTPROCESS_BATCH_WAIT_MS / 1000)
+        postprocess_pool.warmup()
+
 
 # ========= FastAPI 路由 =========
 @app.on_event("startup")
 def _startup():
-    global model, tokenizer, vocab_size, model_cfg
+    global model, tokenizer, vocab_size, model_cfg, draft_model, lexicon_trie
     try:
         print(f"[Startup] Loading model from: {MODEL_PATH} on {DEVICE} ...")
         model, tokenizer, vocab_size, model_cfg = load_model(MODEL_PATH)
-        print(f"[Startup] Model loaded. vocab_size={vocab_size}, cfg={model_cfg}")
+        params = sum(p.numel() for p in model.parameters())
+        print(f"[Startup] Model loaded. vocab_size={vocab_size}, params={params:,}, cfg={model_cfg}")
+        if DRAFT_MODEL_PATH:
+            draft_model = load_draft_model(DRAFT_MODEL_PATH, tokenizer)
+            draft_params = sum(p.numel() for p in draft_model.parameters())
+            print(f"[Startup] Draft model loaded: {DRAFT_MODEL_PATH}, params={draft_params:,}, "
+                  f"num_draft_tokens={NUM_DRAFT_TOKENS}")
+        if LEXICON_PATH:
+            lexicon_trie = load_lexicon_trie(LEXICON_PATH, tokenizer)
+            print(f"[Startup] Lexicon loaded: {LEXICON_PATH}, phrases={len(lexicon_trie):,}, "
+                  f"trie nodes={len(lexicon_trie.children):,}")
+        if KEYWORD_EXTRACTOR == "aho":
+            postprocess.keyword_automaton = AhoCorasick(load_lexicon(KEYWORD_LEXICON_PATH))
+            print(f"[Startup] Keyword automaton loaded: {KEYWORD_LEXICON_PATH}, "
+                  f"phrases={len(postprocess.keyword_automaton):,}")
+        elif KEYWORD_EXTRACTOR == "jieba":
+            if POSTPROCESS_WORKERS <= 0:
+                postprocess.load_jieba()  # 在接流量之前加载 jieba 词典
+        else:
+            raise ValueError(f"未知的 KEYWORD_EXTRACTOR: {KEYWORD_EXTRACTOR}")
+        start_postprocess_pool()
+        if postprocess_pool is not None:
+            print(f"[Startup] Postprocess pool started: workers={POSTPROCESS_WORKERS}, "
+                  f"batch_size={POSTPROCESS_BATCH_SIZE}, batch_wait={POSTPROCESS_BATCH_WAIT_MS}ms")
     except Exception as e:
         # 启动失败时抛异常，让容器/进程管理器重启
         raise RuntimeError(f"加载模型失败: {e}")
@@ -276,7 +219,11 @@ def _startup():
 @app.get("/health")
 def health():
     ok = model is not None and tokenizer is not None
-    return {"ok": ok, "device": str(DEVICE), "model_path": MODEL_PATH}
+    return {"ok": ok, "device": str(DEVICE), "model_path": MODEL_PATH,
+            "draft_model_path": DRAFT_MODEL_PATH if draft_model is not None else None,
+            "lexicon_path": LEXICON_PATH if lexicon_trie is not None else None,
+            "keyword_extractor": "aho" if postprocess.keyword_automaton is not None else "jieba",
+            "postprocess_workers": POSTPROCESS_WORKERS if postprocess_pool is not None else 0}
 
 @app.get("/suggest", response_model=SuggestResponse)
 def suggest(
@@ -292,7 +239,7 @@ def suggest(
         sugs = generate_suggestions(
             q,
             n=n,
-            oversample=3,
+            oversample=CONSTRAINED_OVERSAMPLE if lexicon_trie is not None else 3,
             max_new_tokens=max_new_tokens,
             temperature=temperature,
             top_k=top_k,
@@ -304,13 +251,27 @@ def suggest(
 # 可选：热重载模型（线上慎用）
 @app.post("/reload")
 def reload_model():
-    global model, tokenizer, vocab_size, model_cfg
+    global model, tokenizer, vocab_size, model_cfg, draft_model, lexicon_trie
     try:
         model, tokenizer, vocab_size, model_cfg = load_model(MODEL_PATH)
+        if DRAFT_MODEL_PATH:
+            draft_model = load_draft_model(DRAFT_MODEL_PATH, tokenizer)
+        if LEXICON_PATH:
+            lexicon_trie = load_lexicon_trie(LEXICON_PATH, tokenizer)
+        if KEYWORD_EXTRACTOR == "aho":
+            postprocess.keyword_automaton = AhoCorasick(load_lexicon(KEYWORD_LEXICON_PATH))
+        start_postprocess_pool()  # 词表可能更新了，子进程一起重建
         return {"ok": True, "msg": "模型重载成功"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"重载失败: {e}")
 
+@app.on_event("shutdown")
+def _shutdown():
+    global postprocess_pool
+    if postprocess_pool is not None:
+        postprocess_pool.shutdown()
+        postprocess_pool = None
+
 if __name__ == "__main__":
     # 运行：python server.py
     # 或者：uvicorn server:app --host 0.0.0.0 --port 8000 --workers 1
@@ -0,0 +1,118 @@
+import math
+
+import numpy as np
+import pytest
+
+from bm25_index import BM25Index, reciprocal_rank_fusion, weighted_score_fusion
+
+DOCS = [
+    '苹果 iPhone 15 手机壳',
+    '华为 mate60 手机',
+    '蓝牙耳机 降噪 蓝牙',
+    'iPhone 15 钢化膜',
+    '运动鞋 男款',
+]
+
+
+def _index(docs=DOCS, **kwargs):
+    index = BM25Index(**kwargs)
+    index.add(docs)
+    return index
+
+
+def _reference_scores(index, docs, query):
+    """按定义逐篇计算 BM25：sum idf(t) * tf * (k1 + 1) / (tf + k1 * (1 - b + b * dl / avgdl))"""
+    analyzed = [index.analyze(d) for d in docs]
+    avgdl = sum(map(len, analyzed)) / len(analyzed)
+    n = len(docs)
+    scores = np.zeros(n)
+    for term in set(index.analyze(query)):
+        df = sum(term in terms for terms in analyzed)
+        if df == 0:
+            continue
+        idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+        for i, terms in enumerate(analyzed):
+            tf = terms.count(term)
+            if tf:
+                norm = index.k1 * (1 - index.b + index.b * len(terms) / avgdl)
+                scores[i] += idf * tf * (index.k1 + 1) / (tf + norm)
+    return scores
+
+
+@pytest.mark.parametrize('query', ['iphone 15', '蓝牙耳机', '手机', '不存在的词'])
+def test_scores_match_bm25_definition(query):
+    index = _index()
+    docs, scores = index.score(query)
+    expected = _reference_scores(index, DOCS, query)
+    np.testing.assert_array_equal(docs, np.flatnonzero(expected))
+    np.testing.assert_allclose(scores, expected[docs], rtol=1e-5)
+
+
+def test_analyze_adds_cjk_bigrams_and_drops_punctuation():
+    terms = BM25Index().analyze('蓝牙耳机，USB-C')
+    assert {'蓝', '牙', '蓝牙', '牙耳', '耳机', 'usb', 'c'} <= set(terms)
+    assert '，' not in terms and '-' not in terms
+
+
+def test_pending_buffer_and_merged_postings_agree():
+    merged = _index()
+    merged.merge()
+    pending = BM25Index()
+    for doc in DOCS:
+        pending.add([doc])
+    assert pending._pending
+    for query in ('iphone 15', '蓝牙', '运动鞋'):
+        for a, b in zip(merged.search(query, k=3), pending.search(query, k=3)):
+            np.testing.assert_allclose(a, b, rtol=1e-6)
+
+
+def test_search_ranks_and_respects_exclude():
+    index = _index()
+    scores, rows = index.search('iphone 15', k=3)
+    assert set(rows[:2].tolist()) == {0, 3} and rows[2] == -1 and scores[2] == -np.inf
+    exclude = np.zeros(len(DOCS), dtype=bool)
+    exclude[3] = True
+    _, rows = index.search('iphone 15', k=3, exclude=exclude)
+    assert rows.tolist() == [0, -1, -1]
+    scores, rows = index.batch_search(['手机', '运动鞋'], k=2)
+    assert rows.shape == (2, 2) and rows[1, 0] == 4
+
+
+@pytest.mark.parametrize('mmap', [True, False])
+def test_save_load_round_trip(tmp_path, mmap):
+    index = _index(k1=1.5, b=0.6)
+    index.save(str(tmp_path / 'bm25'))
+    loaded = BM25Index.load(str(tmp_path / 'bm25'), mmap=mmap)
+    assert (loaded.k1, loaded.b, len(loaded)) == (1.5, 0.6, len(DOCS))
+    for query in ('iphone 15', '蓝牙耳机'):
+        for a, b in zip(loaded.search(query, k=3), index.search(query, k=3)):
+            np.testing.assert_allclose(a, b)
+    loaded.add(['iPhone 16 手机壳'])
+    assert loaded.search('iphone', k=3)[1].tolist()[:3].count(-1) == 0
+
+
+def test_reciprocal_rank_fusion():
+    scores, rows = reciprocal_rank_fusion([[3, 1, 2, -1], [1, 4]], k=60)
+    assert rows.tolist() == [1, 3, 4, 2]
+    assert scores[0] == pytest.approx(1 / 62 + 1 / 61)
+    assert scores[1] == pytest.approx(1 / 61)
+    scores, rows = reciprocal_rank_fusion([[3], [1]], k=60, weights=[3.0, 1.0])
+    assert rows.tolist() == [3, 1] and scores[0] == pytest.approx(3 / 61)
+    assert len(reciprocal_rank_fusion([[-1, -1]])[1]) == 0
+
+
+def test_weighted_score_fusion_normalizes_each_list():
+    # 两路分数尺度差很多，归一化后按权重相加
+    scores, rows = weighted_score_fusion(
+        [[0.9, 0.8, 0.5], [30.0, 10.0, -np.inf]],
+        [[1, 2, 3], [3, 1, -1]],
+        weights=[0.5, 0.5],
+    )
+    fused = dict(zip(rows.tolist(), scores.tolist()))
+    assert fused[1] == pytest.approx(0.5 * 1.0 + 0.5 * 0.0)
+    assert fused[2] == pytest.approx(0.5 * 0.75)
+    assert fused[3] == pytest.approx(0.5 * 0.0 + 0.5 * 1.0)
+    assert list(scores) == sorted(scores, reverse=True)
+    # 只有一个结果时记为 1
+    scores, rows = weighted_score_fusion([[0.3]], [[7]], weights=[2.0])
+    assert rows.tolist() == [7] and scores[0] == pytest.approx(2.0)
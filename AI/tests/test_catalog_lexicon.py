@@ -0,0 +1,90 @@
+from catalog_lexicon import AhoCorasick
+
+
+def test_find_terms_leftmost_longest():
+    ac = AhoCorasick(['蓝牙', '蓝牙耳机', '耳机', '充电'])
+    assert ac.find_terms('无线蓝牙耳机带充电仓') == ['蓝牙耳机', '充电']
+
+
+def test_mixed_case_terms_match_case_insensitively():
+    ac = AhoCorasick(['iPhone', 'USB', '数据线'])
+    assert ac.find_terms('IPHONE 15 usb 数据线') == ['iPhone', 'USB', '数据线']
+    keywords = ac.extract_keywords('适用 iPhone 的 USB 数据线，iphone 专用')
+    assert keywords[0] == 'iPhone'
+    assert set(keywords) == {'iPhone', 'USB', '数据线'}
+
+
+def test_extract_keywords_stopwords():
+    ac = AhoCorasick(['耳机', '正品'])
+    assert ac.extract_keywords('正品耳机', stopwords={'正品'}) == ['耳机']
+
+
+def test_aho_worker_init_does_not_import_torch(tmp_path):
+    import os
+    import sys
+    import subprocess
+
+    lexicon = tmp_path / 'lexicon.txt'
+    lexicon.write_text('蓝牙耳机\t3\n', encoding='utf-8')
+    code = ("import sys\n"
+            "from inference.postprocess import _init_postprocess_worker\n"
+            f"_init_postprocess_worker('aho', {str(lexicon)!r})\n"
+            "print('torch' in sys.modules, 'jieba' in sys.modules)\n")
+    cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    out = subprocess.run([sys.executable, '-c', code], cwd=cwd, capture_output=True, text=True, check=True)
+    assert out.stdout.split() == ['False', 'False']
+
+
+def _tokenizer():
+    from inference.tokenizer import TextTokenizer
+
+    tokenizer = TextTokenizer(vocab_size=100)
+    tokenizer.build_vocab(['蓝牙耳机 无线充电器 手机壳', '运动鞋 连衣裙'])
+    return tokenizer
+
+
+def test_token_trie_allows_eos_only_at_phrase_end():
+    from catalog_lexicon import TokenTrie
+
+    tokenizer = _tokenizer()
+    eos = tokenizer.special_tokens['<EOS>']
+    trie = TokenTrie.from_phrases(['蓝牙', '蓝牙耳机', '未登录词'], tokenizer)
+    assert len(trie) == 2  # 含 <UNK> 的短语被跳过
+    ids = tokenizer.encode('蓝牙耳机', add_special=False, pad_to_max=False)
+    assert trie.contains(ids) and trie.contains(ids[:2]) and not trie.contains(ids[:3])
+    node = trie.step(trie.step(0, ids[0]), ids[1])
+    assert sorted(trie.allowed(node, eos, 'cpu').tolist()) == sorted([ids[2], eos])
+    assert eos not in trie.allowed(0, eos, 'cpu').tolist()
+    assert trie.step(0, ids[2]) is None
+
+
+def test_constrained_generation_only_returns_lexicon_phrases():
+    import torch
+    from catalog_lexicon import TokenTrie
+    from inference.model import LightweightTransformer
+
+    tokenizer = _tokenizer()
+    phrases = ['蓝牙耳机', '无线充电器', '手机壳', '运动鞋', '连衣裙', '手机']
+    trie = TokenTrie.from_phrases(phrases, tokenizer)
+    torch.manual_seed(0)
+    model = LightweightTransformer(len(tokenizer.vocab), d_model=32, nhead=4, num_layers=1,
+                                   dim_feedforward=64, max_seq_length=32)
+    results = {model.generate('手机', tokenizer, max_length=10, temperature=2.0, trie=trie) for _ in range(20)}
+    assert results <= set(phrases)
+    assert len(results) > 1
+
+
+def test_iter_matches_reports_overlapping_phrases():
+    ac = AhoCorasick(['he', 'she', 'hers', '耳机'])
+    text = 'ushers 耳机'
+    assert sorted(text[s:e] for s, e in ac.iter_matches(text)) == ['he', 'hers', 'she', '耳机']
+
+
+def test_lexicon_file_round_trip(tmp_path):
+    from catalog_lexicon import load_lexicon, save_lexicon
+
+    path = tmp_path / 'lexicon.txt'
+    save_lexicon([('蓝牙耳机', 12), ('USB', 3)], str(path))
+    phrases = load_lexicon(str(path))
+    assert phrases == ['蓝牙耳机', 'USB']
+    assert AhoCorasick(phrases).find_terms('usb 蓝牙耳机') == ['USB', '蓝牙耳机']
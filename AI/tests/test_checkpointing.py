@@ -0,0 +1,38 @@
+import os
+import random
+
+import numpy as np
+import torch
+
+from checkpointing import (AsyncCheckpointer, capture_rng_state, find_latest_checkpoint, list_checkpoints,
+                           load_checkpoint, restore_rng_state)
+
+
+def test_snapshot_is_isolated_from_later_updates(tmp_path):
+    weight = torch.zeros(3)
+    checkpointer = AsyncCheckpointer(str(tmp_path))
+    path = checkpointer.save({'w': weight, 'shared': [weight, weight]}, step=1)
+    weight += 1  # 快照之后的更新不应写进检查点
+    checkpointer.wait()
+    state = load_checkpoint(path)
+    assert torch.equal(state['w'], torch.zeros(3))
+    # 同一个张量只存一份，加载后仍共享
+    assert state['shared'][0].data_ptr() == state['shared'][1].data_ptr()
+
+
+def test_keep_last_prunes_old_checkpoints(tmp_path):
+    checkpointer = AsyncCheckpointer(str(tmp_path), keep_last=2)
+    for step in (10, 20, 30):
+        checkpointer.save({'step': step}, step)
+    checkpointer.wait()
+    assert [step for step, _ in list_checkpoints(str(tmp_path))] == [20, 30]
+    assert find_latest_checkpoint(str(tmp_path)).endswith('ckpt_step_30.pth')
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.tmp')]
+
+
+def test_rng_state_round_trip():
+    state = capture_rng_state()
+    expected = (random.random(), np.random.rand(), torch.rand(1))
+    restore_rng_state(state)
+    assert (random.random(), np.random.rand()) == expected[:2]
+    assert torch.equal(torch.rand(1), expected[2])
@@ -0,0 +1,62 @@
+import random
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+from distill_train import _distill_loss, distill_model
+from item_desc_train import load_trained_model, train_model
+
+
+def _logits(seed, shape=(2, 5, 11)):
+    return torch.randn(shape, generator=torch.Generator().manual_seed(seed))
+
+
+def _labels():
+    labels = torch.randint(0, 11, (2, 5), generator=torch.Generator().manual_seed(9))
+    labels[:, -1] = -100
+    return labels
+
+
+def test_kd_term_vanishes_when_student_matches_teacher():
+    logits, labels = _logits(0), _labels()
+    loss, kd, ce = _distill_loss(logits, logits.clone(), labels, temperature=2.0, alpha=0.9)
+    assert kd.item() == pytest.approx(0.0, abs=1e-6)
+    mask = labels != -100
+    assert ce.item() == pytest.approx(F.cross_entropy(logits[mask], labels[mask]).item())
+    assert loss.item() == pytest.approx(0.1 * ce.item())
+
+
+def test_distill_loss_ignores_unlabelled_positions():
+    student, teacher, labels = _logits(0), _logits(1), _labels()
+    loss, kd, _ = _distill_loss(student, teacher, labels, temperature=2.0, alpha=1.0)
+    assert kd.item() > 0 and loss.item() == pytest.approx(kd.item())
+    changed = teacher.clone()
+    changed[:, -1] += 5.0  # 只改标签为 -100 的位置
+    assert _distill_loss(student, changed, labels, 2.0, 1.0)[0].item() == pytest.approx(loss.item())
+
+
+def test_distilled_student_loads_like_a_trained_model(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    rng = random.Random(0)
+    chars = '手机耳机蓝牙智能无线充电运动休闲'
+    with open('corpus.txt', 'w', encoding='utf-8') as f:
+        for _ in range(16):
+            f.write(''.join(rng.choice(chars) for _ in range(4)) + '\t'
+                    + ''.join(rng.choice(chars) for _ in range(8)) + '\n')
+    train_model({
+        'data_path': 'corpus.txt', 'vocab_size': 200, 'eval_fraction': 0, 'num_epochs': 1, 'batch_size': 4,
+        'checkpoint_dir': 'ckpt',
+        'model_config': {'d_model': 64, 'nhead': 4, 'num_layers': 2, 'dim_feedforward': 128, 'max_seq_length': 24},
+    })
+    student, _ = distill_model({
+        'teacher_path': 'item_desc_model_final.pth', 'output_path': 'student.pth', 'data_path': 'corpus.txt',
+        'eval_fraction': 0, 'num_epochs': 1, 'batch_size': 4,
+        'model_config': {'d_model': 32, 'nhead': 4, 'num_layers': 1, 'dim_feedforward': 64},
+    })
+    teacher, _, _ = load_trained_model('item_desc_model_final.pth')
+    loaded, tokenizer, _ = load_trained_model('student.pth')
+    assert loaded.max_seq_length == teacher.max_seq_length == 24
+    assert sum(p.numel() for p in loaded.parameters()) < sum(p.numel() for p in teacher.parameters())
+    for a, b in zip(student.state_dict().values(), loaded.state_dict().values()):
+        assert torch.equal(a, b)
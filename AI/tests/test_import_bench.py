@@ -0,0 +1,24 @@
+import pytest
+
+from inference.import_bench import FORBIDDEN_MODULES, check_forbidden, measure_import
+
+
+@pytest.mark.parametrize('module', sorted(FORBIDDEN_MODULES))
+def test_inference_entry_points_do_not_import_forbidden_modules(module):
+    result = measure_import(module, repeats=1)
+    assert check_forbidden(module, result['modules']) == []
+
+
+def test_lazy_package_exports():
+    result = measure_import('inference', repeats=1)
+    assert 'torch' not in result['modules']
+    import inference
+
+    assert inference.TextTokenizer.__module__ == 'inference.tokenizer'
+    with pytest.raises(AttributeError):
+        inference.NotExported
+
+
+def test_check_forbidden_matches_submodules():
+    assert check_forbidden('inference.tokenizer', ['os', 'torch.nn']) == ['torch']
+    assert check_forbidden('inference.tokenizer', ['os', 'torchvision']) == []
@@ -0,0 +1,134 @@
+import pytest
+import torch
+
+from inference.layers import convert_block_state_dict
+from inference.model import LightweightTransformer, build_model_from_checkpoint
+
+MODEL_CONFIG = dict(d_model=32, nhead=4, num_layers=2, dim_feedforward=64, dropout=0.0, max_seq_length=16)
+VOCAB = 50
+
+
+def _model(block_type='sdpa', seed=0, **kwargs):
+    torch.manual_seed(seed)
+    return LightweightTransformer(VOCAB, block_type=block_type, **dict(MODEL_CONFIG, **kwargs)).eval()
+
+
+def _tokens(batch=2, length=10, seed=1):
+    return torch.randint(1, VOCAB, (batch, length), generator=torch.Generator().manual_seed(seed))
+
+
+def test_encoder_weights_convert_to_sdpa():
+    encoder = _model('encoder')
+    sdpa = _model('sdpa', seed=1)
+    sdpa.load_state_dict(convert_block_state_dict(encoder.state_dict(), src='encoder', dst='sdpa'))
+    x = _tokens()
+    with torch.no_grad():
+        torch.testing.assert_close(sdpa(x, is_causal=True), encoder(x, is_causal=True), rtol=1e-4, atol=1e-5)
+
+
+def test_sdpa_weights_convert_back_to_encoder():
+    sdpa = _model('sdpa')
+    encoder = _model('encoder', seed=1)
+    encoder.load_state_dict(convert_block_state_dict(sdpa.state_dict(), src='sdpa', dst='encoder'))
+    x = _tokens()
+    with torch.no_grad():
+        torch.testing.assert_close(encoder(x, is_causal=True), sdpa(x, is_causal=True), rtol=1e-4, atol=1e-5)
+    with pytest.raises(ValueError):
+        convert_block_state_dict({}, src='encoder', dst='rnn')
+
+
+def test_old_checkpoint_without_block_type_loads_as_sdpa():
+    encoder = _model('encoder')
+    checkpoint = {
+        'model_state_dict': encoder.state_dict(),
+        'vocab_size': VOCAB,
+        'model_config': dict(MODEL_CONFIG),  # 旧检查点没有 block_type
+    }
+    model = build_model_from_checkpoint(checkpoint).eval()
+    assert model.block_type == 'sdpa'
+    x = _tokens()
+    with torch.no_grad():
+        torch.testing.assert_close(model(x, is_causal=True), encoder(x, is_causal=True), rtol=1e-4, atol=1e-5)
+
+
+def test_kv_cache_decoding_matches_full_forward():
+    model = _model('sdpa')
+    x = _tokens(batch=1, length=8)
+    with torch.no_grad():
+        full = model(x, is_causal=True)
+        logits, cache = model(x[:, :5], is_causal=True, use_cache=True)
+        steps = [logits]
+        for i in range(5, 8):
+            logits, cache = model(x[:, i:i + 1], past_key_values=cache, use_cache=True)
+            steps.append(logits)
+    torch.testing.assert_close(torch.cat(steps, dim=1), full, rtol=1e-4, atol=1e-5)
+
+
+def test_encoder_rejects_kv_cache():
+    with pytest.raises(ValueError):
+        _model('encoder')(_tokens(), use_cache=True)
+
+
+@pytest.mark.parametrize('tie, rank', [(True, None), (False, 8), (True, 8)])
+def test_compact_embeddings_round_trip_through_checkpoint(tmp_path, tie, rank):
+    model = _model('sdpa', tie_embeddings=tie, embedding_rank=rank)
+    if tie:
+        assert model.output_layer.weight is model.embedding.weight
+    embed_dim = rank or MODEL_CONFIG['d_model']
+    assert model.embedding.weight.shape == (VOCAB, embed_dim)
+    path = tmp_path / 'model.pth'
+    torch.save({'model_state_dict': model.state_dict(), 'vocab_size': VOCAB,
+                'model_config': dict(MODEL_CONFIG, tie_embeddings=tie, embedding_rank=rank)}, path)
+    loaded = build_model_from_checkpoint(torch.load(path, weights_only=False)).eval()
+    if tie:
+        assert loaded.output_layer.weight is loaded.embedding.weight
+    x = _tokens()
+    with torch.no_grad():
+        torch.testing.assert_close(loaded(x, is_causal=True), model(x, is_causal=True))
+
+
+def test_compact_embeddings_shrink_the_vocab_matrices():
+    def count(model):
+        return sum(p.numel() for p in model.parameters())
+
+    base = _model('sdpa')
+    d = MODEL_CONFIG['d_model']
+    # 共享后少一个 (vocab, d_model) 矩阵
+    assert count(base) - count(_model('sdpa', tie_embeddings=True)) == VOCAB * d
+    # 低秩：两个 (vocab, d) 变为两个 (vocab, r) 加两个 r x d 投影
+    r = 8
+    assert count(base) - count(_model('sdpa', embedding_rank=r)) == 2 * VOCAB * d - 2 * VOCAB * r - 2 * r * d
+
+
+def _tokenizer():
+    from inference.tokenizer import TextTokenizer
+
+    tokenizer = TextTokenizer(vocab_size=VOCAB)
+    tokenizer.build_vocab(['手机耳机蓝牙智能无线充电', '运动休闲时尚轻薄连衣裙'])
+    return tokenizer
+
+
+@pytest.mark.parametrize('prompt', ['手机', '蓝牙耳机', '连衣裙'])
+def test_greedy_speculative_decoding_matches_target(prompt):
+    tokenizer = _tokenizer()
+    vocab = len(tokenizer.vocab)
+    torch.manual_seed(0)
+    target = LightweightTransformer(vocab, **MODEL_CONFIG)
+    draft = LightweightTransformer(vocab, **dict(MODEL_CONFIG, num_layers=1, d_model=16, dim_feedforward=32))
+    # top_k=1 时目标分布是 one-hot，不论草稿提议什么，接受 / 重采样后的结果都必须是目标模型的贪心输出
+    expected = target.generate(prompt, tokenizer, max_length=8, top_k=1)
+    stats = {}
+    got = target.generate(prompt, tokenizer, max_length=8, top_k=1, draft_model=draft, num_draft_tokens=3,
+                          stats=stats)
+    assert got == expected
+    assert stats['accepted'] <= stats['drafted']
+
+
+def test_self_drafting_accepts_every_token():
+    tokenizer = _tokenizer()
+    torch.manual_seed(0)
+    model = LightweightTransformer(len(tokenizer.vocab), **MODEL_CONFIG)
+    stats = {}
+    model.generate('手机', tokenizer, max_length=8, draft_model=model, num_draft_tokens=3, stats=stats)
+    assert stats['accepted'] == stats['drafted'] > 0
+    assert stats['target_calls'] < stats['new_tokens']
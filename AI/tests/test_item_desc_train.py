@@ -0,0 +1,278 @@
+import math
+import random
+
+import pytest
+import torch
+
+import item_desc_train
+from checkpointing import list_checkpoints
+from item_desc_train import train_model
+
+_CHARS = '手机耳机蓝牙智能无线充电运动休闲时尚轻薄'
+
+
+def _write_corpus(path, n, seed=0):
+    """等长的 标题\\t描述 行，每个样本的有效 token 数相同"""
+    rng = random.Random(seed)
+    with open(path, 'w', encoding='utf-8') as f:
+        for _ in range(n):
+            title = ''.join(rng.choice(_CHARS) for _ in range(4))
+            desc = ''.join(rng.choice(_CHARS) for _ in range(8))
+            f.write(f'{title}\t{desc}\n')
+    return str(path)
+
+
+def _config(tmp_path, corpus, **overrides):
+    cfg = {
+        'data_path': corpus,
+        'vocab_size': 200,
+        'vocab_lines': 1000,
+        'max_samples': 1000,
+        'eval_fraction': 0,
+        'num_epochs': 1,
+        'batch_size': 2,
+        'lr': 1e-3,
+        'checkpoint_dir': str(tmp_path / 'ckpt'),
+        'model_config': {
+            'd_model': 32, 'nhead': 4, 'num_layers': 1, 'dim_feedforward': 64,
+            'dropout': 0.0, 'max_seq_length': 24,
+        },
+    }
+    cfg.update(overrides)
+    return cfg
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # train_model 把最终模型写到当前目录
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def _record_step_grads(monkeypatch):
+    grads = []
+    original = item_desc_train._optimizer_step
+
+    def recording(model, *args, **kwargs):
+        grads.append([p.grad.detach().clone() for p in model.parameters() if p.grad is not None])
+        return original(model, *args, **kwargs)
+
+    monkeypatch.setattr(item_desc_train, '_optimizer_step', recording)
+    return grads
+
+
+def test_leftover_accumulation_averages_over_accumulated_batches(workdir, monkeypatch):
+    corpus = _write_corpus(workdir / 'corpus.txt', 6)
+    grads = _record_step_grads(monkeypatch)
+    # 3 个 micro-batch 凑不满 accum=4，只在 epoch 末尾用残余梯度更新一次
+    train_model(_config(workdir, corpus, batch_size=2, grad_accum_steps=4))
+    train_model(_config(workdir, corpus, batch_size=6, grad_accum_steps=1))
+    assert len(grads) == 2
+    for leftover, full in zip(*grads):
+        torch.testing.assert_close(leftover, full, rtol=1e-4, atol=1e-6)
+
+
+def _tokenizer(corpus):
+    tokenizer, _ = item_desc_train._build_tokenizer(corpus, vocab_size=200, vocab_lines=1000)
+    return tokenizer
+
+
+@pytest.mark.parametrize('num_shards', [1, 3, 7])
+def test_streaming_shards_cover_every_line_once(tmp_path, num_shards):
+    corpus = _write_corpus(tmp_path / 'corpus.txt', 101)
+    dataset = item_desc_train.StreamingItemDescDataset(corpus, tokenizer=None)
+    lines = []
+    for shard in range(num_shards):
+        lines.extend(dataset._iter_shard_lines(shard, num_shards))
+    with open(corpus, encoding='utf-8') as f:
+        assert sorted(lines) == sorted(f)
+
+
+def test_streaming_gzip_shards_by_line(tmp_path):
+    import gzip
+
+    corpus = _write_corpus(tmp_path / 'corpus.txt', 50)
+    with open(corpus, 'rb') as src, gzip.open(tmp_path / 'corpus.txt.gz', 'wb') as dst:
+        dst.write(src.read())
+    dataset = item_desc_train.StreamingItemDescDataset(str(tmp_path / 'corpus.txt.gz'), tokenizer=None)
+    assert not dataset.seekable
+    shards = [list(dataset._iter_shard_lines(i, 2)) for i in range(2)]
+    assert len(shards[0]) == 25 and len(shards[1]) == 25
+    assert not set(shards[0]) & set(shards[1])
+
+
+@pytest.mark.parametrize('pack', [False, True])
+def test_streaming_resume_skips_consumed_samples(tmp_path, pack):
+    corpus = _write_corpus(tmp_path / 'corpus.txt', 40)
+    tokenizer = _tokenizer(corpus)
+    kwargs = dict(max_seq_length=24, shuffle_buffer=8, seed=3, rank=1, world_size=2, pack=pack)
+    dataset = item_desc_train.StreamingItemDescDataset(corpus, tokenizer, **kwargs)
+    dataset.set_epoch(2)
+    full = [sample[0] for sample in dataset]
+    state = dataset.state_dict(batches_seen=3, batch_size=2)
+
+    resumed = item_desc_train.StreamingItemDescDataset(corpus, tokenizer, **kwargs)
+    resumed.load_state_dict(state)
+    resumed.set_epoch(2)
+    rest = [sample[0] for sample in resumed]
+    assert len(rest) == len(full) - 6
+    for a, b in zip(rest, full[6:]):
+        assert torch.equal(a, b)
+    # 离开续训所在的 epoch 后从头读
+    resumed.set_epoch(3)
+    dataset.set_epoch(3)
+    assert len(list(resumed)) == len(list(dataset))
+
+
+def test_pack_sequences_greedy_and_truncates():
+    rows = list(item_desc_train._pack_sequences([[1] * 3, [2] * 4, [3] * 2, [4] * 9], 8))
+    assert rows == [[[1] * 3, [2] * 4], [[3] * 2], [[4] * 8]]
+
+
+def test_packed_attention_mask_is_block_diagonal_causal():
+    segments = torch.tensor([[1, 1, 2, 2, 2, 0]])
+    blocked = item_desc_train.build_packed_attention_mask(segments, nhead=2)
+    assert blocked.shape == (2, 6, 6)
+    visible = ~blocked[0]
+    expected = torch.tensor([
+        [1, 0, 0, 0, 0, 0],
+        [1, 1, 0, 0, 0, 0],
+        [0, 0, 1, 0, 0, 0],
+        [0, 0, 1, 1, 0, 0],
+        [0, 0, 1, 1, 1, 0],
+        [0, 0, 0, 0, 0, 1],
+    ], dtype=torch.bool)
+    assert torch.equal(visible, expected)
+    assert torch.equal(blocked[0], blocked[1])
+
+
+@pytest.mark.parametrize('block_type', ['sdpa', 'encoder'])
+def test_packed_forward_matches_separate_samples(block_type):
+    from inference.model import LightweightTransformer
+
+    torch.manual_seed(0)
+    model = LightweightTransformer(50, d_model=32, nhead=4, num_layers=2, dim_feedforward=64,
+                                   dropout=0.0, max_seq_length=16, block_type=block_type).eval()
+    samples = [[1, 5, 6, 7], [1, 8, 9], [1, 10, 11, 12, 13]]
+    batch = [t.unsqueeze(0) for t in item_desc_train._build_packed_sample(samples, 16, pad=0)]
+    with torch.no_grad():
+        packed, labels, n_tokens = item_desc_train._lm_forward(model, batch, 'cpu')
+        start = 0
+        for sample in samples:
+            alone = model(torch.tensor([sample]), is_causal=True)
+            torch.testing.assert_close(packed[0, start:start + len(sample)], alone[0], rtol=1e-4, atol=1e-5)
+            start += len(sample)
+    assert n_tokens == 12
+    # 标签只在样本内部右移，样本末尾不预测下一条样本
+    assert labels[0, :4].tolist() == [5, 6, 7, -100]
+
+
+def test_merge_config_rejects_unknown_keys():
+    merged = item_desc_train._merge_config({'grad_accum_steps': 4, 'model_config': {'d_model': 64}})
+    assert merged['grad_accum_steps'] == 4
+    assert merged['model_config']['d_model'] == 64
+    assert merged['model_config']['nhead'] == item_desc_train.DEFAULT_TRAIN_CONFIG['model_config']['nhead']
+    with pytest.raises(ValueError):
+        item_desc_train._merge_config({'grad_acum_steps': 4})
+
+
+def test_precision_contexts_on_cpu():
+    cpu = torch.device('cpu')
+    with item_desc_train._autocast_context(cpu, 'bf16'):
+        out = torch.nn.Linear(4, 4)(torch.randn(2, 4))
+    assert out.dtype == torch.bfloat16
+    with pytest.raises(ValueError):
+        item_desc_train._autocast_context(cpu, 'fp16')
+    assert not item_desc_train._create_grad_scaler(cpu, 'bf16').is_enabled()
+
+
+def test_full_accumulation_matches_large_batch(workdir, monkeypatch):
+    corpus = _write_corpus(workdir / 'corpus.txt', 8)
+    grads = _record_step_grads(monkeypatch)
+    train_model(_config(workdir, corpus, batch_size=2, grad_accum_steps=4))
+    train_model(_config(workdir, corpus, batch_size=8, grad_accum_steps=1))
+    assert len(grads) == 2
+    for accumulated, full in zip(*grads):
+        torch.testing.assert_close(accumulated, full, rtol=1e-4, atol=1e-6)
+
+
+def test_resumable_sampler_splits_ranks_evenly():
+    dataset = list(range(10))
+    samplers = [item_desc_train.ResumableSampler(dataset, rank=r, world_size=3, seed=1) for r in range(3)]
+    parts = [list(s) for s in samplers]
+    assert [len(p) for p in parts] == [4, 4, 4]
+    # 补齐 2 个重复样本后覆盖全部样本
+    assert set(sum(parts, [])) == set(dataset)
+    samplers[1].set_start(2)
+    assert list(samplers[1]) == parts[1][2:] and len(samplers[1]) == 2
+    samplers[1].set_epoch(1)
+    assert len(samplers[1]) == 4 and list(samplers[1]) != parts[1]
+
+
+def _free_port():
+    import socket
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def test_ddp_matches_single_process_large_batch(workdir, monkeypatch):
+    corpus = _write_corpus(workdir / 'corpus.txt', 8)
+    monkeypatch.setenv('MASTER_ADDR', '127.0.0.1')
+    monkeypatch.setenv('MASTER_PORT', str(_free_port()))
+    cfg = _config(workdir, corpus, num_epochs=2, threads_per_rank=1)
+    # 每个 rank 的 micro-batch 为 2，两个 rank 合起来与单进程 batch 4 的样本集合相同
+    item_desc_train.launch_distributed(dict(cfg, batch_size=2), nproc=2)
+    ddp_state = torch.load('item_desc_model_final.pth', weights_only=False)['model_state_dict']
+    model, _ = train_model(dict(cfg, batch_size=4))
+    for name, value in model.state_dict().items():
+        # Adam 会放大接近 0 的梯度上的舍入差异，容差取一步更新量（lr=1e-3）的 1/10
+        torch.testing.assert_close(ddp_state[name], value, rtol=1e-3, atol=1e-4)
+
+
+def test_resume_mid_epoch_reproduces_weights(workdir):
+    corpus = _write_corpus(workdir / 'corpus.txt', 10)
+    # dropout > 0：续训还要恢复随机数状态才能得到同样的权重
+    cfg = _config(workdir, corpus, num_epochs=2, checkpoint_every=1, keep_last=0)
+    cfg['model_config']['dropout'] = 0.1
+    straight, _ = train_model(cfg)
+    ckpt = dict(list_checkpoints(cfg['checkpoint_dir']))[3]  # 第 1 个 epoch 的中间
+    resumed, _ = train_model(dict(cfg, resume=ckpt))
+    for (name, a), b in zip(straight.state_dict().items(), resumed.state_dict().values()):
+        assert torch.equal(a, b), name
+
+
+def test_hash_split_is_disjoint_and_complete(tmp_path):
+    corpus = _write_corpus(tmp_path / 'corpus.txt', 400)
+    tokenizer = _tokenizer(corpus)
+    split = {name: item_desc_train.ItemDescDataset(corpus, tokenizer, split=name, eval_fraction=0.2).samples
+             for name in ('train', 'eval')}
+    train_titles = {title for title, _ in split['train']}
+    eval_titles = {title for title, _ in split['eval']}
+    assert not train_titles & eval_titles
+    assert len(split['train']) + len(split['eval']) == 400
+    assert 40 < len(split['eval']) < 120
+    assert item_desc_train._in_split(('标题', '描述'), None, 0.2)
+    assert not item_desc_train._in_split(('标题', '描述'), 'eval', 0)
+
+
+def test_perplexity_is_the_same_with_and_without_packing(tmp_path):
+    from torch.utils.data import DataLoader
+    from inference.model import LightweightTransformer
+
+    corpus = _write_corpus(tmp_path / 'corpus.txt', 12)
+    tokenizer = _tokenizer(corpus)
+    torch.manual_seed(0)
+    model_config = dict(_config(tmp_path, corpus)['model_config'], max_seq_length=48)
+    model = LightweightTransformer(len(tokenizer.vocab), **model_config)
+    results = []
+    for pack in (False, True):
+        dataset = item_desc_train.ItemDescDataset(corpus, tokenizer, max_seq_length=48, pack=pack)
+        loader = DataLoader(dataset, batch_size=4)
+        results.append(item_desc_train.evaluate_perplexity(model, loader, torch.device('cpu')))
+    plain, packed = results
+    assert plain['tokens'] == packed['tokens'] == 12 * 14
+    assert packed['loss'] == pytest.approx(plain['loss'], rel=1e-4)
+    assert plain['ppl'] == pytest.approx(math.exp(plain['loss']))
+    assert model.training
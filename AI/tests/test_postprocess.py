@@ -0,0 +1,42 @@
+import pytest
+
+import inference.postprocess as postprocess
+from catalog_lexicon import AhoCorasick, load_lexicon
+
+PHRASES = ['蓝牙耳机', '无线', '降噪', '手机', '充电器', '快充']
+RAW_TEXTS = [
+    ['无线蓝牙耳机主动降噪', '蓝牙耳机 快充'],
+    ['手机快充充电器', '无线充电器'],
+    ['降噪蓝牙耳机无线'],
+]
+
+
+@pytest.fixture
+def lexicon_path(tmp_path):
+    path = tmp_path / 'lexicon.txt'
+    path.write_text(''.join(f'{p}\t1\n' for p in PHRASES), encoding='utf-8')
+    return str(path)
+
+
+def test_pool_matches_in_process_postprocessing(lexicon_path, monkeypatch):
+    monkeypatch.setattr(postprocess, 'keyword_automaton', AhoCorasick(load_lexicon(lexicon_path)))
+    expected = [postprocess._postprocess_suggestions(texts, '蓝牙', want_n=5) for texts in RAW_TEXTS]
+    assert any(expected)
+
+    pool = postprocess.PostprocessPool(workers=2, extractor='aho', lexicon_path=lexicon_path, batch_wait=0.05)
+    try:
+        pool.warmup()
+        futures = [pool.submit(texts, '蓝牙', want_n=5) for texts in RAW_TEXTS]
+        assert [f.result(timeout=60) for f in futures] == expected
+    finally:
+        pool.shutdown()
+
+
+def test_pool_propagates_worker_errors(lexicon_path):
+    pool = postprocess.PostprocessPool(workers=1, extractor='aho', lexicon_path=lexicon_path)
+    try:
+        future = pool.submit([None, 3], '蓝牙')  # 非字符串文本在子进程里出错
+        with pytest.raises(AttributeError):
+            future.result(timeout=60)
+    finally:
+        pool.shutdown()
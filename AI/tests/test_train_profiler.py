@@ -0,0 +1,42 @@
+import json
+import time
+
+from train_profiler import StepProfiler
+
+
+def test_disabled_profiler_is_passthrough():
+    logs = []
+    profiler = StepProfiler('cpu', log=logs.append)
+    assert list(profiler.wrap_loader([1, 2, 3])) == [1, 2, 3]
+    with profiler.phase('forward'):
+        pass
+    profiler.step_end(4, 40)
+    assert profiler.step == 0 and logs == []
+
+
+def test_reports_every_n_steps_with_phase_times():
+    logs = []
+    profiler = StepProfiler('cpu', report_every=2, log=logs.append)
+    for _ in profiler.wrap_loader(range(4)):
+        with profiler.phase('forward'):
+            time.sleep(0.002)
+        profiler.step_end(8, 100)
+    assert len(logs) == 2
+    assert logs[0].startswith('[profile] step 2 |') and logs[1].startswith('[profile] step 4 |')
+    forward_ms = float(logs[0].split('forward ')[1].split('ms')[0])
+    assert forward_ms >= 2.0
+
+
+def test_trace_covers_requested_steps(tmp_path):
+    path = tmp_path / 'trace.json'
+    profiler = StepProfiler('cpu', trace_steps=(2, 3), trace_path=str(path), log=lambda *_: None)
+    for _ in profiler.wrap_loader(range(5)):
+        with profiler.phase('backward'):
+            pass
+        profiler.step_end(1, 1)
+        if profiler.step == 2:
+            assert profiler._profiler is not None
+    profiler.close()
+    assert profiler._profiler is None
+    events = json.loads(path.read_text())['traceEvents']
+    assert sum(e.get('name') == 'backward' for e in events) == 2
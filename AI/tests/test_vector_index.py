@@ -0,0 +1,411 @@
+import numpy as np
+import pytest
+
+from vector_index import VectorIndex, VectorStore
+
+
+def _random_vectors(n, dim=32, seed=0):
+    return np.random.default_rng(seed).standard_normal((n, dim)).astype(np.float32)
+
+
+def _exact_topk(vectors, queries, k, live=None):
+    """余弦相似度的精确前 k（行号），live 为参与比较的行"""
+    normed = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    q = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    scores = q @ normed.T
+    if live is not None:
+        scores[:, ~live] = -np.inf
+    return np.argsort(-scores, axis=1, kind='stable')[:, :k]
+
+
+def _recall(found, truth):
+    return np.mean([len(set(f) & set(t)) / len(t) for f, t in zip(found.tolist(), truth.tolist())])
+
+
+def _build(n=1000, dim=32, **kwargs):
+    vectors = _random_vectors(n, dim)
+    index = VectorIndex(dimension=dim, compact_threshold=None, **kwargs)
+    if kwargs.get('index_type', 'flat') != 'flat' or kwargs.get('storage', 'float32') == 'pq':
+        index.train(vectors)
+    index.add_vectors(vectors, [f'商品{i}' for i in range(n)], ids=list(range(n)))
+    return index, vectors
+
+
+@pytest.mark.parametrize('index_type', ['flat', 'hnsw'])
+def test_deleted_rows_never_returned(index_type):
+    index, vectors = _build(index_type=index_type)
+    deleted = np.arange(0, len(vectors), 3)
+    index.delete(deleted.tolist())
+    queries = vectors[deleted[:20]]
+    _, indices = index.batch_topk(queries, k=10)
+    assert not np.isin(indices, deleted).any()
+    assert (indices >= 0).all()
+    assert len(index) == len(vectors) - len(deleted)
+
+
+def test_tombstone_overfetch_depends_on_deleted_fraction():
+    index, vectors = _build(index_type='hnsw')
+    fetched = []
+    raw_search = index._raw_search
+
+    def recording(queries, k):
+        fetched.append(k)
+        return raw_search(queries, k)
+
+    index._raw_search = recording
+    index.delete(list(range(0, 500)))  # 删除一半
+    index.batch_topk(vectors[500:510], k=10)
+    # 按存活占比 1/2 多取，而不是 k + 500 条墓碑
+    assert fetched[0] == 10 + 20
+    live = np.ones(len(vectors), dtype=bool)
+    live[:500] = False
+    _, indices = index.batch_topk(vectors[500:510], k=10)
+    assert _recall(indices, _exact_topk(vectors, vectors[500:510], 10, live)) >= 0.9
+
+
+def test_compaction_preserves_ids_and_results():
+    index, vectors = _build()
+    index.delete(list(range(0, 1000, 2)))
+    query = vectors[501:502]
+    before_scores, before_rows = index.batch_topk(query, k=5)
+    before_ids = index.get_ids(before_rows[0])
+    index.compact()
+    assert index.num_deleted == 0 and index.ntotal == 500
+    after_scores, after_rows = index.batch_topk(query, k=5)
+    assert list(index.get_ids(after_rows[0])) == list(before_ids)
+    np.testing.assert_allclose(after_scores, before_scores, rtol=1e-5)
+    assert 500 not in index and 501 in index
+
+
+def test_upsert_replaces_vector():
+    index, vectors = _build(n=100)
+    index.upsert([5], vectors[7:8], ['新商品'])
+    assert len(index) == 100
+    _, rows = index.batch_topk(vectors[7:8], k=2)
+    assert sorted(index.get_ids(rows[0])) == [5, 7]
+
+
+def test_save_load_keeps_search_params(tmp_path):
+    index, _ = _build(n=50, prefilter_ratio=0.05, block_size=16)
+    index.save(str(tmp_path / 'idx'))
+    loaded = VectorIndex(dimension=32)
+    loaded.load(str(tmp_path / 'idx'))
+    assert loaded.prefilter_ratio == 0.05
+    assert loaded.block_size == 16
+
+
+def test_vector_store_grows_geometrically():
+    store = VectorStore(4, initial_capacity=2)
+    capacities = set()
+    for i in range(100):
+        assert store.append(np.full((1, 4), i)) == i
+        capacities.add(store.capacity)
+    assert len(store) == 100 and store.capacity >= 100
+    assert len(capacities) <= 7  # 2, 4, 8, ... 128：扩容次数是对数级
+    np.testing.assert_array_equal(store.data[:, 0], np.arange(100))
+    store.shrink_to_fit()
+    assert store.capacity == 100 and store.capacity_nbytes == store.nbytes
+
+
+def test_vector_store_wrap_does_not_copy_until_append():
+    array = np.arange(12, dtype=np.float32).reshape(3, 4)
+    array.flags.writeable = False
+    store = VectorStore.wrap(array)
+    assert np.shares_memory(store.data, array)
+    store.append(np.ones((2, 4)))
+    assert len(store) == 5 and not np.shares_memory(store.data, array)
+    np.testing.assert_array_equal(store.data[:3], array)
+
+
+def test_incremental_adds_match_single_add():
+    vectors = _random_vectors(300)
+    one = VectorIndex(dimension=32)
+    one.add_vectors(vectors, [str(i) for i in range(300)])
+    many = VectorIndex(dimension=32)
+    for start in range(0, 300, 7):
+        many.add_vectors(vectors[start:start + 7], [str(i) for i in range(start, min(start + 7, 300))])
+    np.testing.assert_array_equal(many.vectors, one.vectors)
+    assert list(many.texts) == list(one.texts)
+
+
+@pytest.mark.parametrize('block_size', [7, 64, 4096])
+def test_brute_force_search_is_exact(block_size):
+    index, vectors = _build(n=500, block_size=block_size)
+    query = _random_vectors(1, seed=5)
+    results = index.search(query[0], k=10, threshold=-1.0)
+    assert [r['index'] for r in results] == _exact_topk(vectors, query, 10)[0].tolist()
+    expected = vectors[results[0]['index']] @ query[0] / np.linalg.norm(vectors[results[0]['index']]) \
+        / np.linalg.norm(query[0])
+    assert results[0]['score'] == pytest.approx(float(expected), rel=1e-5)
+    assert all(a['score'] >= b['score'] for a, b in zip(results, results[1:]))
+
+
+def test_search_threshold_and_small_corpus():
+    index, vectors = _build(n=3)
+    results = index.search(vectors[1], k=10, threshold=-1.0)
+    assert len(results) == 3 and results[0]['index'] == 1
+    assert [r['index'] for r in index.search(vectors[1], k=10, threshold=0.99)] == [1]
+    assert VectorIndex(dimension=32).search(vectors[0], k=5) == []
+
+
+@pytest.mark.parametrize('num_threads, query_block', [(None, 1024), (None, 3), (3, 1024)])
+def test_batch_topk_matches_exact_and_single_search(num_threads, query_block):
+    index, vectors = _build(n=700, block_size=100)
+    queries = _random_vectors(20, seed=7)
+    scores, indices = index.batch_topk(queries, k=8, num_threads=num_threads, query_block=query_block)
+    assert scores.shape == indices.shape == (20, 8)
+    np.testing.assert_array_equal(indices, _exact_topk(vectors, queries, 8))
+    batch = index.batch_search(queries, k=8, threshold=-1.0, num_threads=num_threads, query_block=query_block)
+    for query, results in zip(queries, batch):
+        single = index.search(query, k=8, threshold=-1.0)
+        assert [r['index'] for r in results] == [r['index'] for r in single]
+        np.testing.assert_allclose([r['score'] for r in results], [r['score'] for r in single], rtol=1e-5)
+
+
+def _clustered_vectors(n, dim=32, clusters=20, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32) * 3
+    return (centers[rng.integers(clusters, size=n)] + rng.standard_normal((n, dim))).astype(np.float32)
+
+
+def _build_from(vectors, **kwargs):
+    index = VectorIndex(dimension=vectors.shape[1], compact_threshold=None, **kwargs)
+    index.train(vectors)
+    index.add_vectors(vectors, [str(i) for i in range(len(vectors))])
+    return index
+
+
+def test_ivf_recall_against_brute_force():
+    vectors = _clustered_vectors(3000)
+    queries = _clustered_vectors(50, seed=1)
+    truth = _exact_topk(vectors, queries, 10)
+    index = _build_from(vectors, index_type='ivf', nlist=20, nprobe=4)
+    _, approx = index.batch_topk(queries, k=10)
+    assert _recall(approx, truth) >= 0.9
+    # 探查全部倒排表时等价于暴力搜索
+    index.nprobe = 20
+    _, full = index.batch_topk(queries, k=10)
+    assert _recall(full, truth) == 1.0
+
+
+def test_hnsw_recall_against_brute_force():
+    vectors = _random_vectors(1000, seed=3)
+    queries = _random_vectors(30, seed=4)
+    truth = _exact_topk(vectors, queries, 10)
+    index = _build_from(vectors, index_type='hnsw', M=16, ef_construction=64, ef_search=16)
+    _, low = index.batch_topk(queries, k=10)
+    index.ef_search = 128
+    _, high = index.batch_topk(queries, k=10)
+    assert _recall(high, truth) >= 0.95
+    assert _recall(high, truth) >= _recall(low, truth)
+    # 已入库的向量查自己应排第一
+    _, own = index.batch_topk(vectors[:20], k=1)
+    assert (own[:, 0] == np.arange(20)).mean() >= 0.95
+
+
+@pytest.mark.parametrize('storage, rerank_k, min_recall', [
+    ('fp16', 0, 0.99),
+    ('int8', 0, 0.9),
+    ('pq', 0, 0.4),
+    ('pq', 100, 0.95),
+])
+def test_compressed_storage_recall(storage, rerank_k, min_recall):
+    vectors = _clustered_vectors(2000)
+    queries = _clustered_vectors(40, seed=1)
+    index = _build_from(vectors, storage=storage, pq_m=8, rerank_k=rerank_k)
+    _, indices = index.batch_topk(queries, k=10)
+    assert _recall(indices, _exact_topk(vectors, queries, 10)) >= min_recall
+    results = index.search(queries[0], k=10, threshold=-1.0)
+    assert [r['index'] for r in results] == indices[0].tolist()
+
+
+def test_compressed_storage_rejects_unsupported_combinations():
+    with pytest.raises(ValueError):
+        VectorIndex(dimension=32, storage='int4')
+    with pytest.raises(ValueError):
+        VectorIndex(dimension=32, storage='pq', index_type='ivf')
+    with pytest.raises(ValueError):
+        VectorIndex(dimension=32, storage='int8', rerank_k=50, keep_vectors=False)
+
+
+@pytest.mark.parametrize('storage, ratio', [('fp16', 2), ('int8', 4), ('pq', 16)])
+def test_compressed_storage_shrinks_search_matrix(storage, ratio):
+    vectors = _clustered_vectors(2048)
+    baseline = _build_from(vectors, keep_vectors=False)
+    index = _build_from(vectors, storage=storage, pq_m=8, keep_vectors=False)
+    assert index.memory_usage()['normalized'] * ratio <= baseline.memory_usage()['normalized']
+
+
+@pytest.mark.parametrize('kwargs', [
+    {},
+    {'index_type': 'ivf', 'nlist': 10, 'nprobe': 10},
+    {'index_type': 'hnsw'},
+    {'storage': 'pq', 'pq_m': 8, 'rerank_k': 50},
+])
+@pytest.mark.parametrize('mmap', [True, False])
+def test_save_load_round_trip_then_append(tmp_path, kwargs, mmap):
+    vectors = _clustered_vectors(400)
+    metadata = [{'sku': f'S{i}', 'price': i} for i in range(300)]
+    index = VectorIndex(dimension=32, compact_threshold=None, **kwargs)
+    index.train(vectors[:300])
+    index.add_vectors(vectors[:300], [f'商品{i}' for i in range(300)], metadata)
+    path = str(tmp_path / 'idx')
+    index.save(path)
+    queries = vectors[::40]
+    before = index.batch_topk(queries, k=5)
+
+    loaded = VectorIndex()
+    loaded.load(path, mmap=mmap)
+    assert loaded.ntotal == 300 and loaded.index_type == index.index_type
+    assert loaded.texts[7] == '商品7' and loaded.metadata[7] == {'sku': 'S7', 'price': 7}
+    after = loaded.batch_topk(queries, k=5)
+    np.testing.assert_array_equal(after[1], before[1])
+    np.testing.assert_allclose(after[0], before[0], rtol=1e-5)
+
+    # 加载后继续追加：新行可搜到，磁盘上的目录不受影响
+    loaded.add_vectors(vectors[300:], [f'商品{i}' for i in range(300, 400)])
+    assert loaded.ntotal == 400 and loaded.texts[350] == '商品350'
+    hits = loaded.batch_topk(vectors[300:310], k=1)[1][:, 0]
+    assert (hits >= 300).mean() >= 0.9
+    reopened = VectorIndex()
+    reopened.load(path)
+    assert reopened.ntotal == 300
+
+
+def test_load_legacy_pickle(tmp_path):
+    import pickle
+
+    vectors = _random_vectors(20)
+    path = tmp_path / 'old.pkl'
+    with open(path, 'wb') as f:
+        pickle.dump({'dimension': 32, 'index_type': 'flat', 'vectors': vectors,
+                     'texts': [str(i) for i in range(20)], 'metadata': [{}] * 20}, f)
+    index = VectorIndex()
+    index.load(str(path))
+    assert index.ntotal == 20
+    assert index.search(vectors[3], k=1)[0]['text'] == '3'
+
+
+def test_delete_ignores_unknown_ids_and_duplicate_adds_fail():
+    index, vectors = _build(n=20)
+    assert index.delete([3, 3, 999]) == 1
+    assert 3 not in index and len(index) == 19
+    with pytest.raises(ValueError):
+        index.add_vectors(vectors[:1], ['重复'], ids=[4])
+
+
+def test_tombstones_survive_save_load(tmp_path):
+    index, vectors = _build(n=200)
+    index.delete(list(range(0, 200, 4)))
+    index.save(str(tmp_path / 'idx'))
+    loaded = VectorIndex()
+    loaded.load(str(tmp_path / 'idx'))
+    assert loaded.num_deleted == 50 and len(loaded) == 150
+    assert 4 not in loaded and 5 in loaded
+    _, rows = loaded.batch_topk(vectors[:40], k=5)
+    assert not np.isin(loaded.get_ids(rows.ravel()), np.arange(0, 200, 4)).any()
+    # 加载后继续删除 / 新增 id 不会与已有 id 冲突
+    loaded.delete([5])
+    loaded.add_vectors(vectors[:1], ['新'])
+    assert len(loaded) == 150 and loaded.get_ids([loaded.ntotal - 1])[0] == 200
+
+
+def test_background_compaction_with_concurrent_reads():
+    import threading
+
+    index, vectors = _build(n=1000)
+    index.compact_threshold = 0.2
+    errors = []
+    stop = threading.Event()
+
+    def reader():
+        while not stop.is_set():
+            try:
+                _, rows = index.batch_topk(vectors[:5], k=3)
+                if (rows < 0).any():
+                    errors.append('short result')
+            except Exception as e:  # 压缩替换状态期间读到任何异常都算失败
+                errors.append(repr(e))
+
+    thread = threading.Thread(target=reader)
+    thread.start()
+    index.delete(list(range(500, 800)))  # 超过阈值，自动触发后台压缩
+    index.add_vectors(_random_vectors(10, seed=9), ['新'] * 10)
+    index.wait_for_compaction()
+    stop.set()
+    thread.join()
+    assert errors == []
+    assert index.num_deleted == 0 and len(index) == index.ntotal == 710
+    assert set(range(500, 800)).isdisjoint(index.get_ids(np.arange(index.ntotal)).tolist())
+
+
+FILTERS = [
+    {'category': 'c3'},
+    {'category': ['c1', 'c2'], 'in_stock': True},
+    {'price': (100, 600)},
+    {'price': (None, 950), 'tags': 'b'},
+    {'tags': ['a', 'c'], 'price': (10.0, 300.0)},
+    {'category': 'missing'},
+]
+
+
+def _with_metadata(n=1500, index_fields=True, **kwargs):
+    rng = np.random.default_rng(2)
+    vectors = _clustered_vectors(n)
+    metadata = [{'category': f'c{rng.integers(10)}', 'price': float(rng.uniform(0, 1000)),
+                 'in_stock': bool(rng.random() < 0.7),
+                 'tags': [t for t in 'abc' if rng.random() < 0.4]} for _ in range(n)]
+    index = VectorIndex(dimension=32, compact_threshold=None, **kwargs)
+    if index_fields:
+        index.create_attribute_index('category')
+        index.create_attribute_index('in_stock')
+        index.create_attribute_index('tags')
+        index.create_attribute_index('price', kind='numeric')
+    index.train(vectors)
+    index.add_vectors(vectors, [str(i) for i in range(n)], metadata)
+    return index, vectors
+
+
+@pytest.mark.parametrize('filters', FILTERS)
+def test_attribute_indexes_match_metadata_scan(filters):
+    indexed, _ = _with_metadata()
+    scanned, _ = _with_metadata(index_fields=False)
+    for index in (indexed, scanned):
+        index.delete(list(range(0, 1500, 10)))
+    rows = indexed.filter_rows(filters)
+    np.testing.assert_array_equal(rows, scanned.filter_rows(filters))
+    assert len(np.unique(rows)) == len(rows) and not np.isin(rows, np.arange(0, 1500, 10)).any()
+
+
+@pytest.mark.parametrize('prefilter_ratio', [0.0, 1.0])
+@pytest.mark.parametrize('filters', FILTERS[:5])
+def test_filtered_flat_search_is_exact(filters, prefilter_ratio):
+    index, vectors = _with_metadata(prefilter_ratio=prefilter_ratio)
+    queries = _clustered_vectors(10, seed=5)
+    live = np.zeros(len(vectors), dtype=bool)
+    live[index.filter_rows(filters)] = True
+    _, rows = index.batch_topk(queries, k=10, filters=filters)
+    np.testing.assert_array_equal(rows, _exact_topk(vectors, queries, 10, live))
+
+
+@pytest.mark.parametrize('kwargs', [{'index_type': 'hnsw'}, {'index_type': 'ivf', 'nlist': 20, 'nprobe': 8}])
+def test_filtered_ann_search_only_returns_matches(kwargs):
+    index, vectors = _with_metadata(n=800, prefilter_ratio=0.05, **kwargs)
+    queries = _clustered_vectors(10, seed=5)
+    for filters in FILTERS[:5]:
+        allowed = index.filter_rows(filters)
+        live = np.zeros(len(vectors), dtype=bool)
+        live[allowed] = True
+        _, rows = index.batch_topk(queries, k=10, filters=filters)
+        assert np.isin(rows[rows >= 0], allowed).all()
+        assert (rows >= 0).sum(axis=1).tolist() == [min(10, len(allowed))] * len(queries)
+        assert _recall(rows, _exact_topk(vectors, queries, 10, live)) >= 0.8
+
+
+def test_attribute_indexes_survive_save_load(tmp_path):
+    index, _ = _with_metadata(n=300)
+    index.save(str(tmp_path / 'idx'))
+    loaded = VectorIndex()
+    loaded.load(str(tmp_path / 'idx'))
+    for filters in FILTERS:
+        np.testing.assert_array_equal(loaded.filter_rows(filters), index.filter_rows(filters))
@@ -0,0 +1,139 @@
+import time
+import contextlib
+import torch
+
+try:
+    import resource  # 仅类 Unix 平台提供，用于读取进程峰值 RSS
+    RESOURCE_AVAILABLE = True
+except ImportError:
+    RESOURCE_AVAILABLE = False
+
+
+class StepProfiler:
+    """
+    训练步分阶段计时：
+    - data / forward / backward / optimizer 四个阶段的平均耗时，data 阶段即 DataLoader 阻塞时间
+    - 每 report_every 步输出一次 samples/s、tokens/s、峰值内存与数据等待占比
+    - trace_steps=(start, end) 时抓取第 start ~ end 步（从 1 计数，含两端）的 torch.profiler 轨迹，写到 trace_path
+    report_every=0 且未指定 trace_steps 时所有接口都是空操作，不影响训练速度。
+    """
+
+    PHASES = ('data', 'forward', 'backward', 'optimizer')
+
+    def __init__(self, device, report_every=0, trace_steps=None, trace_path='train_trace.json', log=print):
+        self.device = torch.device(device)
+        self.report_every = report_every
+        self.trace_steps = tuple(trace_steps) if trace_steps else None
+        self.trace_path = trace_path
+        self.log = log
+        self.enabled = bool(report_every) or self.trace_steps is not None
+        self.step = 0
+        self._profiler = None
+        self._reset_window()
+
+    def _reset_window(self):
+        self._times = {p: 0.0 for p in self.PHASES}
+        self._samples = 0
+        self._tokens = 0
+        self._steps = 0
+        self._window_start = time.perf_counter()
+        if self.device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    def _sync(self):
+        # CUDA 是异步执行的，不同步的话时间会记到下一个阶段
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """给一个阶段计时；抓取轨迹期间同时打上 record_function 标记"""
+        if not self.enabled:
+            yield
+            return
+        self._sync()
+        start = time.perf_counter()
+        label = torch.profiler.record_function(name) if self._profiler is not None else contextlib.nullcontext()
+        with label:
+            yield
+        self._sync()
+        self._times[name] += time.perf_counter() - start
+
+    def wrap_loader(self, iterable):
+        """包装 DataLoader：等待下一个 batch 的时间记入 data 阶段"""
+        if not self.enabled:
+            yield from iterable
+            return
+        self._toggle_trace()
+        it = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(it)
+            except StopIteration:
+                return
+            self._times['data'] += time.perf_counter() - start
+            yield batch
+
+    def step_end(self, num_samples, num_tokens):
+        """每个训练步结束时调用，累计吞吐并按需输出报告 / 开关轨迹抓取"""
+        if not self.enabled:
+            return
+        self.step += 1
+        self._steps += 1
+        self._samples += num_samples
+        self._tokens += num_tokens
+
+        self._toggle_trace()
+
+        if self.report_every and self._steps >= self.report_every:
+            self.log(self.report())
+            self._reset_window()
+
+    def peak_memory_mb(self):
+        """CUDA 为本窗口的峰值显存；CPU 为进程峰值 RSS（Linux 下 ru_maxrss 单位为 KB），拿不到时返回 0"""
+        if self.device.type == 'cuda':
+            return torch.cuda.max_memory_allocated(self.device) / 2 ** 20
+        if not RESOURCE_AVAILABLE:
+            return 0.0
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    def report(self):
+        """当前窗口的统计信息"""
+        elapsed = max(time.perf_counter() - self._window_start, 1e-9)
+        steps = max(self._steps, 1)
+        phases = ' | '.join(f"{p} {1000 * self._times[p] / steps:.1f}ms" for p in self.PHASES)
+        return (f"[profile] step {self.step} | {phases} | "
+                f"数据等待 {self._times['data'] / elapsed:.0%} | "
+                f"{self._samples / elapsed:,.1f} samples/s | {self._tokens / elapsed:,.0f} tokens/s | "
+                f"峰值内存 {self.peak_memory_mb():,.0f} MB")
+
+    def _toggle_trace(self):
+        """在第 start 步开始前打开 profiler，第 end 步结束后关闭并导出"""
+        if self.trace_steps is None:
+            return
+        start, end = self.trace_steps
+        if self._profiler is None and self.step + 1 == start:
+            self._start_trace()
+        elif self._profiler is not None and self.step >= end:
+            self._stop_trace()
+
+    def _start_trace(self):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if self.device.type == 'cuda':
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self._profiler = torch.profiler.profile(activities=activities, record_shapes=True,
+                                                profile_memory=True, with_stack=False)
+        self._profiler.__enter__()
+        self.log(f"[profile] 开始抓取轨迹: step {self.trace_steps[0]} ~ {self.trace_steps[1]}")
+
+    def _stop_trace(self):
+        self._profiler.__exit__(None, None, None)
+        self._profiler.export_chrome_trace(self.trace_path)
+        self._profiler = None
+        self.log(f"[profile] 轨迹已写入: {self.trace_path}（可用 chrome://tracing 或 Perfetto 打开）")
+
+    def close(self):
+        """训练结束时调用：抓取窗口未走完也把已有轨迹写出"""
+        if self._profiler is not None:
+            self._stop_trace()
@@ -1,8 +1,18 @@
 import numpy as np
 import pickle
 import os
+import sys
+import json
+import shutil
+import math
+import heapq
+import time
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 from sentence_encoder import SentenceTransformer
 from nlp_transformer import TextTokenizer
+from bm25_index import BM25Index, reciprocal_rank_fusion, weighted_score_fusion
 import torch
 
 try:
@@ -12,152 +22,1973 @@ except ImportError:
     FAISS_AVAILABLE = False
     print("警告: FAISS 未安装，将使用简单的暴力搜索")
 
+class VectorStore:
+    """
+    按容量翻倍增长的行存储：追加均摊 O(1)，不再每次 np.vstack 整体复制；
+    有效数据 data 始终是一块连续内存，可以直接做矩阵运算。
+    """
+
+    def __init__(self, dimension, dtype=np.float32, initial_capacity=1024):
+        self.dimension = dimension
+        self.dtype = np.dtype(dtype)
+        self.initial_capacity = initial_capacity
+        self._data = np.empty((0, dimension), dtype=self.dtype)
+        self._size = 0
+
+    @classmethod
+    def wrap(cls, array):
+        """
+        直接包装已有数组（如只读 mmap）而不复制：容量等于长度，
+        第一次追加时才扩容复制到内存，原数组本身不会被写。
+        """
+        store = cls(array.shape[1], dtype=array.dtype)
+        store._data = array
+        store._size = len(array)
+        return store
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def data(self):
+        """当前有效的 (n, dimension) 视图；扩容后旧视图不会再看到新追加的行"""
+        return self._data[:self._size]
+
+    @property
+    def capacity(self):
+        return self._data.shape[0]
+
+    def reserve(self, capacity):
+        """确保至少能容纳 capacity 行（容量不足时翻倍扩容）"""
+        if capacity <= self.capacity:
+            return
+        new_capacity = max(capacity, 2 * self.capacity, self.initial_capacity)
+        data = np.empty((new_capacity, self.dimension), dtype=self.dtype)
+        data[:self._size] = self._data[:self._size]
+        self._data = data
+
+    def append(self, rows):
+        """追加若干行，返回第一行的下标"""
+        rows = np.asarray(rows, dtype=self.dtype).reshape(-1, self.dimension)
+        start = self._size
+        self.reserve(start + len(rows))
+        self._data[start:start + len(rows)] = rows
+        self._size += len(rows)
+        return start
+
+    def shrink_to_fit(self):
+        """释放多余容量（批量导入结束后调用）"""
+        if self.capacity > self._size:
+            self._data = self._data[:self._size].copy()
+
+    @property
+    def nbytes(self):
+        """有效数据占用的字节数"""
+        return self._size * self.dimension * self.dtype.itemsize
+
+    @property
+    def capacity_nbytes(self):
+        """实际分配的字节数（含预留容量）"""
+        return self._data.nbytes
+
+
+def _normalize_rows(x):
+    """按行 L2 归一化（float32），零向量保持为零"""
+    x = np.asarray(x, dtype=np.float32)
+    norms = np.linalg.norm(x, axis=-1, keepdims=True)
+    return x / np.clip(norms, 1e-8, None)
+
+
+# ===== 磁盘格式：目录 + manifest.json，大数组为 .npy（可 mmap），文本 / 元数据为 数据文件 + 偏移量 =====
+INDEX_FORMAT = 'vector_index'
+# 版本 2：增加 row_ids.npy（行号 -> 外部 id）与 deleted.npy（墓碑位图），版本 1 的目录按连续 id、无删除加载
+INDEX_FORMAT_VERSION = 2
+
+
+def _save_array(dirpath, name, array):
+    np.save(os.path.join(dirpath, name + '.npy'), np.ascontiguousarray(array))
+
+
+def _load_array(dirpath, name, mmap_mode='r'):
+    """mmap_mode='r' 只读共享页；'c' 写时复制（需要原地修改的数组，如 HNSW 邻居表）；None 读进内存"""
+    path = os.path.join(dirpath, name + '.npy')
+    if mmap_mode is None:
+        return np.load(path)
+    try:
+        # 转成普通 ndarray 视图（不复制），参与运算时不会再生成 memmap 子类对象
+        return np.asarray(np.load(path, mmap_mode=mmap_mode))
+    except ValueError:
+        # 长度为 0 的数组无法 mmap
+        return np.load(path)
+
+
+class OffsetRecordList:
+    """
+    变长记录的只读列表：数据文件（拼接的 utf-8 字节）+ 偏移量数组，按下标即时解码，
+    加载时不解析任何记录，多个进程可以共享同一份 mmap 页。
+    支持 append / extend：新记录留在内存里，下次保存时一起写出。
+    """
+
+    def __init__(self, data, offsets, decode):
+        self._data = data
+        self._offsets = offsets
+        self._decode = decode
+        self._base = len(offsets) - 1
+        self._tail = []
+
+    @staticmethod
+    def write(dirpath, name, items, encode):
+        """把记录写成 name.bin + name.offsets.npy"""
+        offsets = [0]
+        with open(os.path.join(dirpath, name + '.bin'), 'wb') as f:
+            for item in items:
+                raw = encode(item)
+                f.write(raw)
+                offsets.append(offsets[-1] + len(raw))
+        _save_array(dirpath, name + '.offsets', np.asarray(offsets, dtype=np.int64))
+
+    @classmethod
+    def open(cls, dirpath, name, decode, mmap=True):
+        offsets = _load_array(dirpath, name + '.offsets', 'r' if mmap else None)
+        path = os.path.join(dirpath, name + '.bin')
+        if offsets[-1] == 0:
+            data = b''
+        elif mmap:
+            data = np.asarray(np.memmap(path, dtype=np.uint8, mode='r'))
+        else:
+            with open(path, 'rb') as f:
+                data = f.read()
+        return cls(data, offsets, decode)
+
+    def __len__(self):
+        return self._base + len(self._tail)
+
+    def _get(self, i):
+        if i >= self._base:
+            return self._tail[i - self._base]
+        start, end = self._offsets[i], self._offsets[i + 1]
+        return self._decode(self._data[start:end].tobytes() if isinstance(self._data, np.ndarray)
+                            else self._data[start:end])
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._get(j) for j in range(*i.indices(len(self)))]
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self._get(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._get(i)
+
+    def append(self, item):
+        self._tail.append(item)
+
+    def extend(self, items):
+        self._tail.extend(items)
+
+    @property
+    def nbytes(self):
+        return (len(self._data) + self._offsets.nbytes + sys.getsizeof(self._tail)
+                + sum(sys.getsizeof(t) for t in self._tail))
+
+
+def _encode_text(text):
+    return str(text).encode('utf-8')
+
+
+def _decode_text(raw):
+    return raw.decode('utf-8')
+
+
+def _json_default(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    return str(obj)
+
+
+def _encode_metadata(meta):
+    """元数据按 JSON 存储；numpy 标量 / 数组转成 Python 值，其他无法序列化的对象存为字符串"""
+    return json.dumps(meta, ensure_ascii=False, default=_json_default).encode('utf-8')
+
+
+def _decode_metadata(raw):
+    return json.loads(raw.decode('utf-8'))
+
+
+def _exclude_penalty(exclude):
+    """屏蔽位图 -> 打分时直接相加的偏置：屏蔽的行为 -inf，其余为 0"""
+    return np.where(exclude, np.float32(-np.inf), np.float32(0))
+
+
+def _assign_nearest(x, centroids, spherical=True, block_size=4096):
+    """
+    把每行分到最近的中心，分块计算控制临时内存。
+    spherical=True 按内积（输入均已归一化时即余弦最近）；否则按欧氏距离：argmax(x·c - |c|²/2)
+    """
+    bias = 0 if spherical else -0.5 * np.sum(centroids * centroids, axis=1)
+    assign = np.empty(len(x), dtype=np.int64)
+    for start in range(0, len(x), block_size):
+        assign[start:start + block_size] = np.argmax(x[start:start + block_size] @ centroids.T + bias, axis=1)
+    return assign
+
+
+def kmeans(x, k, niter=20, seed=0, spherical=True):
+    """
+    k-means；spherical=True 为球面 k-means（中心每轮重新归一化，与余弦相似度一致），
+    否则为欧氏距离下的普通 k-means（乘积量化的子空间用）。空簇用随机样本重新初始化。
+    """
+    x = np.asarray(x, dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    k = min(k, len(x))
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(niter):
+        assign = _assign_nearest(x, centroids, spherical=spherical)
+        counts = np.bincount(assign, minlength=k)
+        order = np.argsort(assign, kind='stable')
+        nonempty = np.flatnonzero(counts)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[nonempty]
+        sums = np.zeros_like(centroids)
+        sums[nonempty] = np.add.reduceat(x[order], starts, axis=0)
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            sums[empty] = x[rng.choice(len(x), len(empty), replace=False)]
+        if spherical:
+            centroids = _normalize_rows(sums)
+        else:
+            centroids = sums / np.maximum(counts, 1)[:, None].astype(np.float32)
+            centroids[empty] = sums[empty]
+    return centroids
+
+
+class Float16Codec:
+    """半精度存储：每维 2 字节，打分时按块转回 float32"""
+
+    dtype = np.float16
+    is_trained = True
+
+    def __init__(self, dimension):
+        self.code_dim = dimension
+
+    def train(self, x):
+        pass
+
+    def encode(self, x):
+        return np.asarray(x, dtype=np.float16)
+
+    def decode(self, codes):
+        return np.asarray(codes, dtype=np.float32)
+
+    def prepare(self, queries):
+        return queries
+
+    def scores(self, prepared, codes):
+        """(查询数, 块大小) 的内积"""
+        return prepared @ codes.astype(np.float32).T
+
+    def state_dict(self):
+        return {}
+
+    def load_state_dict(self, state):
+        pass
+
+    nbytes = 0
+
+
+class ScalarQuantizer8:
+    """
+    逐维 int8 标量量化：每维按训练集的 [min, max] 均匀分成 256 级，每维 1 字节。
+    非对称打分：查询保持 float32，q·x ≈ q·vmin + (q*scale)·code，不需要先解码向量。
+    """
+
+    dtype = np.uint8
+
+    def __init__(self, dimension):
+        self.code_dim = dimension
+        self.vmin = None
+        self.scale = None
+
+    @property
+    def is_trained(self):
+        return self.vmin is not None
+
+    def train(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        self.vmin = x.min(axis=0)
+        self.scale = np.maximum((x.max(axis=0) - self.vmin) / 255, 1e-12).astype(np.float32)
+
+    def encode(self, x):
+        codes = np.rint((np.asarray(x, dtype=np.float32) - self.vmin) / self.scale)
+        return np.clip(codes, 0, 255).astype(np.uint8)
+
+    def decode(self, codes):
+        return self.vmin + codes.astype(np.float32) * self.scale
+
+    def prepare(self, queries):
+        return queries * self.scale, queries @ self.vmin
+
+    def scores(self, prepared, codes):
+        scaled, bias = prepared
+        return scaled @ codes.astype(np.float32).T + bias[:, None]
+
+    def state_dict(self):
+        return {} if self.vmin is None else {'vmin': self.vmin, 'scale': self.scale}
+
+    def load_state_dict(self, state):
+        if 'vmin' in state:
+            self.vmin = np.asarray(state['vmin'], dtype=np.float32)
+            self.scale = np.asarray(state['scale'], dtype=np.float32)
+
+    @property
+    def nbytes(self):
+        return 0 if self.vmin is None else self.vmin.nbytes + self.scale.nbytes
+
+
+class ProductQuantizer:
+    """
+    乘积量化：向量切成 m 段，每段用 2^nbits 个中心（欧氏 k-means）编码成 1 字节，每条向量 m 字节。
+    非对称距离计算（ADC）：每个查询先算出 (m, ksub) 的查找表，打分只是 m 次查表相加。
+    """
+
+    dtype = np.uint8
+
+    def __init__(self, dimension, m=16, nbits=8, niter=20, max_train=65536, seed=0):
+        if dimension % m != 0:
+            raise ValueError(f"维度 {dimension} 不能被 PQ 段数 {m} 整除")
+        if nbits > 8:
+            raise ValueError("PQ 每段最多 8 bit")
+        self.dimension = dimension
+        self.m = m
+        self.dsub = dimension // m
+        self.ksub = 2 ** nbits
+        self.niter = niter
+        self.max_train = max_train
+        self.seed = seed
+        self.code_dim = m
+        self.centroids = None  # (m, ksub, dsub)
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    def _split(self, x):
+        return np.asarray(x, dtype=np.float32).reshape(len(x), self.m, self.dsub)
+
+    def train(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        if len(x) > self.max_train:
+            x = x[np.random.default_rng(self.seed).choice(len(x), self.max_train, replace=False)]
+        sub = self._split(x)
+        self.centroids = np.stack([kmeans(sub[:, j], self.ksub, niter=self.niter, seed=self.seed + j,
+                                          spherical=False) for j in range(self.m)])
+
+    def encode(self, x):
+        sub = self._split(x)
+        codes = np.empty((len(sub), self.m), dtype=np.uint8)
+        for j in range(self.m):
+            codes[:, j] = _assign_nearest(sub[:, j], self.centroids[j], spherical=False)
+        return codes
+
+    def decode(self, codes):
+        return np.concatenate([self.centroids[j][codes[:, j]] for j in range(self.m)], axis=1)
+
+    def prepare(self, queries):
+        """查找表 (查询数, m, ksub)：每段查询子向量与该段各中心的内积"""
+        return np.einsum('qjd,jkd->qjk', self._split(queries), self.centroids)
+
+    def scores(self, lut, codes):
+        out = np.zeros((len(lut), len(codes)), dtype=np.float32)
+        for j in range(self.m):
+            out += lut[:, j, codes[:, j]]
+        return out
+
+    def state_dict(self):
+        return {} if self.centroids is None else {'centroids': self.centroids}
+
+    def load_state_dict(self, state):
+        if 'centroids' in state:
+            self.centroids = np.asarray(state['centroids'], dtype=np.float32)
+
+    @property
+    def nbytes(self):
+        return 0 if self.centroids is None else self.centroids.nbytes
+
+
+STORAGE_TYPES = ('float32', 'fp16', 'int8', 'pq')
+
+
+def _make_codec(storage, dimension, pq_m=16):
+    if storage == 'float32':
+        return None
+    if storage == 'fp16':
+        return Float16Codec(dimension)
+    if storage == 'int8':
+        return ScalarQuantizer8(dimension)
+    if storage == 'pq':
+        return ProductQuantizer(dimension, m=pq_m)
+    raise ValueError(f"不支持的存储类型: {storage}，可选 {STORAGE_TYPES}")
+
+
+class IVFIndex:
+    """
+    纯 NumPy 的 IVF（倒排文件）近似索引，供没装 FAISS 的环境使用：
+    - train：球面 k-means 训练 nlist 个粗聚类中心（样本过多时只取 max_train_per_list * nlist 条）
+    - add：每条向量分到最近的中心，倒排表的向量和 id 各存成一块连续数组（VectorStore，均摊 O(1) 追加）
+    - search：先找最近的 nprobe 个中心，只扫描这些倒排表
+    输入向量应已归一化，内积即余弦相似度。
+    """
+
+    def __init__(self, dimension, nlist=100, nprobe=10, niter=20, max_train_per_list=256, seed=0):
+        self.dimension = dimension
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.niter = niter
+        self.max_train_per_list = max_train_per_list
+        self.seed = seed
+        self.centroids = None
+        self._lists = []
+        self._ids = []
+        self.ntotal = 0
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    def train(self, x):
+        x = np.asarray(x, dtype=np.float32).reshape(-1, self.dimension)
+        limit = self.max_train_per_list * self.nlist
+        if len(x) > limit:
+            x = x[np.random.default_rng(self.seed).choice(len(x), limit, replace=False)]
+        self.centroids = kmeans(x, self.nlist, niter=self.niter, seed=self.seed)
+        # 训练样本少于 nlist 时中心数会变少
+        self._lists = [VectorStore(self.dimension, initial_capacity=64) for _ in range(len(self.centroids))]
+        self._ids = [VectorStore(1, dtype=np.int64, initial_capacity=64) for _ in range(len(self.centroids))]
+
+    def add(self, x, ids=None):
+        """追加向量；ids 缺省为连续编号"""
+        if not self.is_trained:
+            raise RuntimeError("IVF 索引尚未训练")
+        x = np.asarray(x, dtype=np.float32).reshape(-1, self.dimension)
+        if ids is None:
+            ids = np.arange(self.ntotal, self.ntotal + len(x))
+        ids = np.asarray(ids, dtype=np.int64)
+        assign = _assign_nearest(x, self.centroids)
+        order = np.argsort(assign, kind='stable')
+        lists, starts = np.unique(assign[order], return_index=True)
+        bounds = list(starts[1:]) + [len(order)]
+        for lst, start, end in zip(lists, starts, bounds):
+            rows = order[start:end]
+            self._lists[lst].append(x[rows])
+            self._ids[lst].append(ids[rows])
+        self.ntotal += len(x)
+
+    def search(self, queries, k, nprobe=None):
+        """返回 (scores, ids)，形状 (查询数, k)，不足 k 个时 id 为 -1"""
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dimension)
+        m = len(queries)
+        scores = np.full((m, k), -np.inf, dtype=np.float32)
+        ids = np.full((m, k), -1, dtype=np.int64)
+        if not self.is_trained or self.ntotal == 0:
+            return scores, ids
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        coarse = queries @ self.centroids.T
+        probes = np.argpartition(coarse, -nprobe, axis=1)[:, -nprobe:]
+        for qi in range(m):
+            cand_scores, cand_ids = [], []
+            for lst in probes[qi]:
+                if len(self._lists[lst]):
+                    cand_scores.append(self._lists[lst].data @ queries[qi])
+                    cand_ids.append(self._ids[lst].data[:, 0])
+            if not cand_scores:
+                continue
+            s = np.concatenate(cand_scores)
+            i = np.concatenate(cand_ids)
+            kk = min(k, len(s))
+            if len(s) > kk:
+                top = np.argpartition(s, -kk)[-kk:]
+                s, i = s[top], i[top]
+            order = np.argsort(-s, kind='stable')
+            scores[qi, :kk] = s[order]
+            ids[qi, :kk] = i[order]
+        return scores, ids
+
+    def reconstruct(self):
+        """按 id 顺序还原全部向量（id 需为 0..ntotal-1 的连续编号）"""
+        out = np.zeros((self.ntotal, self.dimension), dtype=np.float32)
+        for vecs, ids in zip(self._lists, self._ids):
+            if len(vecs):
+                out[ids.data[:, 0]] = vecs.data
+        return out
+
+    def save(self, dirpath):
+        """倒排表按列表顺序拼成一块连续数组 + 每个列表的起止偏移，加载时直接切片 mmap"""
+        if not self.is_trained:
+            return
+        _save_array(dirpath, 'ivf_centroids', self.centroids)
+        sizes = [len(v) for v in self._lists]
+        _save_array(dirpath, 'ivf_offsets', np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64))
+        empty_vecs = np.zeros((0, self.dimension), dtype=np.float32)
+        empty_ids = np.zeros((0, 1), dtype=np.int64)
+        _save_array(dirpath, 'ivf_vectors', np.concatenate([v.data for v in self._lists] or [empty_vecs]))
+        _save_array(dirpath, 'ivf_ids', np.concatenate([i.data for i in self._ids] or [empty_ids]))
+
+    def load(self, dirpath, mmap=True):
+        """读取 save 写出的数组，不重新训练；倒排表直接引用 mmap 切片，追加时才复制"""
+        if not os.path.exists(os.path.join(dirpath, 'ivf_centroids.npy')):
+            return
+        mode = 'r' if mmap else None
+        self.centroids = np.array(_load_array(dirpath, 'ivf_centroids', None))
+        offsets = _load_array(dirpath, 'ivf_offsets', None)
+        vectors = _load_array(dirpath, 'ivf_vectors', mode)
+        ids = _load_array(dirpath, 'ivf_ids', mode)
+        self._lists = [VectorStore.wrap(vectors[a:b]) for a, b in zip(offsets[:-1], offsets[1:])]
+        self._ids = [VectorStore.wrap(ids[a:b]) for a, b in zip(offsets[:-1], offsets[1:])]
+        self.ntotal = int(offsets[-1])
+
+    @property
+    def nbytes(self):
+        centroids = self.centroids.nbytes if self.centroids is not None else 0
+        return centroids + sum(v.capacity_nbytes + i.capacity_nbytes for v, i in zip(self._lists, self._ids))
+
+
+class HNSWIndex:
+    """
+    纯 NumPy / Python 的 HNSW 图索引（FAISS 不可用时的后备实现）：
+    - 支持逐条增量插入，不需要训练，新商品随时加入
+    - 图用数组存储：第 0 层每个节点一行 M0=2*M 个邻居，上层每层一张 (节点数, M) 的邻居表
+      外加 节点 -> 行号 的映射，空位填 -1
+    - ef_construction / ef_search 控制建图与查询时的候选集大小
+    输入向量应已归一化，相似度为内积（余弦）。
+    """
+
+    def __init__(self, dimension, M=16, ef_construction=100, ef_search=64, seed=0):
+        self.dimension = dimension
+        self.M = M
+        self.M0 = 2 * M
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self._level_mult = 1 / math.log(M)
+        self._rng = np.random.default_rng(seed)
+        self._vectors = VectorStore(dimension)
+        self._levels = VectorStore(1, dtype=np.int8)
+        self._links0 = VectorStore(self.M0, dtype=np.int32)
+        self._upper = {}  # level -> (节点 -> 行号, 该层邻居表)
+        self.entry_point = -1
+        self.max_level = -1
+        self.ntotal = 0
+
+    is_trained = True
+
+    def train(self, x):
+        """HNSW 不需要训练，保留接口与 IVFIndex 一致"""
+
+    def _links(self, node, level):
+        if level == 0:
+            return self._links0.data[node]
+        rows, table = self._upper[level]
+        return table.data[rows[node]]
+
+    def _neighbors(self, node, level):
+        links = self._links(node, level)
+        return links[links >= 0]
+
+    def _search_layer(self, q, entry_points, ef, level):
+        """在某一层上做最佳优先搜索，返回按相似度降序的 [(sim, node), ...]"""
+        vectors = self._vectors.data
+        visited = set(entry_points)
+        sims = vectors[entry_points] @ q
+        candidates = [(-sim, node) for sim, node in zip(sims.tolist(), entry_points)]
+        heapq.heapify(candidates)
+        results = [(sim, node) for sim, node in zip(sims.tolist(), entry_points)]
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+        while candidates:
+            neg_sim, node = heapq.heappop(candidates)
+            if len(results) >= ef and -neg_sim < results[0][0]:
+                break
+            fresh = [n for n in self._neighbors(node, level).tolist() if n not in visited]
+            if not fresh:
+                continue
+            visited.update(fresh)
+            for sim, n in zip((vectors[fresh] @ q).tolist(), fresh):
+                if len(results) < ef or sim > results[0][0]:
+                    heapq.heappush(candidates, (-sim, n))
+                    heapq.heappush(results, (sim, n))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+        return sorted(results, reverse=True)
+
+    def _select_neighbors(self, candidates, m):
+        """
+        启发式选邻居：候选按相似度降序，只保留比已选邻居更接近目标的点，保证各方向都有连边；
+        不足 m 个时用被淘汰的候选补齐。
+        """
+        if len(candidates) <= m:
+            return [node for _, node in candidates]
+        nodes = [node for _, node in candidates]
+        vecs = self._vectors.data[nodes]
+        pairwise = vecs @ vecs.T
+        # closest[i]：候选 i 与已选邻居的最大相似度，每选中一个点更新一次
+        closest = np.full(len(nodes), -np.inf, dtype=np.float32)
+        selected, pruned = [], []
+        for i, (sim, node) in enumerate(candidates):
+            if len(selected) >= m:
+                break
+            if closest[i] < sim:
+                selected.append(i)
+                np.maximum(closest, pairwise[i], out=closest)
+            else:
+                pruned.append(i)
+        selected.extend(pruned[:m - len(selected)])
+        return [nodes[i] for i in selected]
+
+    def _set_links(self, node, level, neighbors):
+        links = self._links(node, level)
+        links[:] = -1
+        links[:len(neighbors)] = neighbors
+
+    def _connect(self, node, neighbor, level):
+        """给 neighbor 加一条指向 node 的反向边，邻居已满时重新挑选"""
+        links = self._links(neighbor, level)
+        free = np.flatnonzero(links < 0)
+        if len(free):
+            links[free[0]] = node
+            return
+        vectors = self._vectors.data
+        pool = np.append(links, node)
+        sims = vectors[pool] @ vectors[neighbor]
+        order = np.argsort(-sims)
+        candidates = [(float(sims[i]), int(pool[i])) for i in order]
+        self._set_links(neighbor, level, self._select_neighbors(candidates, len(links)))
+
+    def add(self, x, ids=None):
+        """逐条插入；节点编号即插入顺序（ids 只能是连续编号，与 IVFIndex 接口保持一致）"""
+        x = np.asarray(x, dtype=np.float32).reshape(-1, self.dimension)
+        if ids is not None and not np.array_equal(ids, np.arange(self.ntotal, self.ntotal + len(x))):
+            raise ValueError("HNSWIndex 只支持连续编号的 ids")
+        for v in x:
+            self._insert(v)
+
+    def _insert(self, v):
+        node = self._vectors.append(v)
+        level = int(-math.log(1.0 - self._rng.random()) * self._level_mult)
+        self._levels.append([level])
+        self._links0.append(np.full(self.M0, -1, dtype=np.int32))
+        for l in range(1, level + 1):
+            if l not in self._upper:
+                self._upper[l] = ({}, VectorStore(self.M, dtype=np.int32, initial_capacity=64))
+            rows, table = self._upper[l]
+            rows[node] = table.append(np.full(self.M, -1, dtype=np.int32))
+        self.ntotal += 1
+
+        if self.entry_point < 0:
+            self.entry_point, self.max_level = node, level
+            return
+        entry = [self.entry_point]
+        for l in range(self.max_level, level, -1):
+            entry = [self._search_layer(v, entry, 1, l)[0][1]]
+        for l in range(min(level, self.max_level), -1, -1):
+            found = self._search_layer(v, entry, self.ef_construction, l)
+            neighbors = self._select_neighbors(found, self.M)
+            self._set_links(node, l, neighbors)
+            for n in neighbors:
+                self._connect(node, n, l)
+            entry = [n for _, n in found]
+        if level > self.max_level:
+            self.entry_point, self.max_level = node, level
+
+    def search(self, queries, k, ef=None):
+        """返回 (scores, ids)，形状 (查询数, k)，不足 k 个时 id 为 -1"""
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dimension)
+        m = len(queries)
+        scores = np.full((m, k), -np.inf, dtype=np.float32)
+        ids = np.full((m, k), -1, dtype=np.int64)
+        if self.entry_point < 0:
+            return scores, ids
+        ef = max(ef or self.ef_search, k)
+        for qi, q in enumerate(queries):
+            entry = [self.entry_point]
+            for l in range(self.max_level, 0, -1):
+                entry = [self._search_layer(q, entry, 1, l)[0][1]]
+            found = self._search_layer(q, entry, ef, 0)[:k]
+            scores[qi, :len(found)] = [sim for sim, _ in found]
+            ids[qi, :len(found)] = [node for _, node in found]
+        return scores, ids
+
+    def reconstruct(self):
+        return self._vectors.data.copy()
+
+    def save(self, dirpath):
+        """向量、层号、第 0 层邻居表各一个数组，上层每层存 节点列表 + 邻居表；入口点记在返回的字典里"""
+        _save_array(dirpath, 'hnsw_vectors', self._vectors.data)
+        _save_array(dirpath, 'hnsw_levels', self._levels.data)
+        _save_array(dirpath, 'hnsw_links0', self._links0.data)
+        for level, (rows, table) in self._upper.items():
+            nodes = np.empty(len(rows), dtype=np.int64)
+            for node, row in rows.items():
+                nodes[row] = node
+            _save_array(dirpath, f'hnsw_nodes{level}', nodes)
+            _save_array(dirpath, f'hnsw_links{level}', table.data)
+        return {'entry_point': int(self.entry_point), 'max_level': int(self.max_level)}
+
+    def load(self, dirpath, state, mmap=True):
+        """
+        读取 save 写出的图。向量和层号只读映射；邻居表插入新节点时会原地改写，
+        用写时复制映射（'c'）：没改过的页仍与其他进程共享，也不会写回文件。
+        """
+        self._vectors = VectorStore.wrap(_load_array(dirpath, 'hnsw_vectors', 'r' if mmap else None))
+        self._levels = VectorStore.wrap(_load_array(dirpath, 'hnsw_levels', 'r' if mmap else None))
+        self._links0 = VectorStore.wrap(_load_array(dirpath, 'hnsw_links0', 'c' if mmap else None))
+        self.entry_point = state['entry_point']
+        self.max_level = state['max_level']
+        self.ntotal = len(self._vectors)
+        self._upper = {}
+        for level in range(1, self.max_level + 1):
+            nodes = _load_array(dirpath, f'hnsw_nodes{level}', None)
+            table = VectorStore.wrap(_load_array(dirpath, f'hnsw_links{level}', 'c' if mmap else None))
+            self._upper[level] = ({int(n): i for i, n in enumerate(nodes)}, table)
+        # 换一个种子，避免加载后新插入节点的层号序列与建图时重复
+        self._rng = np.random.default_rng(self.ntotal)
+
+    @property
+    def nbytes(self):
+        upper = sum(table.capacity_nbytes for _, table in self._upper.values())
+        return self._vectors.capacity_nbytes + self._levels.capacity_nbytes + self._links0.capacity_nbytes + upper
+
+
+def _as_items(value):
+    """元数据里的多值字段（列表 / 元组 / 集合，如标签）拆成多个值，缺失为空"""
+    if value is None:
+        return ()
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return value
+    return (value,)
+
+
+def _match_value(value, cond):
+    """未建属性索引的字段逐条判断：元组 (lo, hi) 为闭区间（None 表示不限），列表 / 集合为任一取值，其余为相等"""
+    items = _as_items(value)
+    if isinstance(cond, tuple):
+        lo, hi = cond
+        return any(isinstance(v, (int, float, np.number)) and (lo is None or v >= lo) and (hi is None or v <= hi)
+                   for v in items)
+    if isinstance(cond, (list, set, frozenset)):
+        return any(v in cond for v in items if isinstance(v, (str, int, float, bool, np.generic)))
+    return any(v == cond for v in items)
+
+
+class CategoricalAttributeIndex:
+    """
+    类别属性索引（等值 / 任一取值过滤，如类目、品牌、是否有货、标签）：
+    值 -> 升序行号数组的倒排表，每个值一个 VectorStore，多值字段的每个值各记一次。
+    """
+
+    kind = 'categorical'
+
+    def __init__(self):
+        self._postings = {}
+
+    def add(self, values, start):
+        """values 为从第 start 行开始的一批字段值"""
+        groups = {}
+        for offset, value in enumerate(values):
+            for item in _as_items(value):
+                try:
+                    groups.setdefault(item, []).append(start + offset)
+                except TypeError:
+                    pass  # 不可哈希的值（如字典）不建索引
+        for item, rows in groups.items():
+            if item not in self._postings:
+                self._postings[item] = VectorStore(1, dtype=np.int64, initial_capacity=64)
+            self._postings[item].append(np.asarray(rows, dtype=np.int64)[:, None])
+
+    def match(self, cond):
+        """返回满足条件的升序行号"""
+        if isinstance(cond, tuple):
+            raise ValueError("类别属性不支持范围条件，请建 numeric 属性索引")
+        values = cond if isinstance(cond, (list, set, frozenset)) else [cond]
+        parts = [self._postings[v].data[:, 0] for v in values if v in self._postings]
+        if not parts:
+            return np.empty(0, dtype=np.int64)
+        if len(parts) == 1:
+            return parts[0]
+        return np.unique(np.concatenate(parts))
+
+    def save(self, dirpath, prefix):
+        keys = list(self._postings)
+        rows = [self._postings[key].data[:, 0] for key in keys]
+        with open(os.path.join(dirpath, prefix + '_keys.json'), 'w', encoding='utf-8') as f:
+            json.dump(keys, f, ensure_ascii=False, default=_json_default)
+        _save_array(dirpath, prefix + '_offsets', np.concatenate([[0], np.cumsum([len(r) for r in rows])]).astype(np.int64))
+        _save_array(dirpath, prefix + '_rows', np.concatenate(rows or [np.empty(0, dtype=np.int64)])[:, None])
+
+    def load(self, dirpath, prefix, mmap=True):
+        with open(os.path.join(dirpath, prefix + '_keys.json'), encoding='utf-8') as f:
+            keys = json.load(f)
+        offsets = _load_array(dirpath, prefix + '_offsets', None)
+        rows = _load_array(dirpath, prefix + '_rows', 'r' if mmap else None)
+        self._postings = {key: VectorStore.wrap(rows[a:b]) for key, a, b in zip(keys, offsets[:-1], offsets[1:])}
+
+    @property
+    def nbytes(self):
+        return sum(p.capacity_nbytes for p in self._postings.values()) + sys.getsizeof(self._postings)
+
+
+class NumericAttributeIndex:
+    """
+    数值属性索引（范围过滤，如价格、库存量）：按值排好序的 (值, 行号) 数组用二分查找，
+    新追加的行先放在未排序的尾部，尾部超过主体的 1/8 时合并重排。
+    非数值 / 缺失的字段不进索引。
+    """
+
+    kind = 'numeric'
+
+    def __init__(self):
+        # (排序后的值, 对应行号, 尾部值, 尾部行号) 放在一个元组里整体替换，不加锁的读者不会读到一半
+        self._state = (np.empty(0), np.empty(0, dtype=np.int64),
+                       VectorStore(1, dtype=np.float64, initial_capacity=64),
+                       VectorStore(1, dtype=np.int64, initial_capacity=64))
+        self._multi_valued = False
+
+    def add(self, values, start):
+        rows, nums = [], []
+        for offset, value in enumerate(values):
+            items = _as_items(value)
+            if len(items) > 1:
+                self._multi_valued = True
+            for item in items:
+                if isinstance(item, (int, float, np.number)):
+                    rows.append(start + offset)
+                    nums.append(float(item))
+        if not rows:
+            return
+        base_values, base_rows, tail_values, tail_rows = self._state
+        # 先写行号再写值：读者按两者较短的长度读取
+        tail_rows.append(np.asarray(rows, dtype=np.int64)[:, None])
+        tail_values.append(np.asarray(nums, dtype=np.float64)[:, None])
+        if len(tail_values) > max(1024, len(base_values) // 8):
+            self._merge()
+
+    def _merge(self):
+        base_values, base_rows, tail_values, tail_rows = self._state
+        values = np.concatenate([base_values, tail_values.data[:, 0]])
+        rows = np.concatenate([base_rows, tail_rows.data[:, 0]])
+        order = np.argsort(values, kind='stable')
+        self._state = (values[order], rows[order],
+                       VectorStore(1, dtype=np.float64, initial_capacity=64),
+                       VectorStore(1, dtype=np.int64, initial_capacity=64))
+
+    def match(self, cond):
+        """返回满足条件的升序行号：(lo, hi) 为闭区间（None 表示不限），列表 / 集合为任一取值，其余为相等"""
+        if isinstance(cond, tuple):
+            ranges = [cond]
+        elif isinstance(cond, (list, set, frozenset)):
+            ranges = [(v, v) for v in cond]
+        else:
+            ranges = [(cond, cond)]
+        base_values, base_rows, tail_values, tail_rows = self._state
+        n = min(len(tail_values), len(tail_rows))
+        tv, tr = tail_values.data[:n, 0], tail_rows.data[:n, 0]
+        parts = []
+        for lo, hi in ranges:
+            i = 0 if lo is None else np.searchsorted(base_values, lo, side='left')
+            j = len(base_values) if hi is None else np.searchsorted(base_values, hi, side='right')
+            parts.append(base_rows[i:j])
+            mask = np.ones(n, dtype=bool)
+            if lo is not None:
+                mask &= tv >= lo
+            if hi is not None:
+                mask &= tv <= hi
+            parts.append(tr[mask])
+        rows = np.concatenate(parts)
+        # 单值字段查单个区间时各部分的行号互不重复，排序即可；否则可能命中同一行，需要去重
+        return np.sort(rows) if len(ranges) == 1 and not self._multi_valued else np.unique(rows)
+
+    def save(self, dirpath, prefix):
+        self._merge()
+        base_values, base_rows, _, _ = self._state
+        _save_array(dirpath, prefix + '_values', base_values)
+        _save_array(dirpath, prefix + '_rows', base_rows)
+        _save_array(dirpath, prefix + '_multi', np.array([self._multi_valued]))
+
+    def load(self, dirpath, prefix, mmap=True):
+        mode = 'r' if mmap else None
+        self._state = (_load_array(dirpath, prefix + '_values', mode), _load_array(dirpath, prefix + '_rows', mode),
+                       VectorStore(1, dtype=np.float64, initial_capacity=64),
+                       VectorStore(1, dtype=np.int64, initial_capacity=64))
+        self._multi_valued = bool(_load_array(dirpath, prefix + '_multi', None)[0])
+
+    @property
+    def nbytes(self):
+        base_values, base_rows, tail_values, tail_rows = self._state
+        return base_values.nbytes + base_rows.nbytes + tail_values.capacity_nbytes + tail_rows.capacity_nbytes
+
+
+ATTRIBUTE_INDEX_TYPES = {
+    'categorical': CategoricalAttributeIndex,
+    'numeric': NumericAttributeIndex,
+}
+
+
 class VectorIndex:
-    """向量索引系统"""
+    """向量索引系统
+
+    keep_vectors=False 时不再保留原始向量副本：FAISS 可用时向量只存在 FAISS 索引里
+    （需要时由 vectors 属性从索引中还原），否则只保留暴力搜索用的归一化矩阵。
+    block_size 为暴力搜索每块处理的行数，控制临时内存并让每块数据能留在缓存里。
+    index_type='ivf' 时使用 nlist 个聚类、每次查 nprobe 个；没有 FAISS 时用纯 NumPy 的 IVFIndex（余弦相似度）。
+    index_type='hnsw' 时使用 HNSW 图（M / ef_construction / ef_search），可增量插入、无需训练；
+    没有 FAISS 时用原生的 HNSWIndex（余弦相似度）。
+    storage 为扁平索引的向量存储格式：'float32' | 'fp16' | 'int8'（逐维标量量化）| 'pq'（pq_m 段乘积量化），
+    压缩格式用非对称打分；rerank_k > 0 时先按压缩分数取 rerank_k 个候选，再用原始向量精确重打分
+    （需要 keep_vectors=True）。
+
+    每行有一个外部 id（add_vectors 不传 ids 时自动编号），upsert / delete 按 id 更新和删除：
+    旧行只在墓碑位图里打标记，搜索时跳过；墓碑占比超过 compact_threshold 时在后台线程里
+    用存活的行重建整个索引（重新训练聚类中心 / 码本），完成后一次性替换。
+    写操作之间用锁串行，搜索不加锁：行号、墓碑位图、文本都先于向量追加，
+    压缩替换后正在进行的搜索会检测到版本变化并重新执行。compact_threshold=None 时不自动压缩。
+
+    create_attribute_index 为 metadata 字段建属性索引，search / batch_search / batch_topk 的 filters
+    按字段过滤（见 filter_rows）。满足条件的行占比不超过 prefilter_ratio 时先取出候选行只给它们打分；
+    否则暴力搜索在分块打分时屏蔽不满足的行，近似索引按占比多取结果再过滤，不够 k 个时退回候选打分。
+    """
     
-    def __init__(self, dimension=256, index_type='flat'):
+    def __init__(self, dimension=256, index_type='flat', keep_vectors=True, block_size=4096,
+                 nlist=100, nprobe=10, M=16, ef_construction=100, ef_search=64,
+                 storage='float32', pq_m=16, rerank_k=0, compact_threshold=0.2, prefilter_ratio=0.25):
         self.dimension = dimension
         self.index_type = index_type
-        self.vectors = None
+        self.keep_vectors = keep_vectors
+        self.block_size = block_size
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.M = M
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.storage = storage
+        self.pq_m = pq_m
+        self.rerank_k = rerank_k
+        self.compact_threshold = compact_threshold
+        self.prefilter_ratio = prefilter_ratio
+        if storage not in STORAGE_TYPES:
+            raise ValueError(f"不支持的存储类型: {storage}，可选 {STORAGE_TYPES}")
+        if storage != 'float32' and index_type != 'flat':
+            raise ValueError("压缩存储目前只支持 index_type='flat'")
+        if rerank_k and not keep_vectors:
+            raise ValueError("rerank_k > 0 需要 keep_vectors=True 保留原始向量做精确重打分")
         self.texts = None
         self.metadata = None
         self.index = None
+        self._ann = None
+        self._codec = None
+        self._store = None
+        self._normed = None
+        self._faiss_mmap_path = None
+        self._write_lock = threading.Lock()
+        self._generation = 0
+        self._compact_thread = None
+        self._compact_error = None
+        self._attr_indexes = {}
+        self._reset_ids()
         self._build_index()
+
+    @property
+    def vectors(self):
+        """全部向量 (n, dimension)；未保留副本时从 FAISS 索引还原（会复制一份），或返回归一化后的向量"""
+        if self._store is not None:
+            return self._store.data
+        if FAISS_AVAILABLE and self.index is not None and self.index.ntotal > 0:
+            if hasattr(self.index, 'make_direct_map'):
+                self.index.make_direct_map()
+            return self.index.reconstruct_n(0, self.index.ntotal)
+        if self._normed is not None:
+            return self._codec.decode(self._normed.data) if self._codec is not None else self._normed.data
+        if self._ann is not None and self._ann.ntotal > 0:
+            return self._ann.reconstruct()
+        return None
+
+    @property
+    def ntotal(self):
+        """总行数（含已删除、尚未压缩掉的行）"""
+        return len(self.texts) if self.texts is not None else 0
+
+    @property
+    def num_deleted(self):
+        return self._num_deleted
+
+    def __len__(self):
+        """存活的条数"""
+        return self.ntotal - self._num_deleted
+
+    def __contains__(self, id_):
+        return id_ in self._id_rows
+
+    def _reset_ids(self):
+        self._row_ids = VectorStore(1, dtype=np.int64)   # 行号 -> 外部 id
+        self._deleted = VectorStore(1, dtype=bool)       # 墓碑位图
+        self._id_rows = {}                               # 外部 id -> 存活的行号
+        self._num_deleted = 0
+        self._next_id = 0
+
+    def _register_rows(self, count, ids=None):
+        """为即将追加的 count 行登记外部 id 与墓碑位（在文本和向量之前追加）"""
+        if ids is None:
+            ids = np.arange(self._next_id, self._next_id + count, dtype=np.int64)
+        else:
+            ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+            if len(ids) != count:
+                raise ValueError(f"ids 数量 {len(ids)} 与向量数量 {count} 不一致")
+            if len(np.unique(ids)) != len(ids):
+                raise ValueError("同一批 ids 中有重复")
+            existing = [int(i) for i in ids if int(i) in self._id_rows]
+            if existing:
+                raise ValueError(f"id 已存在: {existing[:5]}，更新请用 upsert")
+        start = self._row_ids.append(ids[:, None])
+        self._deleted.append(np.zeros((count, 1), dtype=bool))
+        self._id_rows.update(zip(ids.tolist(), range(start, start + count)))
+        if count:
+            self._next_id = max(self._next_id, int(ids.max()) + 1)
+
+    def get_ids(self, indices):
+        """把搜索返回的行号（batch_topk 的 indices）换成外部 id，-1 保持不变"""
+        indices = np.asarray(indices)
+        row_ids = self._row_ids.data[:, 0]
+        return np.where(indices >= 0, row_ids[np.maximum(indices, 0)], -1)
     
     def _build_index(self):
         """构建向量索引"""
         if FAISS_AVAILABLE:
-            if self.index_type == 'flat':
+            if self.index_type == 'flat' and self.storage == 'fp16':
+                self.index = faiss.IndexScalarQuantizer(self.dimension, faiss.ScalarQuantizer.QT_fp16,
+                                                        faiss.METRIC_INNER_PRODUCT)
+            elif self.index_type == 'flat' and self.storage == 'int8':
+                self.index = faiss.IndexScalarQuantizer(self.dimension, faiss.ScalarQuantizer.QT_8bit,
+                                                        faiss.METRIC_INNER_PRODUCT)
+            elif self.index_type == 'flat' and self.storage == 'pq':
+                self.index = faiss.IndexPQ(self.dimension, self.pq_m, 8, faiss.METRIC_INNER_PRODUCT)
+            elif self.index_type == 'flat':
                 self.index = faiss.IndexFlatIP(self.dimension)  # 内积相似度
             elif self.index_type == 'ivf':
                 quantizer = faiss.IndexFlatIP(self.dimension)
-                self.index = faiss.IndexIVFFlat(quantizer, self.dimension, 100)
-                self.index.nprobe = 10
+                self.index = faiss.IndexIVFFlat(quantizer, self.dimension, self.nlist)
+                self.index.nprobe = self.nprobe
+            elif self.index_type == 'hnsw':
+                self.index = faiss.IndexHNSWFlat(self.dimension, self.M, faiss.METRIC_INNER_PRODUCT)
+                self.index.hnsw.efConstruction = self.ef_construction
+                self.index.hnsw.efSearch = self.ef_search
             else:
                 raise ValueError(f"不支持的索引类型: {self.index_type}")
         else:
             self.index = None
-            self.vectors = np.array([]).reshape(0, self.dimension)
-    
-    def add_vectors(self, vectors, texts, metadata=None):
-        """添加向量到索引"""
-        vectors = np.array(vectors).astype('float32')
-        
-        if self.vectors is None:
-            self.vectors = vectors
-            self.texts = list(texts)
-            self.metadata = metadata if metadata else [{}] * len(texts)
-        else:
-            self.vectors = np.vstack([self.vectors, vectors])
-            self.texts.extend(texts)
-            if metadata:
-                self.metadata.extend(metadata)
+            if self.index_type == 'ivf':
+                self._ann = IVFIndex(self.dimension, nlist=self.nlist, nprobe=self.nprobe)
+            elif self.index_type == 'hnsw':
+                self._ann = HNSWIndex(self.dimension, M=self.M, ef_construction=self.ef_construction,
+                                      ef_search=self.ef_search)
+            elif self.index_type != 'flat':
+                raise ValueError(f"不支持的索引类型: {self.index_type}")
+        self._store = VectorStore(self.dimension) if self.keep_vectors else None
+        # 暴力搜索用的预归一化矩阵：查询时只需一次矩阵-向量乘，不再每次重算全量范数；压缩存储时存编码
+        self._normed = None
+        if self.index is None and self._ann is None:
+            self._codec = _make_codec(self.storage, self.dimension, self.pq_m)
+            if self._codec is None:
+                self._normed = VectorStore(self.dimension)
             else:
-                self.metadata.extend([{}] * len(texts))
-        
+                self._normed = VectorStore(self._codec.code_dim, dtype=self._codec.dtype)
+
+    def train(self, vectors):
+        """显式训练（IVF 需要）；不调用时 add_vectors 会用第一批向量训练"""
+        vectors = np.ascontiguousarray(np.asarray(vectors, dtype=np.float32).reshape(-1, self.dimension))
         if FAISS_AVAILABLE and self.index is not None:
             if hasattr(self.index, 'is_trained') and not self.index.is_trained:
                 self.index.train(vectors)
+        elif self._ann is not None and not self._ann.is_trained:
+            self._ann.train(_normalize_rows(vectors))
+        elif self._codec is not None and not self._codec.is_trained:
+            self._codec.train(_normalize_rows(vectors))
+    
+    def add_vectors(self, vectors, texts, metadata=None, ids=None):
+        """
+        添加向量到索引（均摊 O(1) 追加，不复制已有向量）。
+        ids 为每条的外部 id（整数），缺省时自动编号；已存在的 id 会报错，更新请用 upsert。
+        """
+        vectors = np.ascontiguousarray(np.asarray(vectors, dtype=np.float32).reshape(-1, self.dimension))
+        with self._write_lock:
+            self._append(vectors, texts, metadata, ids)
+
+    def upsert(self, ids, vectors, texts, metadata=None):
+        """按 id 新增或更新：已存在的 id 先给旧行打墓碑，新版本追加到末尾"""
+        vectors = np.ascontiguousarray(np.asarray(vectors, dtype=np.float32).reshape(-1, self.dimension))
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        with self._write_lock:
+            self._tombstone(ids)
+            self._append(vectors, texts, metadata, ids)
+        self._maybe_compact()
+
+    def delete(self, ids):
+        """按 id 删除（打墓碑，搜索时跳过），返回实际删除的条数；不存在的 id 忽略"""
+        with self._write_lock:
+            removed = self._tombstone(np.asarray(ids, dtype=np.int64).reshape(-1))
+        self._maybe_compact()
+        return removed
+
+    def _tombstone(self, ids):
+        rows = [self._id_rows.pop(i) for i in ids.tolist() if i in self._id_rows]
+        if rows:
+            self._deleted.data[rows, 0] = True
+            self._num_deleted += len(rows)
+        return len(rows)
+
+    def _append(self, vectors, texts, metadata, ids):
+        """顺序保证不加锁的搜索读到的行都已登记：行号 / 墓碑位 -> 文本 / 元数据 -> 属性索引 -> 向量"""
+        self._register_rows(len(vectors), ids)
+        if self.texts is None:
+            self.texts = []
+            self.metadata = []
+        start = len(self.texts)
+        metadata = metadata or [{}] * len(texts)
+        self.texts.extend(texts)
+        self.metadata.extend(metadata)
+        for field, attr in self._attr_indexes.items():
+            attr.add([m.get(field) if isinstance(m, dict) else None for m in metadata], start)
+        self._index_vectors(vectors)
+
+    def _index_vectors(self, vectors):
+        """把已登记好文本的一批向量写进各个搜索结构"""
+        if self._store is not None:
+            self._store.append(vectors)
+        if self._normed is not None:
+            normed = _normalize_rows(vectors)
+            if self._codec is not None:
+                if not self._codec.is_trained:
+                    self._codec.train(normed)
+                normed = self._codec.encode(normed)
+            self._normed.append(normed)
+        if self._ann is not None:
+            normed = _normalize_rows(vectors)
+            if not self._ann.is_trained:
+                self._ann.train(normed)
+            self._ann.add(normed, np.arange(self.ntotal - len(vectors), self.ntotal))
+        if FAISS_AVAILABLE and self.index is not None:
+            if self._faiss_mmap_path is not None:
+                # mmap 加载的 FAISS 索引是只读的，第一次追加前整体读进内存
+                self.index = faiss.read_index(self._faiss_mmap_path)
+                self._faiss_mmap_path = None
+            if hasattr(self.index, 'is_trained') and not self.index.is_trained:
+                self.index.train(vectors)
             self.index.add(vectors)
+
+    def create_attribute_index(self, field, kind='categorical'):
+        """
+        为 metadata[field] 建属性索引并用已有数据填充，之后追加的行自动维护：
+        kind='categorical' 用于等值 / 任一取值过滤，'numeric' 用于范围过滤。
+        """
+        if kind not in ATTRIBUTE_INDEX_TYPES:
+            raise ValueError(f"不支持的属性索引类型: {kind}，可选 {tuple(ATTRIBUTE_INDEX_TYPES)}")
+        with self._write_lock:
+            attr = ATTRIBUTE_INDEX_TYPES[kind]()
+            if self.metadata is not None:
+                attr.add([m.get(field) if isinstance(m, dict) else None for m in self.metadata], 0)
+            self._attr_indexes = {**self._attr_indexes, field: attr}
+        return attr
+
+    def filter_rows(self, filters):
+        """
+        满足 filters 的存活行号（升序）。filters 为 {字段: 条件}，各字段之间取交集：
+        元组 (lo, hi) 为闭区间（None 表示不限），列表 / 集合为任一取值，其余为相等；
+        多值字段（如标签列表）任一值满足即可。
+        有属性索引的字段直接查索引，没有的逐条扫描 metadata（慢，只适合小索引或临时查询）。
+        """
+        result = None
+        for field, cond in filters.items():
+            attr = self._attr_indexes.get(field)
+            if attr is not None:
+                rows = attr.match(cond)
+            else:
+                rows = np.array([i for i, m in enumerate(self.metadata or [])
+                                 if isinstance(m, dict) and _match_value(m.get(field), cond)], dtype=np.int64)
+            result = rows if result is None else np.intersect1d(result, rows, assume_unique=True)
+            if len(result) == 0:
+                break
+        if result is None:
+            result = np.arange(self.ntotal, dtype=np.int64)
+        if self._num_deleted and len(result):
+            result = result[~self._deleted.data[result, 0]]
+        return result
+
+    def exclusion_mask(self, filters=None):
+        """
+        搜索时要屏蔽的行：墓碑，给了 filters 时再加上不满足条件的行；没有要屏蔽的返回 None。
+        供按行号检索的其他召回（如 BM25）与向量搜索保持同样的删除 / 过滤语义。
+        """
+        if filters:
+            mask = np.ones(len(self._deleted), dtype=bool)
+            mask[self.filter_rows(filters)] = False
+            return mask
+        if self._num_deleted:
+            return self._deleted.data[:, 0]
+        return None
+
+    def _maybe_compact(self):
+        """墓碑占比超过阈值且没有正在进行的压缩时，启动后台压缩"""
+        if (self.compact_threshold and self._num_deleted
+                and self._num_deleted > self.compact_threshold * self.ntotal
+                and (self._compact_thread is None or not self._compact_thread.is_alive())):
+            self.compact(background=True)
+
+    def compact(self, background=False):
+        """
+        用存活的行重建索引，去掉墓碑：
+        1. 持锁记下当前行数与墓碑位图的快照（很快）
+        2. 不持锁地用快照里存活的行构建新索引（重新训练 IVF 中心 / 量化码本），期间读写照常
+        3. 持锁补上构建期间新追加的行和新删除的 id，再一次性替换全部内部状态
+        background=True 时在后台线程执行并返回该线程，出错时由 wait_for_compaction 抛出。
+        """
+        if background:
+            self._compact_thread = threading.Thread(target=self._compact_in_background, daemon=True)
+            self._compact_thread.start()
+            return self._compact_thread
+        self._compact()
+
+    def wait_for_compaction(self):
+        """等待后台压缩完成；压缩出错时在这里抛出"""
+        if self._compact_thread is not None:
+            self._compact_thread.join()
+            self._compact_thread = None
+        if self._compact_error is not None:
+            error, self._compact_error = self._compact_error, None
+            raise RuntimeError(f"索引压缩失败: {error}")
+
+    def _compact_in_background(self):
+        try:
+            self._compact()
+        except Exception as e:
+            self._compact_error = e
+
+    def _compact(self):
+        with self._write_lock:
+            n0 = self.ntotal
+            live = np.flatnonzero(~self._deleted.data[:n0, 0])
+
+        params = {name: getattr(self, name) for name in self._PARAMS}
+        params['compact_threshold'] = None
+        fresh = VectorIndex(**params)
+        fresh._attr_indexes = {field: type(attr)() for field, attr in self._attr_indexes.items()}
+        self._copy_rows(fresh, live)
+
+        with self._write_lock:
+            # 构建期间新建的属性索引，以及先删掉构建期间被删除 / 更新掉的旧行，
+            # 再补上构建期间追加的行（跳过其中已经又被删掉的）
+            for field, attr in self._attr_indexes.items():
+                if field not in fresh._attr_indexes:
+                    new_attr = type(attr)()
+                    new_attr.add([m.get(field) if isinstance(m, dict) else None for m in fresh.metadata or []], 0)
+                    fresh._attr_indexes[field] = new_attr
+            fresh._tombstone(self._row_ids.data[live[self._deleted.data[live, 0]], 0])
+            appended = np.arange(n0, self.ntotal)
+            self._copy_rows(fresh, appended[~self._deleted.data[n0:self.ntotal, 0]])
+            fresh._next_id = max(fresh._next_id, self._next_id)
+            state = {name: fresh.__dict__[name] for name in self._STATE}
+            state['_generation'] = self._generation + 1
+            # dict.update 在持有 GIL 的一次调用里完成，其他线程看不到一半新一半旧的状态
+            self.__dict__.update(state)
+        print(f"索引压缩完成：{n0} 行 -> {self.ntotal} 行")
+
+    def _copy_rows(self, target, rows):
+        """把本索引的若干行（向量、文本、元数据、id）追加到 target"""
+        if len(rows) == 0:
+            return
+        if self._store is not None:
+            vectors = self._store.data[rows]
+        else:
+            vectors = self.vectors[rows]
+        target._append(np.ascontiguousarray(vectors, dtype=np.float32),
+                       [self.texts[i] for i in rows], [self.metadata[i] for i in rows],
+                       self._row_ids.data[rows, 0])
+
+    # 压缩时整体替换的内部状态
+    _STATE = ('texts', 'metadata', 'index', '_ann', '_codec', '_store', '_normed', '_faiss_mmap_path',
+              '_row_ids', '_deleted', '_id_rows', '_num_deleted', '_next_id', '_attr_indexes')
+
+    def memory_usage(self):
+        """
+        各部分内存占用（字节）：vectors 为原始向量副本的有效数据，vectors_capacity 含预留容量；
+        normalized 为暴力搜索的归一化矩阵（压缩存储时为编码），codec 为量化器参数（码本等）；
+        ann 为原生近似索引（IVF / HNSW）；ids 为行号 -> id 数组、墓碑位图和 id -> 行号字典；
+        attributes 为属性索引；
+        faiss 为索引内向量数据的估算值；
+        texts / metadata 为 Python 对象的近似大小（从磁盘目录加载时为数据文件 + 偏移量的大小）。
+        mmap 加载的数组按映射大小计算，这部分页由操作系统按需读入，多个进程共享。
+        """
+        usage = {
+            'vectors': self._store.nbytes if self._store is not None else 0,
+            'vectors_capacity': self._store.capacity_nbytes if self._store is not None else 0,
+            'normalized': self._normed.capacity_nbytes if self._normed is not None else 0,
+            'codec': self._codec.nbytes if self._codec is not None else 0,
+            'ann': self._ann.nbytes if self._ann is not None else 0,
+            'ids': self._row_ids.capacity_nbytes + self._deleted.capacity_nbytes + sys.getsizeof(self._id_rows),
+            'attributes': sum(attr.nbytes for attr in self._attr_indexes.values()),
+            'faiss': 0,
+            'texts': 0,
+            'metadata': 0,
+        }
+        if FAISS_AVAILABLE and self.index is not None:
+            # 扁平 / IVF-Flat / HNSW-Flat 都按原始 float32 存储，IVF 另外每条存一个 int64 id，外加聚类中心；
+            # HNSW 第 0 层每条约 2*M 个 int32 邻居（上层很少，忽略）
+            per_vector = 4 * self.dimension + {'ivf': 8, 'hnsw': 8 * self.M}.get(self.index_type, 0)
+            if self.storage != 'float32':
+                per_vector = {'fp16': 2 * self.dimension, 'int8': self.dimension, 'pq': self.pq_m}[self.storage]
+            usage['faiss'] = self.index.ntotal * per_vector
+            if self.index_type == 'ivf':
+                usage['faiss'] += self.index.nlist * 4 * self.dimension
+        if isinstance(self.texts, OffsetRecordList):
+            usage['texts'] = self.texts.nbytes
+        elif self.texts:
+            usage['texts'] = sys.getsizeof(self.texts) + sum(sys.getsizeof(t) for t in self.texts)
+        if isinstance(self.metadata, OffsetRecordList):
+            usage['metadata'] = self.metadata.nbytes
+        elif self.metadata:
+            unique = {id(m): m for m in self.metadata}.values()  # [{}] * n 共享同一个字典
+            usage['metadata'] = sys.getsizeof(self.metadata) + sum(sys.getsizeof(m) for m in unique)
+        usage['total'] = (usage['vectors_capacity'] + usage['normalized'] + usage['codec'] + usage['ann'] + usage['ids']
+                          + usage['attributes'] + usage['faiss'] + usage['texts'] + usage['metadata'])
+        return usage
     
-    def search(self, query_vector, k=5, threshold=0.6):
-        """搜索相似向量"""
+    def _read(self, fn, *args, **kwargs):
+        """
+        不加锁的读：执行前后比较版本号，期间发生了压缩替换就重新执行
+        （替换前后的数组长度不同，混读时可能越界，这种异常同样重试）。
+        """
+        while True:
+            generation = self._generation
+            try:
+                result = fn(*args, **kwargs)
+            except (IndexError, KeyError):
+                if generation == self._generation:
+                    raise
+                continue
+            if generation == self._generation:
+                return result
+
+    def search(self, query_vector, k=5, threshold=0.6, filters=None):
+        """搜索相似向量；结果中 index 为行号，id 为外部 id；filters 为属性过滤条件（见 filter_rows）"""
+        return self._read(self._search, query_vector, k, threshold, filters)
+
+    def _search(self, query_vector, k, threshold, filters=None):
         query_vector = np.array(query_vector).astype('float32').reshape(1, -1)
         
+        if filters:
+            scores, indices = self._filtered_topk(query_vector, k, filters)
+            return self._format_results(scores[0], indices[0], threshold)
         if FAISS_AVAILABLE and self.index is not None:
-            # 使用FAISS搜索
-            distances, indices = self.index.search(query_vector, k)
-            results = []
-            for i, (distance, idx) in enumerate(zip(distances[0], indices[0])):
-                if idx < len(self.texts) and distance >= threshold:
-                    results.append({
-                        'text': self.texts[idx],
-                        'score': float(distance),
-                        'index': int(idx),
-                        'metadata': self.metadata[idx] if self.metadata else {}
-                    })
-            return results
+            # 使用FAISS搜索；有墓碑时按删除比例多取，再去掉已删除的行
+            ck = self._candidate_k(k)
+            distances, indices = self._topk_excluding(query_vector, ck)
+            if ck > k:
+                distances, indices = self._rerank(query_vector, indices, k, normalize=False)
+            return self._format_results(distances[0], indices[0], threshold)
+        elif self._ann is not None:
+            scores, indices = self._topk_excluding(query_vector, k)
+            return self._format_results(scores[0], indices[0], threshold)
         else:
-            # 暴力搜索
-            if self.vectors is None or self.vectors.size == 0:
+            # 暴力搜索：归一化后的查询与预归一化矩阵做内积即余弦相似度
+            if self._normed is None or len(self._normed) == 0:
                 return []
-            
-            # 计算余弦相似度
-            similarities = np.dot(self.vectors, query_vector.T).flatten()
-            vector_norms = np.linalg.norm(self.vectors, axis=1)
-            query_norm = np.linalg.norm(query_vector)
-            norms = vector_norms * query_norm
-            similarities = similarities / np.clip(norms, 1e-8, None)
-            
-            # 获取top-k结果
-            indices = np.argsort(similarities)[::-1][:k]
-            results = []
-            for idx in indices:
-                if similarities[idx] >= threshold and self.texts is not None and idx < len(self.texts):
-                    result_item = {
-                        'text': self.texts[idx],
-                        'score': float(similarities[idx]),
-                        'index': int(idx),
-                    }
-                    # 安全地添加metadata
-                    if self.metadata is not None and idx < len(self.metadata):
-                        result_item['metadata'] = self.metadata[idx]
-                    else:
-                        result_item['metadata'] = {}
-                    results.append(result_item)
-            return results
-    
-    def batch_search(self, query_vectors, k=5, threshold=0.6):
-        """批量搜索"""
+            query = _normalize_rows(query_vector)
+            scores, indices = self._brute_force_topk(query[0], self._candidate_k(k))
+            if self._candidate_k(k) > k:
+                scores, indices = self._rerank(query, indices[None], k, normalize=True)
+                scores, indices = scores[0], indices[0]
+            return self._format_results(scores, indices, threshold)
+
+    def _candidate_k(self, k):
+        """压缩存储且开启重打分时，先取 rerank_k 个候选"""
+        if self.rerank_k and self.storage != 'float32':
+            return max(k, self.rerank_k)
+        return k
+
+    def _rerank(self, queries, candidates, k, normalize):
+        """
+        用保留的原始向量给候选精确重打分，取前 k。
+        normalize=True 时按余弦（原生暴力搜索的度量），否则按原始内积（与 FAISS 一致）。
+        """
+        raw = self._store.data
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        for qi, cand in enumerate(candidates):
+            cand = cand[cand >= 0]
+            vecs = _normalize_rows(raw[cand]) if normalize else raw[cand]
+            exact = vecs @ queries[qi]
+            order = np.argsort(-exact, kind='stable')[:k]
+            scores[qi, :len(order)] = exact[order]
+            indices[qi, :len(order)] = cand[order]
+        return scores, indices
+
+    def _drop_excluded(self, scores, indices, k, exclude=None):
+        """
+        近似索引多取回的结果里去掉已删除（或 exclude 中为 True）的行，保留前 k 列。
+        exclude 缺省为墓碑位图。
+        """
+        if exclude is None and self._num_deleted:
+            exclude = self._deleted.data[:, 0]
+        if exclude is not None:
+            dead = np.zeros(indices.shape, dtype=bool)
+            valid = indices >= 0
+            dead[valid] = exclude[indices[valid]]
+            scores = np.where(dead, -np.inf, scores).astype(np.float32)
+            indices = np.where(dead, -1, indices)
+            order = np.argsort(-scores, axis=1, kind='stable')
+            scores = np.take_along_axis(scores, order, axis=1)
+            indices = np.take_along_axis(indices, order, axis=1)
+        return scores[:, :k], indices[:, :k]
+
+    def _filtered_topk(self, queries, k, filters, num_threads=None, query_block=1024):
+        """
+        带属性过滤的批量 top-k，按满足条件的行占比（选择性）选策略：
+        - 占比 <= prefilter_ratio：先过滤，只给候选行打分（_score_rows），结果精确
+        - 暴力搜索：分块打分时把不满足条件的行置为 -inf
+        - 近似索引：按 1 / 占比 多取结果再过滤，最多翻倍重试几次，仍不够 k 个的查询退回候选打分
+        """
+        queries = np.ascontiguousarray(np.asarray(queries, dtype=np.float32).reshape(-1, self.dimension))
+        m = len(queries)
+        rows = self.filter_rows(filters)
+        if m == 0 or len(rows) == 0:
+            return np.full((m, k), -np.inf, dtype=np.float32), np.full((m, k), -1, dtype=np.int64)
+        selectivity = len(rows) / self.ntotal
+        if selectivity <= self.prefilter_ratio:
+            return self._score_rows(queries, rows, k)
+        exclude = np.ones(len(self._deleted), dtype=bool)
+        exclude[rows] = False
+        if self.index is None and self._ann is None:
+            return self._batch_topk(queries, k, num_threads, query_block, exclude=exclude)
+
+        ck = self._candidate_k(k)
+        scores, indices = self._topk_excluding(queries, ck, exclude, rows)
+        if ck > k:
+            return self._rerank(queries, indices, k, normalize=self.index is None)
+        return scores, indices
+
+    def _topk_excluding(self, queries, k, exclude=None, rows=None):
+        """
+        近似索引的前 k，去掉 exclude（缺省为墓碑位图）中为 True 的行；rows 为其余的行（缺省按 exclude 求）。
+        按剩余行占比多取 k / 占比 个结果，不够时翻倍重试，最多 3 次；仍不足 k 个的查询退回候选打分。
+        多取的条数只取决于删除 / 过滤掉的比例，不随墓碑总数增长。
+        """
+        if exclude is None:
+            if not self._num_deleted:
+                return self._raw_search(queries, k)
+            exclude = self._deleted.data[:, 0]
+        live = len(rows) if rows is not None else self.ntotal - int(np.count_nonzero(exclude[:self.ntotal]))
+        m = len(queries)
+        if live == 0:
+            return np.full((m, k), -np.inf, dtype=np.float32), np.full((m, k), -1, dtype=np.int64)
+        need = min(k, live) - 1  # 第 need 列有结果即说明凑够了
+        fetch = min(self.ntotal, k + math.ceil(k * self.ntotal / live))
+        for _ in range(3):
+            scores, indices = self._drop_excluded(*self._raw_search(queries, fetch), k, exclude)
+            if indices.shape[1] > need and (indices[:, need] >= 0).all() or fetch >= self.ntotal:
+                break
+            fetch = min(self.ntotal, fetch * 2)
+        if indices.shape[1] < k:
+            pad = k - indices.shape[1]
+            scores = np.pad(scores, ((0, 0), (0, pad)), constant_values=-np.inf)
+            indices = np.pad(indices, ((0, 0), (0, pad)), constant_values=-1)
+        short = indices[:, need] < 0
+        if short.any():
+            if rows is None:
+                rows = np.flatnonzero(~exclude[:self.ntotal])
+            scores[short], indices[short] = self._score_rows(queries[short], rows, k)
+        return scores, indices
+
+    def _raw_search(self, queries, k):
+        """直接查 FAISS / 原生近似索引，不处理墓碑和过滤"""
+        if self.index is not None:
+            self._sync_search_params()
+            return self.index.search(queries, k)
+        return self._ann_search(_normalize_rows(queries), k)
+
+    def _score_rows(self, queries, rows, k, query_block=256):
+        """
+        只给候选行打分：取出候选行的向量（有原始向量时用原始向量，结果精确），
+        按查询分组做 (查询数, 候选数) 的矩阵乘，取每条查询的前 k。
+        度量与当前后端一致：原生索引为余弦，FAISS 为内积。
+        """
+        native = self.index is None
+        if native:
+            queries = _normalize_rows(queries)
+        codec = None
+        if self._normed is not None and (self._codec is None or self._store is None):
+            matrix, codec = self._normed.data, self._codec
+            rows = rows[rows < len(matrix)]
+            cand = matrix[rows]
+        else:
+            matrix = self._store.data if self._store is not None else self.vectors
+            rows = rows[rows < len(matrix)]
+            cand = matrix[rows]
+            if native:
+                cand = _normalize_rows(cand)
+        m = len(queries)
+        scores = np.full((m, k), -np.inf, dtype=np.float32)
+        indices = np.full((m, k), -1, dtype=np.int64)
+        kk = min(k, len(rows))
+        if kk == 0:
+            return scores, indices
+        for start in range(0, m, query_block):
+            q = queries[start:start + query_block]
+            block_scores = codec.scores(codec.prepare(q), cand) if codec is not None else q @ cand.T
+            if block_scores.shape[1] > kk:
+                top = np.argpartition(block_scores, -kk, axis=1)[:, -kk:]
+            else:
+                top = np.broadcast_to(np.arange(kk), (len(q), kk))
+            top_scores = np.take_along_axis(block_scores, top, axis=1)
+            order = np.argsort(-top_scores, axis=1, kind='stable')
+            scores[start:start + len(q), :kk] = np.take_along_axis(top_scores, order, axis=1)
+            indices[start:start + len(q), :kk] = rows[np.take_along_axis(top, order, axis=1)]
+        return scores, indices
+
+    def _sync_search_params(self):
+        """把 nprobe / ef_search 的最新取值同步给 FAISS 索引（允许建好索引后再调参）"""
+        if self.index_type == 'ivf':
+            self.index.nprobe = self.nprobe
+        elif self.index_type == 'hnsw':
+            self.index.hnsw.efSearch = self.ef_search
+
+    def _ann_search(self, queries, k):
+        """原生近似索引的查询，参数取 VectorIndex 上的当前值"""
+        if self.index_type == 'hnsw':
+            return self._ann.search(queries, k, ef=self.ef_search)
+        return self._ann.search(queries, k, nprobe=self.nprobe)
+
+    def _brute_force_topk(self, query, k):
+        """
+        分块扫描：每块一次矩阵-向量乘，再用 argpartition 取块内前 k（O(块大小)），
+        最后只对各块候选做一次排序。返回按分数降序的 (scores, indices)。
+        压缩存储时用非对称打分（查询保持 float32，直接对编码打分）。
+        """
+        matrix = self._normed.data
+        # 墓碑位图在向量之前追加，先取矩阵再取位图，位图一定覆盖矩阵的每一行；
+        # 屏蔽的行加上 -inf（整行广播加法比布尔下标赋值快得多）
+        penalty = _exclude_penalty(self._deleted.data[:, 0]) if self._num_deleted else None
+        n = len(matrix)
+        k = min(k, n)
+        if k <= 0:
+            return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)
+        prepared = self._codec.prepare(query[None]) if self._codec is not None else None
+        cand_scores, cand_indices = [], []
+        for start in range(0, n, self.block_size):
+            block = matrix[start:start + self.block_size]
+            block_scores = self._codec.scores(prepared, block)[0] if prepared is not None else block @ query
+            if penalty is not None:
+                block_scores += penalty[start:start + len(block)]
+            if len(block_scores) > k:
+                top = np.argpartition(block_scores, -k)[-k:]
+                block_scores = block_scores[top]
+            else:
+                top = np.arange(len(block_scores))
+            cand_scores.append(block_scores)
+            cand_indices.append(top + start)
+        scores = np.concatenate(cand_scores)
+        indices = np.concatenate(cand_indices)
+        if len(scores) > k:
+            top = np.argpartition(scores, -k)[-k:]
+            scores, indices = scores[top], indices[top]
+        order = np.argsort(-scores, kind='stable')
+        scores, indices = scores[order], indices[order]
+        if penalty is not None:
+            indices[np.isneginf(scores)] = -1
+        return scores, indices
+
+    def _format_results(self, scores, indices, threshold):
+        """把 (分数, 下标) 转成结果字典列表，过滤低于 threshold 的结果"""
         results = []
-        for query_vector in query_vectors:
-            results.append(self.search(query_vector, k, threshold))
+        for score, idx in zip(scores, indices):
+            # FAISS 结果不足 k 个时用 -1 补位
+            if score >= threshold and self.texts is not None and 0 <= idx < len(self.texts):
+                result_item = {
+                    'text': self.texts[idx],
+                    'score': float(score),
+                    'index': int(idx),
+                    'id': int(self._row_ids.data[idx, 0]),
+                }
+                # 安全地添加metadata
+                if self.metadata is not None and idx < len(self.metadata):
+                    result_item['metadata'] = self.metadata[idx]
+                else:
+                    result_item['metadata'] = {}
+                results.append(result_item)
         return results
     
-    def save(self, filepath):
-        """保存索引到文件"""
-        data = {
-            'vectors': self.vectors,
-            'texts': self.texts,
-            'metadata': self.metadata,
-            'dimension': self.dimension,
-            'index_type': self.index_type
-        }
-        
-        with open(filepath, 'wb') as f:
-            pickle.dump(data, f)
-        
-        print(f"索引已保存到: {filepath}")
+    def batch_search(self, query_vectors, k=5, threshold=0.6, num_threads=None, query_block=1024, filters=None):
+        """批量搜索：一次算完整批查询，再逐条整理成与 search 相同格式的结果；filters 对整批查询生效"""
+        def run():
+            scores, indices = self._batch_topk(query_vectors, k, num_threads, query_block, filters=filters)
+            return [self._format_results(s, i, threshold) for s, i in zip(scores, indices)]
+        return self._read(run)
+
+    def batch_topk(self, query_vectors, k=5, num_threads=None, query_block=1024, filters=None):
+        """
+        批量 top-k，返回 (scores, indices) 两个 (查询数, k) 数组，不足 k 个时 indices 用 -1 补位。
+        离线任务（如相似商品）直接用数组，省掉逐条构造结果字典的开销。
+        - FAISS：整批一次 index.search；原生 IVF / HNSW：整批交给对应索引的 search
+        - 暴力搜索：查询按 query_block 分组，每组对语料分块做矩阵-矩阵乘并合并每条查询的前 k；
+          num_threads > 1 时各组在线程池里并行（numpy 计算期间释放 GIL）
+        已删除的行不会出现在结果里；indices 是行号，压缩后会变，需要稳定标识时用 get_ids 换成外部 id。
+        filters 为属性过滤条件（见 filter_rows），对整批查询生效。
+        """
+        return self._read(self._batch_topk, query_vectors, k, num_threads, query_block, filters=filters)
+
+    def _batch_topk(self, query_vectors, k, num_threads, query_block, filters=None, exclude=None):
+        """exclude 为暴力搜索时额外屏蔽的行（过滤条件的补集，已含墓碑）"""
+        if filters:
+            return self._filtered_topk(query_vectors, k, filters, num_threads, query_block)
+        queries = np.ascontiguousarray(np.asarray(query_vectors, dtype=np.float32).reshape(-1, self.dimension))
+        m = len(queries)
+        ck = self._candidate_k(k)
+        if FAISS_AVAILABLE and self.index is not None:
+            scores, indices = self._topk_excluding(queries, ck)
+            return self._rerank(queries, indices, k, normalize=False) if ck > k else (scores, indices)
+        if self._ann is not None:
+            return self._topk_excluding(queries, k)
+
+        scores = np.full((m, ck), -np.inf, dtype=np.float32)
+        indices = np.full((m, ck), -1, dtype=np.int64)
+        if m == 0 or self._normed is None or len(self._normed) == 0:
+            return scores, indices
+
+        queries = _normalize_rows(queries)
+        if num_threads and num_threads > 1:
+            # 查询不多时把组切小一些，让每个线程都有活干
+            query_block = max(1, min(query_block, math.ceil(m / num_threads)))
+        starts = range(0, m, query_block)
+
+        def work(start):
+            return self._brute_force_topk_batch(queries[start:start + query_block], ck, exclude)
+
+        if num_threads and num_threads > 1 and len(starts) > 1:
+            with ThreadPoolExecutor(max_workers=num_threads) as pool:
+                parts = list(pool.map(work, starts))
+        else:
+            parts = [work(start) for start in starts]
+        for start, (part_scores, part_indices) in zip(starts, parts):
+            kk = part_scores.shape[1]
+            scores[start:start + len(part_scores), :kk] = part_scores
+            indices[start:start + len(part_indices), :kk] = part_indices
+        if ck > k:
+            return self._rerank(queries, indices, k, normalize=True)
+        return scores, indices
+
+    def _brute_force_topk_batch(self, queries, k, exclude=None):
+        """
+        一组查询（已归一化）对全部语料的前 k：每个语料块一次 GEMM 得到 (查询数, 块大小) 的分数，
+        块内用 argpartition 取前 k，再与目前为止的前 k 合并。返回按分数降序的 (scores, indices)。
+        exclude（缺省为墓碑位图）中为 True 的行打分时置为 -inf，不足 k 个时 indices 为 -1。
+        """
+        matrix = self._normed.data
+        if exclude is None and self._num_deleted:
+            exclude = self._deleted.data[:, 0]
+        penalty = _exclude_penalty(exclude) if exclude is not None else None
+        n = len(matrix)
+        k = min(k, n)
+        prepared = self._codec.prepare(queries) if self._codec is not None else None
+        best_scores = best_indices = None
+        for start in range(0, n, self.block_size):
+            block = matrix[start:start + self.block_size]
+            block_scores = self._codec.scores(prepared, block) if prepared is not None else queries @ block.T
+            if penalty is not None:
+                block_scores += penalty[start:start + len(block)]
+            if block_scores.shape[1] > k:
+                top = np.argpartition(block_scores, -k, axis=1)[:, -k:]
+                block_scores = np.take_along_axis(block_scores, top, axis=1)
+            else:
+                top = np.broadcast_to(np.arange(block_scores.shape[1]), block_scores.shape)
+            top = top + start
+            if best_scores is None:
+                best_scores, best_indices = block_scores, top
+                continue
+            merged_scores = np.concatenate([best_scores, block_scores], axis=1)
+            merged_indices = np.concatenate([best_indices, top], axis=1)
+            sel = np.argpartition(merged_scores, -k, axis=1)[:, -k:]
+            best_scores = np.take_along_axis(merged_scores, sel, axis=1)
+            best_indices = np.take_along_axis(merged_indices, sel, axis=1)
+        order = np.argsort(-best_scores, axis=1, kind='stable')
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        best_indices = np.take_along_axis(best_indices, order, axis=1)
+        if penalty is not None:
+            best_indices = np.where(np.isneginf(best_scores), -1, best_indices)
+        return best_scores, best_indices
     
-    def load(self, filepath):
-        """从文件加载索引"""
-        if not os.path.exists(filepath):
-            raise FileNotFoundError(f"索引文件不存在: {filepath}")
-        
+    _PARAMS = ('dimension', 'index_type', 'keep_vectors', 'block_size', 'nlist', 'nprobe', 'M',
+               'ef_construction', 'ef_search', 'storage', 'pq_m', 'rerank_k', 'compact_threshold',
+               'prefilter_ratio')
+
+    def save(self, path):
+        """
+        保存索引到目录 path（版本化的磁盘格式，load 时可直接 mmap）：
+            manifest.json          格式版本、索引参数、条数、索引后端（faiss / native）
+            vectors.npy            原始向量（keep_vectors=True 时）
+            search.npy             暴力搜索用的归一化矩阵或压缩编码；codec.npz 为量化器参数
+            ivf_*.npy / hnsw_*.npy 原生 IVF / HNSW 索引的数组
+            index.faiss            FAISS 原生序列化格式
+            texts.bin / metadata.bin 及 *.offsets.npy  拼接的 utf-8 / JSON 记录与偏移量
+            row_ids.npy / deleted.npy  每行的外部 id 与墓碑位图（墓碑原样保存，不在保存时压缩）
+            attr{i}_*                第 i 个属性索引（字段与类型记在 manifest 的 attributes 里）
+        先写到临时目录再整体替换，其他进程正在 mmap 的旧文件不受影响。
+        """
+        path = os.path.normpath(path)
+        tmp = path + '.tmp'
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+
+        manifest = {name: getattr(self, name) for name in self._PARAMS}
+        manifest.update({
+            'format': INDEX_FORMAT,
+            'version': INDEX_FORMAT_VERSION,
+            'ntotal': self.ntotal,
+            'backend': 'faiss' if self.index is not None else 'native',
+        })
+        if self._store is not None:
+            _save_array(tmp, 'vectors', self._store.data)
+        if self._normed is not None:
+            _save_array(tmp, 'search', self._normed.data)
+        if self._codec is not None:
+            np.savez(os.path.join(tmp, 'codec.npz'), **self._codec.state_dict())
+        if isinstance(self._ann, HNSWIndex):
+            manifest['hnsw'] = self._ann.save(tmp)
+        elif self._ann is not None:
+            self._ann.save(tmp)
+        if self.index is not None:
+            faiss.write_index(self.index, os.path.join(tmp, 'index.faiss'))
+        _save_array(tmp, 'row_ids', self._row_ids.data)
+        _save_array(tmp, 'deleted', self._deleted.data)
+        manifest['num_deleted'] = self._num_deleted
+        manifest['next_id'] = self._next_id
+        manifest['attributes'] = []
+        for i, (field, attr) in enumerate(self._attr_indexes.items()):
+            attr.save(tmp, f'attr{i}')
+            manifest['attributes'].append([field, attr.kind])
+        OffsetRecordList.write(tmp, 'texts', self.texts or [], _encode_text)
+        OffsetRecordList.write(tmp, 'metadata', self.metadata or [], _encode_metadata)
+        with open(os.path.join(tmp, 'manifest.json'), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+        # 旧索引（目录或旧版 pickle 文件）先挪开再换上新目录
+        old = None
+        if os.path.exists(path):
+            old = path + '.old'
+            if os.path.isdir(old):
+                shutil.rmtree(old)
+            elif os.path.exists(old):
+                os.remove(old)
+            os.rename(path, old)
+        os.rename(tmp, path)
+        if old is not None:
+            if os.path.isdir(old):
+                shutil.rmtree(old)
+            else:
+                os.remove(old)
+
+        print(f"索引已保存到: {path}")
+
+    def load(self, path, mmap=True):
+        """
+        从 save 写出的目录加载索引：不解析文本、不重建索引，大数组直接 mmap，
+        多个进程加载同一目录时共享这些只读页；mmap=False 时全部读进内存。
+        保存时的索引后端与当前环境不一致（如保存时有 FAISS、现在没有）时，用保存的向量重建。
+        path 是文件时按旧版 pickle 格式加载。
+        """
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"索引文件不存在: {path}")
+        if not os.path.isdir(path):
+            self._load_pickle(path)
+            return
+
+        with open(os.path.join(path, 'manifest.json'), encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get('format') != INDEX_FORMAT:
+            raise ValueError(f"不是向量索引目录: {path}")
+        if manifest['version'] > INDEX_FORMAT_VERSION:
+            raise ValueError(f"索引格式版本 {manifest['version']} 高于当前支持的 {INDEX_FORMAT_VERSION}，请升级代码")
+
+        for name in self._PARAMS:
+            setattr(self, name, manifest.get(name, getattr(self, name)))
+        self._build_index()
+        self._faiss_mmap_path = None
+        self.texts = OffsetRecordList.open(path, 'texts', _decode_text, mmap=mmap)
+        self.metadata = OffsetRecordList.open(path, 'metadata', _decode_metadata, mmap=mmap)
+        mode = 'r' if mmap else None
+        self._load_ids(path, manifest, mode)
+        self._attr_indexes = {}
+        for i, (field, kind) in enumerate(manifest.get('attributes', [])):
+            attr = ATTRIBUTE_INDEX_TYPES[kind]()
+            attr.load(path, f'attr{i}', mmap=mmap)
+            self._attr_indexes[field] = attr
+
+        backend = 'faiss' if self.index is not None else 'native'
+        if backend != manifest['backend']:
+            vectors = self._saved_vectors(path, manifest, mode)
+            print(f"索引保存时的后端为 {manifest['backend']}，当前为 {backend}，用保存的向量重建索引")
+            if len(vectors):
+                self._index_vectors(vectors)
+        else:
+            if self._store is not None and os.path.exists(os.path.join(path, 'vectors.npy')):
+                self._store = VectorStore.wrap(_load_array(path, 'vectors', mode))
+            if self._codec is not None:
+                with np.load(os.path.join(path, 'codec.npz')) as state:
+                    self._codec.load_state_dict(dict(state))
+            if self._normed is not None:
+                self._normed = VectorStore.wrap(_load_array(path, 'search', mode))
+            if isinstance(self._ann, HNSWIndex):
+                self._ann.load(path, manifest['hnsw'], mmap=mmap)
+            elif self._ann is not None:
+                self._ann.load(path, mmap=mmap)
+            if self.index is not None:
+                self._load_faiss(os.path.join(path, 'index.faiss'), mmap)
+
+        print(f"索引已从 {path} 加载，包含 {len(self.texts)} 个文档")
+
+    def _load_ids(self, path, manifest, mode):
+        """行号 -> id 可以只读映射；墓碑位图删除时要原地写，读进内存（每行 1 字节）"""
+        self._reset_ids()
+        if not os.path.exists(os.path.join(path, 'row_ids.npy')):
+            # 版本 1：连续编号，没有删除
+            self._register_rows(manifest['ntotal'])
+            return
+        row_ids = _load_array(path, 'row_ids', mode)
+        deleted = _load_array(path, 'deleted', None)
+        self._row_ids = VectorStore.wrap(row_ids)
+        self._deleted = VectorStore.wrap(deleted)
+        live = np.flatnonzero(~deleted[:, 0])
+        self._id_rows = dict(zip(row_ids[live, 0].tolist(), live.tolist()))
+        self._num_deleted = len(deleted) - len(live)
+        self._next_id = int(manifest.get('next_id', row_ids.max() + 1 if len(row_ids) else 0))
+
+    def _load_faiss(self, filepath, mmap):
+        """mmap 时按只读映射读取（不支持的索引类型退回普通读取），第一次追加前再整体读进内存"""
+        if mmap and hasattr(faiss, 'IO_FLAG_MMAP'):
+            flags = faiss.IO_FLAG_MMAP | getattr(faiss, 'IO_FLAG_READ_ONLY', 0)
+            try:
+                self.index = faiss.read_index(filepath, flags)
+                self._faiss_mmap_path = filepath
+                return
+            except RuntimeError:
+                pass
+        self.index = faiss.read_index(filepath)
+
+    def _saved_vectors(self, path, manifest, mode):
+        """后端不一致时取重建用的向量：优先原始向量，其次暴力搜索矩阵（解码）或原生近似索引中的向量"""
+        if os.path.exists(os.path.join(path, 'vectors.npy')):
+            return _load_array(path, 'vectors', mode)
+        if os.path.exists(os.path.join(path, 'search.npy')):
+            codes = _load_array(path, 'search', mode)
+            codec = _make_codec(self.storage, self.dimension, self.pq_m)
+            if codec is None:
+                return codes
+            with np.load(os.path.join(path, 'codec.npz')) as state:
+                codec.load_state_dict(dict(state))
+            return codec.decode(codes)
+        if self.index_type == 'hnsw' and 'hnsw' in manifest:
+            ann = HNSWIndex(self.dimension, M=self.M)
+            ann.load(path, manifest['hnsw'], mmap=mode is not None)
+            return ann.reconstruct()
+        if self.index_type == 'ivf':
+            ann = IVFIndex(self.dimension, nlist=self.nlist)
+            ann.load(path, mmap=mode is not None)
+            return ann.reconstruct()
+        if manifest['ntotal'] == 0:
+            return np.zeros((0, self.dimension), dtype=np.float32)
+        raise RuntimeError("索引只保存了 FAISS 格式且没有原始向量，当前环境没有 FAISS，无法加载")
+
+    def _load_pickle(self, filepath):
+        """旧版单文件 pickle 格式：读出全部向量后重建索引"""
         with open(filepath, 'rb') as f:
             data = pickle.load(f)
         
-        self.vectors = data['vectors']
-        self.texts = data['texts']
-        self.metadata = data['metadata']
         self.dimension = data['dimension']
         self.index_type = data['index_type']
         
         # 重新构建索引
         self._build_index()
-        if FAISS_AVAILABLE and self.index is not None and len(self.vectors) > 0:
-            self.index.add(self.vectors.astype('float32'))
+        self._faiss_mmap_path = None
+        self._reset_ids()
+        self._attr_indexes = {}
+        self.texts = None
+        self.metadata = None
+        vectors = data['vectors']
+        if vectors is not None and len(vectors) > 0:
+            self.add_vectors(vectors, data['texts'], data['metadata'])
+        else:
+            self.texts = list(data['texts'] or [])
+            self.metadata = list(data['metadata'] or [])
+            self._register_rows(len(self.texts))
         
         print(f"索引已从 {filepath} 加载，包含 {len(self.texts)} 个文档")
 
+def benchmark_storage(vectors, queries, k=10, storages=STORAGE_TYPES, rerank_k=100, pq_m=16):
+    """
+    压缩存储对比报告：每种存储格式（及开启精确重打分时）的每条向量字节数、
+    相对 float32 暴力搜索的 recall@k 和批量查询耗时。
+    字节数只算搜索结构本身（编码 + 码本摊销），重打分另需保留原始向量。
+    """
+
+    vectors = np.asarray(vectors, dtype=np.float32)
+    queries = np.asarray(queries, dtype=np.float32)
+    dim = vectors.shape[1]
+    texts = [''] * len(vectors)
+    exact = VectorIndex(dim, keep_vectors=False)
+    exact.add_vectors(vectors, texts)
+    _, truth = exact.batch_topk(queries, k)
+
+    report = {}
+    print(f"{'存储':<14}{'字节/向量':>10}{'recall@' + str(k):>12}{'ms/查询':>10}")
+    for storage in storages:
+        for rerank in ((0, rerank_k) if storage != 'float32' and rerank_k else (0,)):
+            index = VectorIndex(dim, keep_vectors=bool(rerank), storage=storage, pq_m=pq_m, rerank_k=rerank)
+            index.add_vectors(vectors, texts)
+            usage = index.memory_usage()
+            per_vector = (index._normed.nbytes + usage['codec']) / len(vectors) if index._normed is not None \
+                else usage['faiss'] / len(vectors)
+            start = time.perf_counter()
+            _, found = index.batch_topk(queries, k)
+            ms = 1000 * (time.perf_counter() - start) / len(queries)
+            recall = np.mean([len(set(f) & set(t)) / k for f, t in zip(found, truth)])
+            name = storage + (f'+rerank{rerank}' if rerank else '')
+            report[name] = {'bytes_per_vector': per_vector, 'recall': recall, 'ms_per_query': ms}
+            print(f"{name:<14}{per_vector:>10.1f}{recall:>12.3f}{ms:>10.3f}")
+    return report
+
+
+@contextlib.contextmanager
+def _timed(timings, stage):
+    """把 with 块的耗时（毫秒）累加到 timings[stage]"""
+    start = time.perf_counter()
+    yield
+    timings[stage] = timings.get(stage, 0.0) + (time.perf_counter() - start) * 1000
+
+
 class SemanticSearchEngine:
-    """语义搜索引擎"""
+    """语义搜索引擎
+
+    除向量检索外还维护一份 BM25 关键词索引（keyword_index，文档号即向量索引的行号），
+    hybrid_search / batch_hybrid_search 两路召回后融合排序，补上 SKU、品牌、型号等需要精确命中的查询。
+    """
     
     def __init__(self, model_checkpoint=None, tokenizer=None, index_path=None):
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         self.model = None
         self.tokenizer = tokenizer
         self.index = VectorIndex()
+        self.keyword_index = None
+        self._keyword_generation = None
+        self.last_timing = {}
         
         if model_checkpoint:
             self.load_model(model_checkpoint)
@@ -228,13 +2059,91 @@ class SemanticSearchEngine:
         results = self.index.search(query_vector, k, threshold)
         return results
     
+    def build_keyword_index(self, k1=1.2, b=0.75):
+        """用向量索引里的全部文本（含尚未压缩掉的已删除行，搜索时屏蔽）重建 BM25 关键词索引"""
+        self.keyword_index = BM25Index(TextTokenizer(), k1=k1, b=b)
+        if self.index.ntotal:
+            self.keyword_index.add(self.index.texts[:self.index.ntotal])
+            self.keyword_index.merge()
+        self._keyword_generation = self.index._generation
+        return self.keyword_index
+
+    def _sync_keyword_index(self):
+        """向量索引压缩过（行号变了）就重建，只是追加了新行就增量补上"""
+        ki = self.keyword_index
+        if ki is None or self._keyword_generation != self.index._generation or len(ki) > self.index.ntotal:
+            self.build_keyword_index(*((ki.k1, ki.b) if ki is not None else ()))
+        elif len(ki) < self.index.ntotal:
+            ki.add(self.index.texts[len(ki):self.index.ntotal])
+
+    def hybrid_search(self, query, k=5, mode='rrf', alpha=0.5, candidates=50, rrf_k=60, filters=None):
+        """单条混合检索，参数见 batch_hybrid_search"""
+        return self.batch_hybrid_search([query], k, mode=mode, alpha=alpha, candidates=candidates,
+                                        rrf_k=rrf_k, filters=filters)[0]
+
+    def batch_hybrid_search(self, queries, k=5, mode='rrf', alpha=0.5, candidates=50, rrf_k=60, filters=None):
+        """
+        混合检索：向量召回与 BM25 关键词召回各取 candidates 个候选，融合后取前 k。
+        mode='rrf' 为倒数排名融合（rrf_k 为平滑常数）；mode='weighted' 为两路分数各自 min-max 归一化后
+        按 alpha : (1 - alpha) 加权。filters 与已删除的行对两路召回同样生效。
+        结果格式与 search 相同，score 为融合分数，另附 dense_score / keyword_score（该路没召回时为 None）。
+        各阶段耗时（毫秒）记在 self.last_timing：keyword_sync / encode / dense / keyword / fusion / total。
+        """
+        if mode not in ('rrf', 'weighted'):
+            raise ValueError(f"不支持的融合方式: {mode}，可选 'rrf' / 'weighted'")
+        queries = list(queries)
+        timings = {}
+
+        def run():
+            timings.clear()
+            with _timed(timings, 'total'):
+                with _timed(timings, 'keyword_sync'):
+                    self._sync_keyword_index()
+                with _timed(timings, 'encode'):
+                    vectors = np.stack([self.encode_text(q) for q in queries]) if queries else \
+                        np.empty((0, self.index.dimension), dtype=np.float32)
+                with _timed(timings, 'dense'):
+                    dense_scores, dense_rows = self.index._batch_topk(vectors, candidates, None, 1024, filters=filters)
+                with _timed(timings, 'keyword'):
+                    exclude = self.index.exclusion_mask(filters)
+                    keyword_scores, keyword_rows = self.keyword_index.batch_search(queries, candidates, exclude=exclude)
+                with _timed(timings, 'fusion'):
+                    results = []
+                    for qi in range(len(queries)):
+                        if mode == 'rrf':
+                            fused, rows = reciprocal_rank_fusion([dense_rows[qi], keyword_rows[qi]], k=rrf_k)
+                        else:
+                            fused, rows = weighted_score_fusion([dense_scores[qi], keyword_scores[qi]],
+                                                                [dense_rows[qi], keyword_rows[qi]], [alpha, 1 - alpha])
+                        dense = dict(zip(dense_rows[qi].tolist(), dense_scores[qi].tolist()))
+                        keyword = dict(zip(keyword_rows[qi].tolist(), keyword_scores[qi].tolist()))
+                        items = self.index._format_results(fused[:k], rows[:k], -np.inf)
+                        for item in items:
+                            item['dense_score'] = dense.get(item['index'])
+                            item['keyword_score'] = keyword.get(item['index'])
+                        results.append(items)
+            return results
+
+        # 与 VectorIndex 的读一样：期间发生压缩替换就整体重做，两路召回的行号始终对应同一版本
+        results = self.index._read(run)
+        self.last_timing = timings
+        return results
+    
     def save_index(self, filepath):
-        """保存索引"""
+        """保存索引（关键词索引存在时一并保存到索引目录下的 bm25/）"""
         self.index.save(filepath)
+        if self.keyword_index is not None:
+            self._sync_keyword_index()
+            self.keyword_index.save(os.path.join(filepath, 'bm25'))
     
     def load_index(self, filepath):
-        """加载索引"""
+        """加载索引；旧版 pickle 或没有保存关键词索引时，第一次混合检索时再构建"""
         self.index.load(filepath)
+        self.keyword_index = None
+        keyword_dir = os.path.join(filepath, 'bm25')
+        if os.path.isdir(keyword_dir):
+            self.keyword_index = BM25Index.load(keyword_dir, TextTokenizer())
+            self._keyword_generation = self.index._generation
 
 def demonstrate_semantic_search():
     """演示语义搜索"""
@@ -296,8 +2205,7 @@ def demonstrate_semantic_search():
             print(f"  {i}. {result['text']} (相似度: {result['score']:.4f})")
     
     # 保存索引
-    search_engine.save_index('semantic_index.pkl')
-    print(f"\n索引已保存到: semantic_index.pkl")
+    search_engine.save_index('semantic_index')
 
 if __name__ == "__main__":
     demonstrate_semantic_search()